@@ -12,6 +12,7 @@ import sys
 smk_directory = os.path.abspath(workflow.basedir)
 sys.path.append(os.path.join(Path(smk_directory).parent.parent.parent, "fedshop"))
 
+from compression import dataset_suffix
 from utils import load_config
 
 #===============================
@@ -28,6 +29,12 @@ CONFIG = load_config(CONFIGFILE)["generation"]
 N_QUERY_INSTANCES = CONFIG["n_query_instances"]
 VERBOSE = CONFIG["verbose"]
 N_BATCH = CONFIG["n_batch"]
+# e.g. .nq.gz, generate.py compresses the output of WatDiv accordingly
+DATASET_SUFFIX = dataset_suffix(CONFIG.get("dataset_compression", "none"))
+# The products are generated by several WatDiv processes, see generate_product_shards in generate.py
+PRODUCT_SHARDS = int(CONFIG["generator"].get("product_shards", 1))
+# With stream ingestion, ingest-data.smk generates the vendors and rating sites while loading them, only the products are generated here
+STREAM_INGESTION = CONFIG["virtuoso"].get("stream_ingestion", False)
 
 # Config per batch
 N_VENDOR=CONFIG["schema"]["vendor"]["params"]["vendor_n"]
@@ -55,10 +62,14 @@ def start_generator(status_file):
 # PIPELINE
 #=================
 
-rule all:
-    input:
-        vendor=expand("{modelDir}/dataset/vendor{vendor_id}.nq", vendor_id=range(N_VENDOR), modelDir=MODEL_DIR),
-        ratingsite=expand("{modelDir}/dataset/ratingsite{ratingsite_id}.nq", ratingsite_id=range(N_RATINGSITE), modelDir=MODEL_DIR)
+if STREAM_INGESTION:
+    rule all:
+        input: CONFIG["schema"]["product"]["export_output_dir"]
+else:
+    rule all:
+        input:
+            vendor=expand("{modelDir}/dataset/vendor{vendor_id}{suffix}", vendor_id=range(N_VENDOR), modelDir=MODEL_DIR, suffix=DATASET_SUFFIX),
+            ratingsite=expand("{modelDir}/dataset/ratingsite{ratingsite_id}{suffix}", ratingsite_id=range(N_RATINGSITE), modelDir=MODEL_DIR, suffix=DATASET_SUFFIX)
     
 rule generate_ratingsites:
     priority: 12
@@ -66,7 +77,7 @@ rule generate_ratingsites:
     input: 
         status=expand("{workDir}/generator-ok.txt", workDir=WORK_DIR),
         product=ancient(CONFIG["schema"]["product"]["export_output_dir"])
-    output: "{modelDir}/dataset/ratingsite{ratingsite_id}.nq"
+    output: "{modelDir}/dataset/ratingsite{ratingsite_id}" + DATASET_SUFFIX
     shell: "python fedshop/generate.py generate {CONFIGFILE} ratingsite {output} --id {wildcards.ratingsite_id}"
 
 rule generate_vendors:
@@ -75,15 +86,15 @@ rule generate_vendors:
     input: 
         status=expand("{workDir}/generator-ok.txt", workDir=WORK_DIR),
         product=ancient(CONFIG["schema"]["product"]["export_output_dir"])
-    output: "{modelDir}/dataset/vendor{vendor_id}.nq"
+    output: "{modelDir}/dataset/vendor{vendor_id}" + DATASET_SUFFIX
     shell: "python fedshop/generate.py generate {CONFIGFILE} vendor {output} --id {wildcards.vendor_id}"
 
 rule generate_products:
     priority: 14
-    threads: 1
+    threads: PRODUCT_SHARDS
     input: expand("{workDir}/generator-ok.txt", workDir=WORK_DIR)
     output: directory(CONFIG["schema"]["product"]["export_output_dir"]), 
-    shell: 'python fedshop/generate.py generate {CONFIGFILE} product {output}'
+    shell: 'python fedshop/generate.py generate {CONFIGFILE} product {output} --shards {PRODUCT_SHARDS}'
 
 rule start_generator_container:
     output: "{workDir}/generator-ok.txt"
@@ -17,6 +17,7 @@ print(Path(directory).parent.parent.parent.parent)
 sys.path.append(os.path.join(Path(directory).parent.parent.parent.parent, "fedshop")) 
 
 from query import exec_query
+from result_cache import dataset_fingerprint
 from utils import load_config, activate_one_container, fedshop_logger
 
 @click.group
@@ -29,6 +30,7 @@ WORKDIR = Path(__file__).parent
 CONFIG = load_config(CONFIGFILE)["generation"]
 SPARQL_COMPOSE_FILE = CONFIG["virtuoso"]["compose_file"]
 SPARQL_SERVICE_NAME = CONFIG["virtuoso"]["service_name"]
+SPARQL_ENDPOINT = CONFIG["virtuoso"]["default_endpoint"]
 N_BATCH = CONFIG["n_batch"]
 LAST_BATCH = N_BATCH - 1
 LOGGER = fedshop_logger(Path(__file__).name)
@@ -39,7 +41,8 @@ def query(queryfile, batch_id):
         query_text = fp.read()
         print(query_text)
         activate_one_container(batch_id, SPARQL_COMPOSE_FILE, SPARQL_SERVICE_NAME, LOGGER, "/dev/null")
-        _, result = exec_query(configfile=CONFIGFILE, query=query_text, error_when_timeout=True, batch_id=batch_id)
+        fingerprint = dataset_fingerprint(CONFIG["workdir"], batch_id)
+        _, result = exec_query(query=query_text, endpoint=SPARQL_ENDPOINT, error_when_timeout=True, fingerprint=fingerprint)
         with BytesIO(result) as header_stream, BytesIO(result) as data_stream: 
             header = header_stream.readline().decode().strip().replace('"', '').split(",")
             result = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
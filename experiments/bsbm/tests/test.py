@@ -37,13 +37,14 @@ def cli():
 
 from utils import load_config
 from query import exec_query
+from result_cache import dataset_fingerprint
 
 BATCH_ID = int(os.environ["RSFB__BATCHID"])
 CONFIGFILE = os.environ["RSFB__CONFIGFILE"]
 
 WORKDIR = Path(__file__).parent
 CONFIG = load_config(CONFIGFILE)["generation"]
-SPARQL_ENDPOINT = CONFIG["virtuoso"]["endpoints"]
+SPARQL_ENDPOINT = CONFIG["virtuoso"]["default_endpoint"]
 STATS_SIGNIFICANCE_LEVEL = 1 - CONFIG["stats"]["confidence_level"]
 
 COUNTRIES_EXPECTED_WEIGHT = {"US": 0.40, "UK": 0.10, "JP": 0.10, "CN": 0.10, "DE": 0.05, "FR": 0.05, "ES": 0.05, "RU": 0.05, "KR": 0.05, "AT": 0.05}
@@ -54,23 +55,17 @@ WATDIV_BOOST_SIGMA = 0.5/3.0
 
 def query(queryfile, cache=True, limit=None):
     result = None
-    if cache:
-        saveAs = f"{Path(queryfile).parent}/{Path(queryfile).stem}.csv"
-        if os.path.exists(saveAs):
-            with open(saveAs, "r") as fp:
-                header = fp.readline().strip().replace('"', '').split(",")
-                result = pd.read_csv(saveAs, parse_dates=[h for h in header if "date" in h])
-                return result
+    # Results are cached in the shared result cache (fedshop/result_cache.py) as long as the batch is not re-ingested
+    fingerprint = dataset_fingerprint(CONFIG["workdir"], BATCH_ID) if cache else None
     
     with open(queryfile, "r") as fp:
         query_text = fp.read()
         if limit is not None:
             query_text += f"LIMIT {limit}"
-        _, result = exec_query(configfile=CONFIGFILE, query=query_text, error_when_timeout=True, batch_id=BATCH_ID)
+        _, result = exec_query(query=query_text, endpoint=SPARQL_ENDPOINT, error_when_timeout=True, fingerprint=fingerprint)
         with BytesIO(result) as header_stream, BytesIO(result) as data_stream: 
             header = header_stream.readline().decode().strip().replace('"', '').split(",")
             result = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
-        if cache: result.to_csv(saveAs, index=False)
     return result
 
 
@@ -0,0 +1,299 @@
+"""Content-addressed cache for SPARQL algebra.
+
+Parsing (pyparsing) and serializing (translateQuery + translateAlgebra) the same templates
+is repeated across snakemake rules and loops. This module caches the results, both in memory and on disk,
+using a hash of the inputs as key.
+
+- Entries are stored as pickled bytes, a fresh copy is returned on every lookup so that callers can mutate the algebra.
+- rdflib's CompValue/Expr and pyparsing's ParseResults are not picklable as is, custom reducers are registered.
+- Keys include the rdflib version and a hash of the sources of the algebra package, so a change of the serializer
+  or of the rewrites invalidates the entries.
+- The cache directory can be changed with FEDSHOP_CACHE_DIR. Set FEDSHOP_ALGEBRA_CACHE=0 to disable the cache.
+- The directory is bounded (FEDSHOP_ALGEBRA_CACHE_MAX_MB), least recently used entries are evicted first,
+  and so are the entries kept in memory (MEMORY_MAX_BYTES).
+- `python fedshop/algebra/cache.py stats|purge|clear` to inspect or purge the cache.
+"""
+
+import collections
+import copyreg
+import hashlib
+import io
+import os
+from pathlib import Path
+import pickle
+import tempfile
+import time
+import types
+
+import click
+import rdflib
+from pyparsing import ParseResults
+from rdflib.plugins.sparql.parserutils import CompValue, Expr
+
+CACHE_DIR = os.path.join(os.environ.get("FEDSHOP_CACHE_DIR", ".fedshop_cache"), "algebra")
+CACHE_ENABLED = os.environ.get("FEDSHOP_ALGEBRA_CACHE", "1") != "0"
+CACHE_MAX_BYTES = int(float(os.environ.get("FEDSHOP_ALGEBRA_CACHE_MAX_MB", 512)) * 1024 * 1024)
+MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+@click.group
+def cli():
+    pass
+
+def code_fingerprint():
+    """Hash of the sources of the algebra package (parser, serializer, rewrites, this module).
+
+    Part of every key, so that entries computed by a previous version of the code are not returned.
+    """
+    hasher = hashlib.sha256()
+    for source in sorted(Path(__file__).parent.glob("*.py")):
+        hasher.update(source.name.encode())
+        hasher.update(source.read_bytes())
+    return hasher.digest()
+
+CODE_FINGERPRINT = code_fingerprint()
+
+def _rebuild_compvalue(cls, state, items):
+    node = cls.__new__(cls)
+    collections.OrderedDict.__init__(node)
+    evalfn = state.pop("_evalfn", None)
+    node.__dict__.update(state)
+    if evalfn is not None:
+        node._evalfn = types.MethodType(evalfn, node)
+    node.update(items)
+    return node
+
+def _reduce_compvalue(node):
+    state = dict(node.__dict__)
+    # Expr binds its evaluation function to itself, store the plain function to avoid the cycle
+    if isinstance(state.get("_evalfn"), types.MethodType):
+        state["_evalfn"] = state["_evalfn"].__func__
+    return _rebuild_compvalue, (type(node), state, list(node.items()))
+
+def _rebuild_parse_results(tokens, named):
+    results = ParseResults(tokens)
+    for name, value in named.items():
+        results[name] = value
+    return results
+
+def _reduce_parse_results(results):
+    return _rebuild_parse_results, (list(results), { name: results[name] for name in results.keys() })
+
+class AlgebraPickler(pickle.Pickler):
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[CompValue] = _reduce_compvalue
+    dispatch_table[Expr] = _reduce_compvalue
+    dispatch_table[ParseResults] = _reduce_parse_results
+
+def dumps(obj):
+    """Pickle an object that may contain rdflib algebra nodes.
+
+    Args:
+        obj: the object to pickle.
+
+    Returns:
+        bytes: the pickled object.
+    """
+    with io.BytesIO() as buffer:
+        pickler = AlgebraPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        # No memo: the output only depends on the content, not on object identity, so it can be used as key
+        pickler.fast = True
+        pickler.dump(obj)
+        return buffer.getvalue()
+
+def loads(data):
+    return pickle.loads(data)
+
+def digest(*parts):
+    """Compute the cache key for the given parts.
+
+    Args:
+        parts (str | bytes): the content the cached value depends on.
+
+    Returns:
+        str: the hex digest.
+    """
+    hasher = hashlib.sha256(rdflib.__version__.encode())
+    hasher.update(CODE_FINGERPRINT)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        hasher.update(len(part).to_bytes(8, "little"))
+        hasher.update(part)
+    return hasher.hexdigest()
+
+class AlgebraCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, memory_max_bytes=MEMORY_MAX_BYTES, enabled=CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self.enabled = enabled
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        # Bytes written since the directory was last checked, None until the first write of the process
+        self._written = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pkl")
+
+    def _remember(self, key, data):
+        """Keep an entry in memory, evicting the least recently used ones beyond memory_max_bytes."""
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes and len(self._memory) > 0:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get(self, key):
+        """Lookup a key, first in memory then on disk.
+
+        Args:
+            key (str): the cache key.
+
+        Returns:
+            The cached object (fresh copy), or None if not found.
+        """
+        if not self.enabled:
+            return None
+
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+        else:
+            path = self._path(key)
+            if not os.path.exists(path):
+                return None
+            try:
+                with open(path, "rb") as cache_fs:
+                    data = cache_fs.read()
+                # The modification time is the last access, see evict
+                os.utime(path)
+            except OSError:
+                return None
+            self._remember(key, data)
+
+        try:
+            return loads(data)
+        except Exception:
+            # Corrupted or incompatible entry, forget it
+            self._memory_bytes -= len(self._memory.pop(key, b""))
+            return None
+
+    def set(self, key, obj):
+        if not self.enabled:
+            return
+
+        data = dumps(obj)
+        self._remember(key, data)
+
+        # Write then rename, so that concurrent jobs never read a partial entry
+        path = self._path(key)
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(mode="wb", dir=Path(path).parent, delete=False) as tmp_fs:
+                tmp_fs.write(data)
+            os.replace(tmp_fs.name, path)
+        except OSError:
+            return
+
+        # The directory is checked on the first write of each process (most write a few entries),
+        # then each time a sixteenth of max_bytes has been written
+        if self._written is None or self._written + len(data) > self.max_bytes // 16:
+            self._written = 0
+            self.evict()
+        else:
+            self._written += len(data)
+
+    def entries(self):
+        """The entries on disk.
+
+        Returns:
+            list[tuple]: (path, size, last access) of each entry, least recently used first.
+        """
+        entries = []
+        for path in Path(self.cache_dir).glob("*/*.pkl"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries until the directory fits in max_bytes.
+
+        Returns:
+            int: the number of removed entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def purge(self, older_than=None):
+        """Remove the entries not accessed for older_than seconds, all of them by default.
+
+        Returns:
+            int: the number of removed entries.
+        """
+        self._memory.clear()
+        self._memory_bytes = 0
+        removed = 0
+        for path, _, last_access in self.entries():
+            if older_than is not None and last_access >= time.time() - older_than:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+        return removed
+
+    def clear(self):
+        """Forget the entries kept in memory, see purge to remove those on disk."""
+        self._memory.clear()
+        self._memory_bytes = 0
+
+ALGEBRA_CACHE = AlgebraCache()
+
+@cli.command()
+def stats():
+    """Print the number of entries and the size of the cache.
+    """
+    entries = ALGEBRA_CACHE.entries()
+    total = sum(size for _, size, _ in entries)
+    click.echo(f"{len(entries)} entries, {total/1024/1024:.1f} MB / {ALGEBRA_CACHE.max_bytes/1024/1024:.0f} MB ({ALGEBRA_CACHE.cache_dir})")
+
+@cli.command()
+@click.option("--older-than", type=click.FLOAT, help="Remove entries not used for this number of days.")
+@click.option("--max-mb", type=click.FLOAT, help="Evict least recently used entries until the cache fits.")
+def purge(older_than, max_mb):
+    """Remove entries matching the criteria.
+    """
+    if max_mb is not None:
+        removed = ALGEBRA_CACHE.evict(int(max_mb * 1024 * 1024))
+    elif older_than is not None:
+        removed = ALGEBRA_CACHE.purge(older_than=older_than*86400)
+    else:
+        raise click.UsageError("Nothing to purge, use `clear` to remove everything")
+    click.echo(f"Removed {removed} entries")
+
+@cli.command(name="clear")
+def clear_entries():
+    """Remove all entries.
+    """
+    click.echo(f"Removed {ALGEBRA_CACHE.purge()} entries")
+
+if __name__ == "__main__":
+    cli()
@@ -1,5 +1,9 @@
 from itertools import chain
+import operator
 from pprint import pprint
+
+import numpy as np
+import pandas as pd
 from pyparsing import Forward, Group, Literal, Suppress, Word, ZeroOrMore, alphanums, alphas, infixNotation, oneOf, opAssoc, Optional
 from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.plugins.sparql.algebra import _traverseAgg, traverse
@@ -148,6 +152,88 @@ def parse_expr(input_expr):
     parsed_expr = Expr.parseString(input_expr)
     return parsed_expr
 
+# Compilation to NumPy predicates
+
+COMPARISON_OPS = {
+    "==": operator.eq, "!=": operator.ne, 
+    ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le
+}
+
+def _compare(op, left, right):
+    if op == "in":
+        return pd.Series(left, copy=False).isin(np.atleast_1d(right)).to_numpy()
+    
+    compare = COMPARISON_OPS[op]
+    if _is_plain_array(left) and _is_plain_array(right):
+        return np.asarray(compare(left, right), dtype=bool)
+    # Object and extension arrays (strings, nullable) may hold missing values, let pandas compare them as DataFrame.query would
+    return compare(pd.Series(left, copy=False), right).to_numpy(dtype=bool, na_value=False)
+
+def _is_plain_array(values):
+    dtype = getattr(values, "dtype", None)
+    return (isinstance(values, np.ndarray) and dtype != object) or (np.isscalar(values) and not isinstance(values, str))
+
+def compile_algebra(algebra):
+    """Compile an Expr algebra into a predicate evaluated on the columns of a DataFrame,
+    equivalent to `df.eval(translate_query(algebra))` without parsing the expression again.
+
+    Args:
+        algebra: the algebra, as returned by parse_expr (and possibly transformed).
+
+    Returns:
+        Callable[[pd.DataFrame], np.ndarray]: the predicate, returning a boolean mask.
+        @variables are given as keyword arguments, e.g. predicate(df, currentDate=...).
+    """
+    def _compile(node):
+        if not isinstance(node, CompValue):
+            # Group and ParseResults wrappers
+            return _compile(node[0])
+        
+        if node.name == "Expr":
+            return _compile(node["expr"])
+        
+        elif node.name == "ComparisonCondition":
+            left, right = _compile(node["left"]), _compile(node["right"])
+            op = node["op"]["op"]
+            return lambda columns, variables: _compare(op, left(columns, variables), right(columns, variables))
+        
+        elif node.name == "FunctionCondition":
+            raise NotImplementedError("FunctionCondition compilation not implemented")
+        
+        elif node.name == "BinaryExpr":
+            left, right = _compile(node["left"]), _compile(node["right"])
+            logical_op = { "and": np.logical_and, "or": np.logical_or }[node["op"]["op"]]
+            return lambda columns, variables: logical_op(left(columns, variables), right(columns, variables))
+        
+        elif node.name == "UnaryExpr":
+            right = _compile(node["right"])
+            return lambda columns, variables: np.logical_not(right(columns, variables))
+        
+        elif node.name == "Column":
+            column_name = node["column_name"]
+            return lambda columns, variables: columns[column_name]
+        
+        elif node.name == "AccessVariable":
+            var = node["var"]
+            return lambda columns, variables: variables[var]
+        
+        else:
+            raise NotImplementedError(f"Compilation for {node.name} not implemented")
+    
+    evaluate = _compile(algebra)
+    column_names = set(_traverseAgg(algebra, collect_constants))
+    
+    def predicate(df: pd.DataFrame, **variables):
+        columns = {}
+        for column_name in column_names:
+            values = df[column_name].array
+            # NumPy-backed columns are compared as ndarrays, the others keep their extension array
+            columns[column_name] = values.to_numpy() if isinstance(values.dtype, np.dtype) and values.dtype != object else values
+        mask = evaluate(columns, variables)
+        return np.broadcast_to(mask, (len(df),))
+    
+    return predicate
+
 # input_expr = "`ProductFeature2` != `ProductFeature1` and `x` <= `p1` and `ProductFeature3` != `ProductFeature2` and `ProductFeature3` != `ProductFeature1` and `y` <= `p2`"
 # input_expr = "`a` == @b and `c`.isin(`d`.groupby(`localProduct`)) and `e` == `f`"
 # input_expr = "`p3` <= `p1` and (`y` <= `p2` or `p3` <= `p2`) and `y` <= `p1`"
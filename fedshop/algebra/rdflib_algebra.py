@@ -144,12 +144,14 @@ def inject_constant_into_placeholders(node, injection_dict):
             if var_name in injection_dict:
                 normalize(injection_dict[var_name])
 
-def add_graph_to_triple_pattern(node):
+def add_graph_to_triple_pattern(node, graph_ids):
     """
     Wrap a triple pattern with GRAPH clause
 
     Args:
         node (CompValue): The triple pattern node to add the graph to.
+        graph_ids (Iterator[int]): Shared counter (e.g itertools.count()) naming the graph variables, 
+            so that the same query always yields the same variables.
 
     Returns:
         CompValue: The modified triple pattern node with the graph added.
@@ -159,7 +161,7 @@ def add_graph_to_triple_pattern(node):
         if node.name == "TriplesBlock":
             graph_triples = []
             for triple in node["triples"]:
-                graph_id = str(uuid.uuid4())[:8]
+                graph_id = next(graph_ids)
                 graph_node = CompValue(
                     "GraphGraphPattern", 
                     term=Variable(f"g{graph_id}"),
@@ -196,7 +198,7 @@ def replace_select_projection_with_graph(node):
             return CompValue(
                 "SelectQuery",
                 modifier="DISTINCT",
-                projection=graph_vars,
+                projection=[ CompValue("vars", var=graph_var) for graph_var in graph_vars ],
                 where=node["where"]
             )
         
@@ -351,7 +353,7 @@ def remove_filter_with_placeholders(node, consts):
     if isinstance(node, CompValue):
         if node.name == "SelectQuery":
             if select_consts:
-                node["projection"] = list(map(lambda x: CompValue("vars", var=Variable(x)), select_consts))
+                node["projection"] = list(map(lambda x: CompValue("vars", var=Variable(x)), sorted(select_consts)))
             node["modifier"] = "DISTINCT"
             return node
         
@@ -379,12 +381,15 @@ def add_values_with_placeholders(node, inline_data):
     if isinstance(node, CompValue):
         if node.name == "SelectQuery":
             inline_data_keys = [ Variable(k) for k in inline_data.keys() ] 
-            inline_data_values = [ 
+            inline_data_values = [
                 [ URIRef(v) if str(v).startswith("http") else Literal(v) for v in values ]
                 for values in inline_data.values()
             ]
             if len(inline_data_keys) == 1:
                 inline_data_values = inline_data_values[0]
+            else:
+                # VALUES expects one list per row, inline_data holds one list per column
+                inline_data_values = [ list(row) for row in zip(*inline_data_values) ]
                 
             values_clause = CompValue(
                 "InlineData",
@@ -392,7 +397,11 @@ def add_values_with_placeholders(node, inline_data):
                 value = inline_data_values
             )
             
-            node["where"]["part"].insert(0, values_clause)
+            # Replace the WHERE clause rather than inserting into it, it may be shared with other trees (see rewrite.py)
+            where = node["where"]
+            new_where = CompValue(where.name, **where)
+            new_where["part"] = [values_clause] + list(where["part"])
+            node["where"] = new_where
             return node
         
 def add_service_to_triple_blocks(node, inline_data):
@@ -414,24 +423,25 @@ def translateAlgebra(query_algebra):
     """
     Translator of a Query's algebra to its equivalent SPARQL (string).
 
-    Coded as a class to support storage of state during the translation process,
-    without use of a file.
+    The query is built in a string held by the closure, placeholders such as {BGP} being
+    replaced as the algebra is traversed. No file is used, so concurrent translations
+    (e.g. parallel snakemake jobs sharing a working directory) do not interfere.
+    Each replacement scans the string, so the time grows quadratically with the size of the query,
+    which stays small for real queries (see misc/bench_serializer.py).
 
     Anticipated Usage:
 
     .. code-block:: python
 
-        translated_query = _AlgebraTranslator(query).translateAlgebra()
-
-    An external convenience function which wraps the above call,
-    `translateAlgebra`, is supplied, so this class does not need to be
-    referenced by client code at all in normal use.
+        translated_query = translateAlgebra(translateQuery(parseQuery(query)))
     """
 
+    # The query is built in memory: no file is shared between concurrent translations
+    query_text = ""
+
     def overwrite(text):
-        file = open("query.txt", "w+")
-        file.write(text)
-        file.close()
+        nonlocal query_text
+        query_text = text
         
     def replace(
         old: str,
@@ -440,14 +450,14 @@ def translateAlgebra(query_algebra):
         search_from_match_occurrence: int = None,
         count: int = 1,
     ):  
-        # Read in the file
-        with open("query.txt", "r") as file:
-            filedata = file.read()
+        nonlocal query_text
+        filedata = query_text
 
         def find_nth(haystack, needle, n):
-            start = haystack.lower().find(needle)
+            haystack = haystack.lower()
+            start = haystack.find(needle)
             while start >= 0 and n > 1:
-                start = haystack.lower().find(needle, start + len(needle))
+                start = haystack.find(needle, start + len(needle))
                 n -= 1
             return start
 
@@ -465,9 +475,7 @@ def translateAlgebra(query_algebra):
                 filedata.replace(old, new, count)
             )  
         
-        # Write the file out again
-        with open("query.txt", "w") as file:
-            file.write(filedata)
+        query_text = filedata
 
     aggr_vars = collections.defaultdict(list)  # type: dict
 
@@ -616,7 +624,7 @@ def translateAlgebra(query_algebra):
                 )
                 replace("{Graph}", expr)
             elif node.name == "Extend":
-                query_string = open("query.txt", "r").read().lower()
+                query_string = query_text.lower()
                 select_occurrences = query_string.count("-*-select-*-")
                 replace(
                     node.var.n3(),
@@ -847,7 +855,7 @@ def translateAlgebra(query_algebra):
             elif node.name == "RelationalExpression":
                 expr = convert_node_arg(node.expr)
                 op = node.op
-                if isinstance(list, type(node.other)):
+                if isinstance(node.other, list):
                     other = (
                         "("
                         + ", ".join(convert_node_arg(expr) for expr in node.other)
@@ -1264,7 +1272,4 @@ def translateAlgebra(query_algebra):
             #     raise ExpressionNotCoveredException("The expression {0} might not be covered yet.".format(node.name))
     
     traverse(query_algebra.algebra, visitPre=sparql_query_text)
-    query_from_algebra = open("query.txt", "r").read()
-    os.remove("query.txt")
-
-    return query_from_algebra
+    return query_text
@@ -0,0 +1,228 @@
+"""Single-pass rewriting of SPARQL parse trees.
+
+The transformations of query.py are rdflib visitors (see rdflib_algebra.py). Applying them with one `traverse` each
+walks the whole tree several times, and `traverse` modifies the tree in place, so every rewrite needs a fresh copy of it.
+`rewrite` applies a list of passes in a single post-order traversal and never modifies its input:
+
+- At each node, the passes run in order, each one on the result of the previous one.
+  This is equivalent to one traversal per pass as long as a pass does not depend on what a later pass does to the
+  descendants of the node, which holds for the passes below.
+- Copy-on-write: a node is copied (shallow) only when one of its children changed or a pass applies to it.
+  Unchanged subtrees are shared with the input, so a parsed template can be rewritten once per instance.
+- Nodes created by a pass are seen by the following passes at the same position, but are not traversed again.
+
+Example:
+    algebra = rewrite(template, [inject_constants(values), drop_offset()])
+"""
+
+import collections
+from itertools import count
+import types
+
+from pyparsing import ParseResults
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.term import Variable
+
+from algebra.rdflib_algebra import (
+    add_graph_to_triple_pattern, add_values_with_placeholders, disable_offset, disable_orderby_limit,
+    inject_constant_into_placeholders, remove_filter_with_placeholders, replace_select_projection_with_graph
+)
+
+QUERY_NODES = ["SelectQuery", "ConstructQuery", "DescribeQuery", "AskQuery"]
+
+class RewritePass:
+    """A visitor and the nodes it applies to.
+
+    Args:
+        visit (Callable): same contract as rdflib's visitPost: returns the new node, or None to keep the node.
+            The visitor may modify the node it receives (it is a private copy), but not its children.
+        applies (Callable, optional): whether the visitor applies to a node. Defaults to every CompValue.
+    """
+    def __init__(self, visit, applies=None):
+        self.visit = visit
+        self.applies = applies or (lambda node: isinstance(node, CompValue))
+
+def copy_node(node: CompValue, **values):
+    """Shallow copy of a CompValue (or Expr), with some values replaced.
+    """
+    new_node = node.__class__.__new__(node.__class__)
+    collections.OrderedDict.__init__(new_node, node)
+    new_node.__dict__.update(node.__dict__)
+    # Expr binds its evaluation function to the node
+    evalfn = node.__dict__.get("_evalfn")
+    if isinstance(evalfn, types.MethodType):
+        new_node._evalfn = types.MethodType(evalfn.__func__, new_node)
+    new_node.update(values)
+    return new_node
+
+def clone(node):
+    """Deep copy of the containers of a tree (CompValue, list, tuple), terms are shared.
+
+    Used before handing a subtree to a visitor that modifies it in place.
+    """
+    if isinstance(node, (list, ParseResults)):
+        return [ clone(child) for child in node ]
+    elif isinstance(node, tuple):
+        return tuple(clone(child) for child in node)
+    elif isinstance(node, CompValue):
+        return copy_node(node, **{ key: clone(value) for key, value in node.items() })
+    return node
+
+def rewrite(algebra, passes):
+    """Apply the passes to a parse tree in one post-order traversal, without modifying it.
+
+    Args:
+        algebra: the parse tree, e.g. as returned by parse_query.
+        passes (list[RewritePass]): the passes, in order.
+
+    Returns:
+        The rewritten tree. Like rdflib's traverse, ParseResults are turned into lists.
+    """
+    def _rewrite(node):
+        if node is None:
+            return None
+
+        owned = False
+        if isinstance(node, ParseResults):
+            node = [ _rewrite(child) for child in node ]
+        elif isinstance(node, list):
+            new_node = [ _rewrite(child) for child in node ]
+            if any(new_child is not child for new_child, child in zip(new_node, node)):
+                node = new_node
+        elif isinstance(node, tuple):
+            new_node = tuple(_rewrite(child) for child in node)
+            if any(new_child is not child for new_child, child in zip(new_node, node)):
+                node = new_node
+        elif isinstance(node, CompValue):
+            changes = {}
+            for key, value in node.items():
+                new_value = _rewrite(value)
+                if new_value is not value:
+                    changes[key] = new_value
+            if len(changes) > 0:
+                node = copy_node(node, **changes)
+                owned = True
+
+        for rewrite_pass in passes:
+            if not rewrite_pass.applies(node):
+                continue
+            if isinstance(node, CompValue) and not owned:
+                node = copy_node(node)
+                owned = True
+            result = rewrite_pass.visit(node)
+            if result is not None and result is not node:
+                # The visitor may have returned nodes of the input
+                node = result
+                owned = False
+        return node
+
+    return _rewrite(algebra)
+
+# Passes
+
+def _has_keys(*keys):
+    return lambda node: isinstance(node, CompValue) and any(key in node for key in keys)
+
+def _has_names(*names):
+    return lambda node: isinstance(node, CompValue) and node.name in names
+
+def inject_constants(values):
+    """Replace the placeholders by their value, see inject_constant_into_placeholders.
+
+    Args:
+        values (dict): variable name -> value.
+    """
+    return RewritePass(
+        lambda node: inject_constant_into_placeholders(node, values),
+        applies=lambda node: isinstance(node, Variable) or (isinstance(node, CompValue) and node.name == "vars")
+    )
+
+def drop_offset():
+    """Remove OFFSET, see disable_offset."""
+    return RewritePass(disable_offset, applies=_has_names("LimitOffsetClauses"))
+
+def drop_orderby_limit():
+    """Remove ORDER BY and LIMIT/OFFSET clauses, see disable_orderby_limit."""
+    return RewritePass(disable_orderby_limit, applies=_has_keys("orderby", "limitoffset"))
+
+def add_graphs(graph_ids=None):
+    """Wrap each triple pattern in a GRAPH clause, see add_graph_to_triple_pattern.
+
+    Args:
+        graph_ids (Iterator[int], optional): counter naming the graph variables. Defaults to a new count().
+    """
+    graph_ids = count() if graph_ids is None else graph_ids
+    return RewritePass(
+        lambda node: add_graph_to_triple_pattern(node, graph_ids),
+        applies=_has_names("TriplesBlock", "GroupGraphPatternSub")
+    )
+
+def filter_graphs(graph_filters):
+    """Add a FILTER next to some of the GRAPH clauses added by add_graphs, in the same group.
+
+    Must come after add_graphs in the list of passes.
+
+    Args:
+        graph_filters (dict): graph variable name (e.g. g0) -> Filter node.
+    """
+    def visit(node):
+        filters = [
+            graph_filters[str(part["term"])] for part in node["part"]
+            if isinstance(part, CompValue) and part.name == "GraphGraphPattern" and str(part["term"]) in graph_filters
+        ]
+        if len(filters) > 0:
+            node["part"] = list(node["part"]) + filters
+        return node
+
+    return RewritePass(visit, applies=_has_names("GroupGraphPatternSub"))
+
+def add_filter(filter_node):
+    """Add a FILTER to the outermost group of the query, where it applies to the solutions of all the branches.
+
+    Args:
+        filter_node (CompValue): the Filter node.
+    """
+    def visit(node):
+        node["where"] = copy_node(node["where"], part=list(node["where"]["part"]) + [filter_node])
+        return node
+
+    return RewritePass(visit, applies=_has_names(*QUERY_NODES))
+
+def project_graphs():
+    """Project the graph variables, see replace_select_projection_with_graph."""
+    return RewritePass(replace_select_projection_with_graph, applies=_has_names(*QUERY_NODES))
+
+def add_values(inline_data):
+    """Add a VALUES clause to the query, see add_values_with_placeholders.
+
+    Args:
+        inline_data (dict): variable name -> list of values.
+    """
+    return RewritePass(
+        lambda node: add_values_with_placeholders(node, inline_data),
+        applies=_has_names("SelectQuery")
+    )
+
+def remove_filters(consts):
+    """Remove the filter expressions on non-constant variables, see remove_filter_with_placeholders.
+
+    Args:
+        consts (dict): the "query", "filter" and optionally "select" constants.
+    """
+    # Sets are computed once instead of at each node
+    consts = { key: set(value) for key, value in consts.items() }
+
+    def visit(node):
+        # Filters are rewritten in place by rdflib's traverse, work on a copy
+        if node.name == "Filter":
+            node = clone(node)
+        return remove_filter_with_placeholders(node, consts)
+
+    def applies(node):
+        return isinstance(node, CompValue) and (
+            node.name in ["SelectQuery", "Filter"] or
+            isinstance(node.get("part"), list) or
+            "orderby" in node or "limitoffset" in node
+        )
+
+    return RewritePass(visit, applies=applies)
@@ -0,0 +1,255 @@
+"""Storage format of the tabular artifacts (value selections, results, provenance).
+
+FEDSHOP_ARTIFACT_FORMAT selects the format, and the extension of the artifacts follows it (see artifact_extension):
+
+- FEDSHOP_ARTIFACT_FORMAT=csv (default): results-batch0.csv, plain CSV, date columns are detected from the header names when reading.
+- FEDSHOP_ARTIFACT_FORMAT=parquet: results-batch0.parquet, Parquet through pyarrow. Dtypes are kept (datetime, numeric),
+  string columns such as IRIs are dictionary-encoded, and files are read with memory mapping.
+  Artifacts written chunk by chunk (TableWriter) have the schema of their first chunk.
+
+Writers follow the extension of the path (.csv or .parquet), FEDSHOP_ARTIFACT_FORMAT only applies to other names.
+Readers detect the format from the content (Parquet magic bytes), so CSV and Parquet artifacts can coexist.
+Existing experiment directories can be converted (and renamed) with `python fedshop/artifacts.py convert <dir> --to parquet`.
+"""
+
+import os
+from pathlib import Path
+import tempfile
+
+import click
+
+from utils import fedshop_logger
+logger = fedshop_logger(Path(__file__).name)
+
+ARTIFACT_FORMATS = ["csv", "parquet"]
+ARTIFACT_EXTENSIONS = { "csv": ".csv", "parquet": ".parquet" }
+ARTIFACT_FORMAT = os.environ.get("FEDSHOP_ARTIFACT_FORMAT", "csv")
+PARQUET_MAGIC = b"PAR1"
+
+@click.group
+def cli():
+    pass
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("The parquet artifact format requires pyarrow, install it with `pip install pyarrow`") from e
+    return pa, pq
+
+def _check_format(fmt):
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(f"Unknown artifact format {fmt}, expected one of {ARTIFACT_FORMATS}")
+    return fmt
+
+def artifact_extension(fmt=None):
+    """Extension of the artifacts, e.g. .parquet.
+
+    Args:
+        fmt (str, optional): the format, overrides FEDSHOP_ARTIFACT_FORMAT. Defaults to None.
+    """
+    return ARTIFACT_EXTENSIONS[_check_format(fmt or ARTIFACT_FORMAT)]
+
+def artifact_path(path, fmt=None):
+    """The path with the extension of the format, e.g. provenance.csv -> provenance.parquet.
+
+    Args:
+        path (str): the artifact path, with or without extension.
+        fmt (str, optional): the format, overrides FEDSHOP_ARTIFACT_FORMAT. Defaults to None.
+    """
+    path = str(path)
+    for extension in ARTIFACT_EXTENSIONS.values():
+        if path.endswith(extension):
+            path = path[:len(path)-len(extension)]
+            break
+    return path + artifact_extension(fmt)
+
+def opt_artifact_path(path):
+    """The path of the original provenance kept by `query.py unwrap`, e.g. provenance.csv -> provenance.opt.csv.
+    """
+    path = Path(path)
+    return str(path.parent / f"{path.stem}.opt{path.suffix}")
+
+def get_format(path, fmt=None):
+    """Format used to write an artifact: the one of its extension, if any.
+
+    Args:
+        path (str): the artifact path.
+        fmt (str, optional): the format of paths without a .csv or .parquet extension, overrides FEDSHOP_ARTIFACT_FORMAT. Defaults to None.
+
+    Returns:
+        str: "csv" or "parquet".
+    """
+    for name, extension in ARTIFACT_EXTENSIONS.items():
+        if str(path).endswith(extension):
+            return name
+    return _check_format(fmt or ARTIFACT_FORMAT)
+
+def detect_format(path):
+    """Format of an existing artifact, from its content.
+
+    Returns:
+        str: "csv" or "parquet".
+    """
+    with open(path, "rb") as fs:
+        return "parquet" if fs.read(len(PARQUET_MAGIC)) == PARQUET_MAGIC else "csv"
+
+def is_empty(path):
+    """Whether an artifact has no content at all (e.g. an engine that produced nothing).
+    """
+    if os.stat(path).st_size == 0:
+        return True
+    if detect_format(path) == "parquet":
+        return False
+    with open(path, "r") as fs:
+        return len(fs.read().strip()) == 0
+
+def _to_arrow(df, schema=None):
+    pa, _ = _import_pyarrow()
+    if schema is not None:
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Dictionary-encode strings: IRIs and literals repeat a lot
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+    return table
+
+def read_table(path, **kwargs):
+    """Read an artifact, whatever its format.
+
+    Args:
+        path (str): the artifact path.
+        kwargs: passed to pd.read_csv for CSV artifacts.
+
+    Returns:
+        pd.DataFrame: the table. Date columns are parsed, dictionary-encoded columns are returned as plain strings
+            and nullable integer columns (e.g. streamed results) as int64, or float64 if values are missing, as from a CSV.
+    """
+    import pandas as pd
+    if detect_format(path) == "parquet":
+        _, pq = _import_pyarrow()
+        table = pq.read_table(path, memory_map=True)
+        df = table.to_pandas()
+        for column in df.columns:
+            dtype = df[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(df[column].cat.categories.dtype)
+            elif isinstance(dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(dtype):
+                df[column] = df[column].astype("float64" if df[column].isna().any() else "int64")
+        return df
+
+    with open(path, "r") as header_fs:
+        header = header_fs.readline().strip().replace('"', '').split(",")
+    return pd.read_csv(path, parse_dates=[h for h in header if "date" in h], low_memory=False, **kwargs)
+
+def write_table(df, path, fmt=None):
+    """Write an artifact.
+
+    Args:
+        df (pd.DataFrame): the table.
+        path (str): the artifact path.
+        fmt (str, optional): the format, overrides FEDSHOP_ARTIFACT_FORMAT. Defaults to None.
+    """
+    if get_format(path, fmt) == "parquet":
+        _, pq = _import_pyarrow()
+        pq.write_table(_to_arrow(df), path)
+    else:
+        df.to_csv(path, index=False)
+
+class TableWriter:
+    """Write an artifact chunk by chunk, e.g. a streamed query result.
+
+    Parquet artifacts take the schema of the first chunk: the next chunks must have the same dtypes, see exec_query_stream.
+    """
+    def __init__(self, path, fmt=None):
+        self.path = path
+        self.fmt = get_format(path, fmt)
+        self._fs = None
+        self._parquet_writer = None
+
+    def write(self, df):
+        if self.fmt == "parquet":
+            _, pq = _import_pyarrow()
+            if self._parquet_writer is None:
+                table = _to_arrow(df)
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            else:
+                # Later chunks follow the schema of the first one
+                try:
+                    table = _to_arrow(df, schema=self._parquet_writer.schema)
+                except (TypeError, ValueError) as e:
+                    raise RuntimeError(f"A chunk of {self.path} does not match the schema of the first chunk, use a larger chunk size or the csv format") from e
+            self._parquet_writer.write_table(table)
+        else:
+            if self._fs is None:
+                self._fs = open(self.path, "w")
+                df.to_csv(self._fs, index=False)
+            else:
+                df.to_csv(self._fs, index=False, header=False)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._fs is not None:
+            self._fs.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@cli.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option("--to", "fmt", type=click.Choice(ARTIFACT_FORMATS), default="parquet")
+@click.option("--pattern", type=click.STRING, default=None, help="Glob of the artifacts to convert, searched recursively. Defaults to the files with the extension of the other format.")
+@click.option("--dry-run", is_flag=True, default=False)
+def convert(directory, fmt, pattern, dry_run):
+    """Convert the artifacts of an experiment directory, e.g. experiments/bsbm/benchmark/generation.
+
+    Each file is written to a temporary file first, then renamed with the extension of the format (see artifact_path).
+    Empty files are only renamed. Run the pipelines with the same FEDSHOP_ARTIFACT_FORMAT afterwards.
+
+    Args:
+        directory (str): the experiment directory.
+        fmt (str): the target format.
+        pattern (str): glob of the artifacts to convert.
+        dry_run (bool): only list the files that would be converted.
+    """
+    if pattern is None:
+        pattern = "*" + next(extension for name, extension in ARTIFACT_EXTENSIONS.items() if name != fmt)
+
+    n_converted = 0
+    for path in sorted(Path(directory).rglob(pattern)):
+        target = artifact_path(path, fmt)
+        if not path.is_file() or (str(path) == target and (is_empty(path) or detect_format(path) == fmt)):
+            continue
+
+        if dry_run:
+            logger.info(f"Would convert {path} to {target}")
+            continue
+
+        if is_empty(path):
+            os.replace(path, target)
+            continue
+
+        df = read_table(path)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp_fs:
+            tmp_path = tmp_fs.name
+        try:
+            write_table(df, tmp_path, fmt=fmt)
+            os.replace(tmp_path, target)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if str(path) != target:
+            os.remove(path)
+        n_converted += 1
+
+    logger.info(f"Converted {n_converted} files to {fmt}")
+
+if __name__ == "__main__":
+    cli()
@@ -5,7 +5,7 @@ import re
 import shutil
 import subprocess
 import click
-from utils import load_config, fedshop_logger
+from utils import container_switch_report, load_config, fedshop_logger
 import requests
 import time
 
@@ -15,6 +15,13 @@ logger = fedshop_logger(Path(__file__).name)
 def cli():
     pass
 
+def log_container_switches(workdir, since=None):
+    report = container_switch_report(f"{workdir}/container-switches.csv", since=since)
+    if report is None:
+        logger.info("No container switch")
+    else:
+        logger.info(f"Container switches:\n{report.to_string(float_format=lambda x: f'{x:.1f}')}")
+
 @cli.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.option("--clean", is_flag=True, default=False)
@@ -184,9 +191,18 @@ def generate(ctx: click.Context, category, configfile, config, debug, clean, cor
         logger.info("Cleaning...")
         ctx.invoke(wipe, configfile=configfile, level=clean)
 
-    for batch in range(1, N_BATCH+1):
-        logger.info(f"Generating instances for batch {batch}/{N_BATCH}...")
-        if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {GENERATION_SNAKEFILE} --batch all={batch}/{N_BATCH}") != 0 : exit(1)
+    start_time = time.time()
+    if category == "queries":
+        # One run per batch, in order: all the jobs of a batch share its Virtuoso container, which is started once
+        batches = sorted(map(int, config_dict.get("batch", range(N_BATCH))))
+        for batch in batches:
+            logger.info(f"Generating instances for batch {batch} ({batches.index(batch)+1}/{len(batches)})...")
+            if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {GENERATION_SNAKEFILE} {WORK_DIR}/benchmark/generation/generate-batch{batch}.txt") != 0 : exit(1)
+    else:
+        for batch in range(1, N_BATCH+1):
+            logger.info(f"Generating instances for batch {batch}/{N_BATCH}...")
+            if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {GENERATION_SNAKEFILE} --batch all={batch}/{N_BATCH}") != 0 : exit(1)
+    log_container_switches(WORK_DIR, since=start_time)
 
 @cli.command()
 @click.argument("experiment-dir", type=click.Path(exists=True, file_okay=False, dir_okay=True))
@@ -317,11 +333,16 @@ def evaluate(ctx: click.Context, configfile, config, debug, clean, cores, rerun_
         elif clean == "metrics":
             os.system(f"rm {WORK_DIR}/benchmark/evaluation/*.csv")
     
-    batch_size = len(config_dict["batch"]) if "batch" in config_dict.keys() else N_BATCH
-    
-    for batch in range(1, batch_size+1):
-        logger.info(f"Producing metrics for batch {batch}/{batch_size}...")
-        if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {EVALUATION_SNAKEFILE} --batch merge_metrics={batch}/{batch_size}") != 0 : exit(1)
+    start_time = time.time()
+    # One run per batch, in order: all the jobs of a batch share its Virtuoso container, which is started once
+    batches = sorted(map(int, config_dict.get("batch", range(N_BATCH))))
+    for batch in batches:
+        logger.info(f"Producing metrics for batch {batch} ({batches.index(batch)+1}/{len(batches)})...")
+        if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {EVALUATION_SNAKEFILE} {BENCH_DIR}/metrics_batch{batch}.csv") != 0 : exit(1)
+
+    logger.info("Merging metrics...")
+    if os.system(f"snakemake {SNAKEMAKE_OPTS} --snakefile {EVALUATION_SNAKEFILE}") != 0 : exit(1)
+    log_container_switches(WORK_DIR, since=start_time)
             
 @cli.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -410,6 +431,15 @@ def wipe(configfile, level: str):
     elif "benchmark" in args:
         remove_benchmark()
 
+@cli.command()
+@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--since", type=click.FLOAT, default=None, help="Only the switches after this timestamp.")
+def container_switches(configfile, since):
+    """Print the number of Virtuoso container switches and the time spent in them, per container.
+    """
+    WORK_DIR = load_config(configfile)["generation"]["workdir"]
+    log_container_switches(WORK_DIR, since=since)
+
 @cli.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 def setup(configfile):
@@ -0,0 +1,187 @@
+"""Compression of the generated N-Quads files (model/dataset).
+
+The dataset is written as plain N-Quads by default. generation.dataset_compression in the config selects:
+
+- none (default): vendor0.nq, ...
+- gzip: vendor0.nq.gz, loaded as is by Virtuoso's bulk loader (ld_dir).
+- zstd: vendor0.nq.zst, smaller and faster to read, through the optional zstandard package. Virtuoso cannot load it,
+  ingest-data decompresses each file next to itself before loading it, then removes the plain copy.
+
+Every reader of the dataset goes through open_nquads, which decompresses the file while it is read,
+so a compressed file is never fully decompressed in memory or on disk.
+Existing datasets can be converted with `python fedshop/compression.py compress experiments/bsbm/model/dataset --to gzip`.
+"""
+
+import glob
+import gzip
+import io
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+
+import click
+
+from utils import fedshop_logger
+logger = fedshop_logger(Path(__file__).name)
+
+COMPRESSIONS = { "none": "", "gzip": ".gz", "zstd": ".zst" }
+BLOCK_SIZE = 1 << 20
+
+@click.group
+def cli():
+    pass
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError("The zstd dataset compression requires zstandard, install it with `pip install zstandard`") from e
+    return zstandard
+
+def dataset_suffix(compression="none"):
+    """Suffix of the data files, e.g. .nq.gz.
+
+    Args:
+        compression (str): none, gzip or zstd.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown dataset compression {compression}, expected one of {list(COMPRESSIONS.keys())}")
+    return f".nq{COMPRESSIONS[compression]}"
+
+def get_compression(path):
+    """Compression of a data file, from its extension.
+
+    Returns:
+        str: none, gzip or zstd.
+    """
+    for compression, extension in COMPRESSIONS.items():
+        if extension != "" and str(path).endswith(extension):
+            return compression
+    return "none"
+
+def strip_compression(path):
+    """The path without its compression extension, e.g. vendor0.nq.gz -> vendor0.nq.
+    """
+    extension = COMPRESSIONS[get_compression(path)]
+    return str(path)[:len(str(path))-len(extension)]
+
+def open_nquads(path, mode="r"):
+    """Open a data file for reading, decompressing it on the fly.
+
+    Args:
+        path (str): the data file, plain or compressed.
+        mode (str, optional): "r" for text, "rb" for bytes.
+
+    Returns:
+        A file object, to be used as a context manager.
+    """
+    binary = "b" in mode
+    compression = get_compression(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb" if binary else "rt", encoding=None if binary else "utf-8")
+    elif compression == "zstd":
+        zstandard = _import_zstandard()
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_size=BLOCK_SIZE, closefd=True)
+        return io.BufferedReader(stream, BLOCK_SIZE) if binary else io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, "rb" if binary else "r")
+
+def open_nquads_writer(path, compression, level=None):
+    """Open a data file for writing, compressing it on the fly.
+
+    Args:
+        path (str): the data file.
+        compression (str): none, gzip or zstd, whatever the extension of path.
+        level (int, optional): the compression level, defaults to 6 for gzip and 3 for zstd.
+
+    Returns:
+        A binary file object, to be used as a context manager.
+    """
+    if compression == "gzip":
+        return gzip.open(path, "wb", compresslevel=level or 6)
+    elif compression == "zstd":
+        zstandard = _import_zstandard()
+        return zstandard.ZstdCompressor(level=level or 3).stream_writer(open(path, "wb"), closefd=True)
+    return open(path, "wb")
+
+def compress_file(path, compression, level=None, remove=True):
+    """Compress (or decompress) a data file, block by block.
+
+    The result is written to a temporary file first, then renamed.
+
+    Args:
+        path (str): the data file, plain or compressed.
+        compression (str): the target compression, none, gzip or zstd.
+        level (int, optional): the compression level, defaults to 6 for gzip and 3 for zstd.
+        remove (bool, optional): whether to remove the source file.
+
+    Returns:
+        str: the path of the new file.
+    """
+    target = strip_compression(path) + COMPRESSIONS[compression]
+    if target == str(path):
+        return target
+
+    with tempfile.NamedTemporaryFile(dir=Path(target).parent, prefix=f".{Path(target).name}", delete=False) as tmp_fs:
+        tmp_path = tmp_fs.name
+    try:
+        with open_nquads(path, "rb") as source_fs, open_nquads_writer(tmp_path, compression, level=level) as target_fs:
+            shutil.copyfileobj(source_fs, target_fs, BLOCK_SIZE)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if remove:
+        os.remove(path)
+    return target
+
+def concatenate_nquads(datafiles, outfile):
+    """Write the content of several data files, decompressed, into one plain N-Quads file.
+    """
+    with open(outfile, "wb") as out_fs:
+        for datafile in datafiles:
+            with open_nquads(datafile, "rb") as nq_fs:
+                shutil.copyfileobj(nq_fs, out_fs, BLOCK_SIZE)
+
+def list_datafiles(datadir, pattern="*.nq*"):
+    """The data files of a directory, whatever their compression, sorted.
+    """
+    suffixes = tuple(dataset_suffix(compression) for compression in COMPRESSIONS.keys())
+    return sorted(f for f in glob.glob(os.path.join(datadir, pattern)) if f.endswith(suffixes))
+
+@cli.command()
+@click.argument("datadir", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option("--to", "compression", type=click.Choice(list(COMPRESSIONS.keys())), default="gzip")
+@click.option("--level", type=click.INT, default=None, help="Compression level, defaults to 6 for gzip and 3 for zstd.")
+@click.option("--pattern", type=click.STRING, default="*.nq*", help="Glob of the data files in datadir.")
+def compress(datadir, compression, level, pattern):
+    """Convert the data files of a directory in place, e.g. experiments/bsbm/model/dataset.
+
+    Set generation.dataset_compression accordingly, so that snakemake finds the converted files.
+
+    Args:
+        datadir (str): the directory of the N-Quads files.
+        compression (str): the target compression.
+        level (int): the compression level.
+        pattern (str): glob of the data files.
+    """
+    before, after = 0, 0
+    for path in list_datafiles(datadir, pattern):
+        before += os.stat(path).st_size
+        target = compress_file(path, compression, level=level)
+        after += os.stat(target).st_size
+        logger.debug(f"{path} -> {target}")
+    logger.info(f"Converted {datadir} to {compression}: {before/1024/1024:.1f} MB -> {after/1024/1024:.1f} MB")
+
+@cli.command()
+@click.argument("datafile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def cat(datafile):
+    """Write a data file to the standard output, decompressed.
+    """
+    with open_nquads(datafile, "rb") as source_fs:
+        shutil.copyfileobj(source_fs, sys.stdout.buffer, BLOCK_SIZE)
+
+if __name__ == "__main__":
+    cli()
@@ -12,10 +12,10 @@ from pathlib import Path
 
 
 import sys
-import requests
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import create_stats, kill_process, load_config, fedshop_logger, str2n3
+from sparql_client import SPARQL_CLIENT
 logger = fedshop_logger(Path(__file__).name)
 
 
@@ -78,7 +78,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
     
     # Run engine for one query
@@ -91,7 +91,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
         # Write stats
         if stats != "/dev/null":            
             # Write proxy stats
-            proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+            proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
             
             with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
                 http_req = proxy_stats["NB_HTTP_REQ"]
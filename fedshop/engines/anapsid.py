@@ -11,7 +11,6 @@ import subprocess
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import requests
 
 from sklearn.calibration import LabelEncoder
 
@@ -19,6 +18,7 @@ import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import kill_process, load_config, fedshop_logger, create_stats, str2n3
+from sparql_client import SPARQL_CLIENT
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -112,7 +112,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
 
     python2_bin = shutil.which("python2").replace("shims", "versions/2.7.18/bin")
@@ -180,7 +180,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
         
     if stats != "/dev/null":            
         # Write proxy stats
-        proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+        proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
         
         with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
             http_req = proxy_stats["NB_HTTP_REQ"]
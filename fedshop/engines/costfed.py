@@ -10,7 +10,6 @@ import subprocess
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import requests
 from sklearn.preprocessing import LabelEncoder
 import psutil
 
@@ -18,6 +17,7 @@ import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import load_config, fedshop_logger, str2n3, create_stats
+from sparql_client import SPARQL_CLIENT
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -92,7 +92,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     endpoints_file = f"summaries/endpoints_batch{batch_id}.txt"
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
 
     oldcwd = os.getcwd()
@@ -137,7 +137,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     # Write proxy stats
     if stats != "/dev/null":            
         # Write proxy stats
-        proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+        proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
         
         with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
             http_req = proxy_stats["NB_HTTP_REQ"]
@@ -8,13 +8,13 @@ import subprocess
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import requests
 from sklearn.preprocessing import LabelEncoder
 
 import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import load_config, fedshop_logger, str2n3, create_stats
+from sparql_client import SPARQL_CLIENT
 logger = fedshop_logger(Path(__file__).name)
 
 @click.group
@@ -53,7 +53,7 @@ def exec_fedx(eval_config, query, out_result, out_source_selection, query_plan,
     proxy_port = config["evaluation"]["proxy"]["port"]
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
 
     args = [engine_config, query, out_result, out_source_selection, query_plan, str(timeout+10), str(noexec).lower()]
@@ -86,7 +86,7 @@ def exec_fedx(eval_config, query, out_result, out_source_selection, query_plan,
     # Write stats
     if stats != "/dev/null":            
         # Write proxy stats
-        proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+        proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
         
         with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
             http_req = proxy_stats["NB_HTTP_REQ"]
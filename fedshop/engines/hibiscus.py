@@ -13,10 +13,11 @@ import numpy as np
 from pathlib import Path
 
 import sys
-import requests
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
+from compression import concatenate_nquads, open_nquads
 from utils import create_stats, kill_process, load_config, fedshop_logger, str2n3
+from sparql_client import SPARQL_CLIENT
 logger = fedshop_logger(Path(__file__).name)
 
 import fedx
@@ -110,7 +111,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     olddir = Path(os.getcwd()).absolute()
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
     
     # Get env-specific executable for python
@@ -248,7 +249,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
         os.chdir(olddir)
         if stats != "/dev/null":            
             # Write proxy stats
-            proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+            proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
             
             with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
                 http_req = proxy_stats["NB_HTTP_REQ"]
@@ -321,7 +322,7 @@ def generate_config_file(ctx: click.Context, datafiles, outfile, eval_config, ba
     # Update the endpoints.txt
     sources = set()
     for datafile in datafiles:
-        with open(f"../../{datafile}", "r") as file:
+        with open_nquads(f"../../{datafile}") as file:
             line = file.readline()
             source = line.rsplit()[-2]
             source = source[1:-1]
@@ -341,8 +342,8 @@ def generate_config_file(ctx: click.Context, datafiles, outfile, eval_config, ba
     # Generate data if not exists
     if not os.path.exists(batch_file):
         Path(batch_file).parent.mkdir(parents=True, exist_ok=True)
-        if os.system(f"cat {' '.join(datafiles)} > {batch_file}") != 0:
-            raise RuntimeError("Could not generate batch file for HiBISCuS")
+        # The data files may be compressed
+        concatenate_nquads(datafiles, batch_file)
     
     # Generate summary files if not exists
     if not os.path.exists(summary_file):    
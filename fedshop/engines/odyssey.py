@@ -15,6 +15,7 @@ import sys
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 #sys.set_int_max_str_digits(0)
 
+from compression import open_nquads
 from utils import kill_process, load_config, str2n3
 # Example of use : 
 # python3 utils/generate-fedx-config-file.py experiments/bsbm/model/vendor test/out.ttl
@@ -182,9 +183,8 @@ def generate_config_file(ctx: click.Context, datafiles, outfile, eval_config, ba
     ssite = set()
     #for data_file in glob.glob(f'{dir_data_file}/*.nq'):
     for data_file in datafiles:
-        with open(data_file) as file:
-            t_file = file.readlines()
-            for line in t_file:
+        with open_nquads(data_file) as file:
+            for line in file:
                 site = line.rsplit()[-2]
                 site = re.search(r"<(.*)>", site).group(1)
                 ssite.add(site)
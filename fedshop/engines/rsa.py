@@ -14,12 +14,13 @@ from pathlib import Path
 import sys
 
 from rdflib import URIRef
-import requests
 from tqdm import tqdm
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from algebra.rdflib_algebra import add_service_to_triple_blocks, add_values_with_placeholders
 from utils import load_config, fedshop_logger, create_stats
+from artifacts import artifact_extension, opt_artifact_path, read_table
+from sparql_client import SPARQL_CLIENT
 from query import export_query, exec_query_on_endpoint, parse_query_proc
 from rdflib.plugins.sparql.algebra import traverse
 
@@ -70,7 +71,7 @@ def warmup(ctx: click.Context, eval_config, engine_config, repeat, batch_id):
     
     def ping(url):
         try:
-            return requests.get(endpoint, params={"query": "ASK {?s ?p ?o}"}).status_code
+            return SPARQL_CLIENT.get(endpoint, retry=False, params={"query": "ASK {?s ?p ?o}"}).status_code
         except:
             return -1
 
@@ -94,7 +95,7 @@ def warmup(ctx: click.Context, eval_config, engine_config, repeat, batch_id):
     random.shuffle(queries)
     for query in tqdm(queries):
         for batch_id in range(config["generation"]["n_batch"]):
-            force_source_selection = f"{Path(query).parent}/batch_{batch_id}/provenance.csv"
+            force_source_selection = f"{Path(query).parent}/batch_{batch_id}/provenance{artifact_extension()}"
             for _ in range(repeat):
                 success = False
                 while not success:
@@ -123,8 +124,7 @@ def create_service_query_manually(ctx: click.Context, eval_config, query, query_
     Returns:
         _type_: _description_
     """
-    opt_source_selection_file = f"{Path(force_source_selection).parent}/{Path(force_source_selection).stem}.opt.csv"
-    source_selection_df = pd.read_csv(opt_source_selection_file)
+    source_selection_df = read_table(opt_artifact_path(force_source_selection))
     
     eval_config = load_config(eval_config)
     proxy_mapping_file = eval_config["generation"]["virtuoso"]["proxy_mapping"]
@@ -235,7 +235,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     timeout = config["evaluation"]["timeout"]
     exec_time = None
     
-    force_source_selection_df = pd.read_csv(force_source_selection).dropna(axis=1, how="all")
+    force_source_selection_df = read_table(force_source_selection).dropna(axis=1, how="all")
     response, result = None, None
     
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
@@ -243,7 +243,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     proxy_sparql_endpoint = proxy_server + "sparql"
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
     
     startTime = time.time()
@@ -258,7 +258,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     #         response, result = exec_query_on_endpoint(query_text, proxy_sparql_endpoint, error_when_timeout=True, timeout=timeout, default_graph=default_graph)
     # else:
     out_query_text = ctx.invoke(create_service_query, eval_config=eval_config, query=query, query_plan=query_plan, force_source_selection=force_source_selection)
-    response, result = exec_query_on_endpoint(out_query_text, endpoint, error_when_timeout=True, timeout=timeout)
+    response, result = exec_query_on_endpoint(out_query_text, endpoint, error_when_timeout=True, timeout=timeout, retry=False)
         
     endTime = time.time()
     exec_time = (endTime - startTime)*1e3
@@ -280,7 +280,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
             exec_time_fs.write(str(exec_time))
         
         # Write proxy stats
-        proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+        proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
         
         with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
             http_req = proxy_stats["NB_HTTP_REQ"]
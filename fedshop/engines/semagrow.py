@@ -11,7 +11,6 @@ import subprocess
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import requests
 from sklearn.preprocessing import LabelEncoder
 from rdflib import ConjunctiveGraph
 
@@ -20,6 +19,7 @@ sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from query import execute_query
 from utils import load_config, fedshop_logger, str2n3, create_stats, create_stats
+from sparql_client import SPARQL_CLIENT
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -106,7 +106,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     proxy_server = config["evaluation"]["proxy"]["endpoint"]
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
     
     #cmd = f"./semagrow.sh "
@@ -169,7 +169,7 @@ def run_benchmark(ctx: click.Context, eval_config, query, out_result, out_source
     # Write stats
     if stats != "/dev/null":            
         # Write proxy stats
-        proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+        proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
 
         stats_home = Path(stats).parent
         Path(stats_home).mkdir(parents=True, exist_ok=True)
@@ -13,12 +13,12 @@ import csv
 from itertools import zip_longest
 
 import sys
-import requests
 
 from sklearn.calibration import LabelEncoder
 sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
 
 from utils import check_container_status, kill_process, load_config, fedshop_logger, create_stats
+from sparql_client import SPARQL_CLIENT
 import fedx
 
 logger = fedshop_logger(Path(__file__).name)
@@ -87,7 +87,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
     proxy_sparql_endpoint = proxy_server + "sparql"
     
     # Reset the proxy stats
-    if requests.get(proxy_server + "reset").status_code != 200:
+    if SPARQL_CLIENT.get(proxy_server + "reset").status_code != 200:
         raise RuntimeError("Could not reset statistics on proxy!")
 
     lines = []
@@ -156,7 +156,7 @@ def run_benchmark(ctx: click.Context, eval_config, engine_config, query, out_res
         
         if stats != "/dev/null":            
             # Write proxy stats
-            proxy_stats = json.loads(requests.get(proxy_server + "get-stats").text)
+            proxy_stats = json.loads(SPARQL_CLIENT.get(proxy_server + "get-stats").text)
             
             with open(f"{Path(stats).parent}/http_req.txt", "w") as http_req_fs:
                 http_req = proxy_stats["NB_HTTP_REQ"]
@@ -1,9 +1,16 @@
+import errno
 import os
 from pathlib import Path
 import re
+import shutil
+import stat
+import threading
+import time
 import click
 import subprocess
+from compression import BLOCK_SIZE, compress_file, get_compression, open_nquads_writer, strip_compression
 from utils import load_config, kill_process, fedshop_logger
+from virtuoso import IsqlSession, exec_statements
 import psutil
 
 logger = fedshop_logger(Path(__file__).name)
@@ -12,42 +19,285 @@ logger = fedshop_logger(Path(__file__).name)
 def cli():
     pass
 
-@cli.command
-@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
-@click.argument("section", type=click.STRING)
-@click.argument("output", type=click.Path(file_okay=True, dir_okay=True))
-@click.option("--id", type=click.INT, default=0)
-def generate(configfile, section, output, id):
-
-    output_base = f"{Path(output).parent}/{section}{id}"
-
-    config = load_config(configfile, saveAs=f"{output_base}.yaml")["generation"]
-    schema_config = config["schema"]
+def write_model(schema_config, section, id, model_file, export_output_dir=None, params=None):
+    """Write the WatDiv model of a section, from its template.
 
+    Args:
+        schema_config (dict): the generation.schema config.
+        section (str): product, vendor or ratingsite.
+        id (int): the id of the vendor or rating site.
+        model_file (str): the model file.
+        export_output_dir (str, optional): overrides the export_output_dir of the section.
+        params (dict, optional): overrides some of the params of the section.
+    """
     template_fs = open(schema_config[section]["template"], "r")
     template = template_fs.read()
     template_fs.close()
     
     # Replace all params in template
-    params: dict = schema_config[section]["params"]
-    if params is not None:
-        for param, value in params.items():
-            #if param == f"{section}_n": continue
-            template = re.sub(re.escape(f"{{%{param}}}"), str(value), template)
+    section_params = dict(schema_config[section]["params"] or {})
+    section_params.update(params or {})
+    for param, value in section_params.items():
+        #if param == f"{section}_n": continue
+        template = re.sub(re.escape(f"{{%{param}}}"), str(value), template)
 
-    model_file = f"{output_base}.txt.tmp"
     Path(model_file).parent.mkdir(parents=True, exist_ok=True)
     with open(model_file, "w") as outWriter:
         out = re.sub(re.escape("{%provenance}"), schema_config[section]["provenance"], template)
         out = re.sub(re.escape(f"{{%{section}_id}}"), f"{section}{id}", out)
-        out = re.sub(re.escape("{%export_output_dir}"), schema_config[section]["export_output_dir"], out)
+        out = re.sub(re.escape("{%export_output_dir}"), export_output_dir or schema_config[section]["export_output_dir"], out)
         if schema_config[section].get("export_dep_output_dir") is not None:
             out = re.sub(re.escape("{%export_dep_output_dir}"), schema_config[section]["export_dep_output_dir"], out)
         outWriter.write(out)
 
+def shard_ranges(n_items, shards):
+    """Split n_items ids into contiguous ranges of (almost) equal size.
+
+    Returns:
+        list[tuple]: (offset, size) of each shard, the first ones are one item larger if n_items is not a multiple of shards.
+    """
+    sizes = [ n_items // shards + (1 if i < n_items % shards else 0) for i in range(shards) ]
+    offsets = [ sum(sizes[:i]) for i in range(shards) ]
+    return [ (offset, size) for offset, size in zip(offsets, sizes) if size > 0 ]
+
+def shard_seed(seed, shard_id):
+    """Seed of a shard, derived from the configured seed so that each shard draws different values, reproducibly."""
+    return (int(seed) * 1000003 + shard_id) % (2**31 - 1)
+
+# A product entity (not ProductFeature, ProductType) in a file path, and as the end of an IRI
+PRODUCT_PATH_PATTERN = re.compile(r"(?<![A-Za-z])Product(\d+)(?!\d)")
+PRODUCT_IRI_PATTERN = re.compile(rb"(?<=/)Product(\d+)(?=>)")
+
+def merge_product_shard(shard_dir, output_dir, offset):
+    """Merge the output of a product shard into the output of the first shard.
+
+    The products of the shard are numbered from 0 (or 1), like those of the first shard: their ids are shifted by offset,
+    in the file paths and in the IRIs. The producers, features and types are the same entities in every shard, the
+    copies of the first shard are kept. Lines of the other files that mention a product are appended to the same file
+    of the first shard.
+
+    Args:
+        shard_dir (str): the export_output_dir of the shard.
+        output_dir (str): the export_output_dir of the first shard.
+        offset (int): the id of the first product of the shard.
+    """
+    shift_path = lambda match: f"Product{int(match.group(1)) + offset}"
+    shift_iri = lambda match: b"Product%d" % (int(match.group(1)) + offset)
+
+    for shard_file in sorted(Path(shard_dir).rglob("*")):
+        if not shard_file.is_file():
+            continue
+        relative_path = str(shard_file.relative_to(shard_dir))
+        target = Path(output_dir) / PRODUCT_PATH_PATTERN.sub(shift_path, relative_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(shard_file, "rb") as shard_fs:
+            if PRODUCT_PATH_PATTERN.search(relative_path) is not None:
+                # A file of its own product: nothing to share with the other shards
+                with open(target, "wb") as target_fs:
+                    for line in shard_fs:
+                        target_fs.write(PRODUCT_IRI_PATTERN.sub(shift_iri, line))
+            else:
+                with open(target, "ab") as target_fs:
+                    for line in shard_fs:
+                        if PRODUCT_IRI_PATTERN.search(line) is not None:
+                            target_fs.write(PRODUCT_IRI_PATTERN.sub(shift_iri, line))
+
+def generate_product_shards(config, output, output_base, shards):
+    """Generate the products with several WatDiv processes, each one generating a contiguous range of product ids.
+
+    Every shard is given the full number of producers, features and types (they are computed from product_n
+    in the config), and a share of product_n. The shards are generated in parallel in <output>.shards/shard<i>,
+    then merged into output with merge_product_shard, so the vendors and rating sites find the layout of a single run.
+
+    The shards must draw different values: generator.seed_option (the command-line option of the WatDiv build taking
+    a seed) is required, shard i is given shard_seed(generator.seed, i), so that two runs with the same config produce
+    the same products.
+
+    Args:
+        config (dict): the generation config.
+        output (str): the export_output_dir of the products.
+        output_base (str): the prefix of the model files.
+        shards (int): the number of shards.
+
+    Raises:
+        ValueError: generator.seed_option is not set, the shards could generate the same products.
+    """
+    schema_config = config["schema"]
+    generator_config = config["generator"]
+    if generator_config.get("seed_option") is None:
+        raise ValueError(f"{shards} product shards require generator.seed_option, so that each shard is given its own seed")
+    scale_factor = int(schema_config["product"]["scale_factor"])
+    ranges = shard_ranges(int(schema_config["product"]["params"]["product_n"]), shards)
+    shards_dir = f"{output}.shards"
+    shutil.rmtree(shards_dir, ignore_errors=True)
+
+    start = time.perf_counter()
+    procs = []
+    for shard_id, (offset, size) in enumerate(ranges):
+        shard_dir = f"{shards_dir}/shard{shard_id}"
+        model_file = f"{output_base}-shard{shard_id}.txt.tmp"
+        write_model(schema_config, "product", 0, model_file, export_output_dir=shard_dir, params={"product_n": size})
+        cmd = f"{generator_config['exec']} -d {model_file} {scale_factor} {generator_config['seed_option']} {shard_seed(generator_config.get('seed', 0), shard_id)}"
+        logger.debug(f"Shard {shard_id}: products {offset} to {offset + size - 1}: {cmd}")
+        procs.append(subprocess.Popen(cmd, shell=True))
+
+    failed = [ shard_id for shard_id, proc in enumerate(procs) if proc.wait() != 0 ]
+    if len(failed) > 0:
+        raise RuntimeError(f"WatDiv failed for the product shards {failed}")
+    generated = time.perf_counter()
+
+    # The first shard is the base of the merge
+    shutil.rmtree(output, ignore_errors=True)
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    os.replace(f"{shards_dir}/shard0", output)
+    for shard_id, (offset, _) in enumerate(ranges[1:], start=1):
+        merge_product_shard(f"{shards_dir}/shard{shard_id}", output, offset)
+    shutil.rmtree(shards_dir)
+
+    logger.info(f"Generated {len(ranges)} product shards in {generated - start:.1f}s, merged in {time.perf_counter() - generated:.1f}s")
+
+def open_fifo_writer(path, is_reader_alive):
+    """Open a FIFO for writing, waiting for its reader as long as it is alive.
+
+    Returns:
+        int: the file descriptor, in blocking mode.
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO: the reader has not opened the FIFO yet
+            if e.errno != errno.ENXIO or not is_reader_alive():
+                raise
+            time.sleep(0.1)
+            continue
+        os.set_blocking(fd, True)
+        return fd
+
+def stream_to_virtuoso(cmd, output, container_name, isql, datapath, graph):
+    """Run WatDiv and load its output into Virtuoso while it is generated.
+
+    WatDiv writes into a FIFO in place of its output file. The data read from it is written to the (compressed)
+    output file, and to a second FIFO in the data directory, read by DB.DBA.TTLP_MT in its own isql session.
+    Once loaded, the output file is registered in DB.DBA.load_list as loaded, so that ingest-data does not load it again.
+
+    Args:
+        cmd (str): the WatDiv command.
+        output (str): the data file, e.g. experiments/bsbm/model/dataset/vendor0.nq.gz.
+        container_name (str): the Virtuoso container, None to run isql locally.
+        isql (str): the path to the isql executable.
+        datapath (str): the directory of output, as seen by Virtuoso. Must be the --datapath of ingest-data.
+        graph (str): the default graph given to the loader.
+    """
+    output = Path(output)
+    watdiv_fifo = strip_compression(output)
+    loader_fifo = f"{output.parent}/.{output.name}.fifo"
+    archive_file = f"{output.parent}/.{output.name}.tmp"
+    for fifo in [watdiv_fifo, loader_fifo]:
+        if os.path.lexists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+    loader_errors = []
+    def load():
+        try:
+            session = IsqlSession(container_name, isql)
+            session.execute([
+                "log_enable(2, 1)",
+                f"DB.DBA.TTLP_MT(file_open('{datapath.rstrip('/')}/{Path(loader_fifo).name}'), '', '{graph}', 255 + 512)"
+            ])
+            session.close()
+        except Exception as e:
+            loader_errors.append(e)
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+
+    watdiv_proc = subprocess.Popen(cmd, shell=True)
+    def unblock_reader():
+        # If WatDiv fails before opening its output, opening the FIFO here ends the read below
+        watdiv_proc.wait()
+        try:
+            os.close(os.open(watdiv_fifo, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+    threading.Thread(target=unblock_reader, daemon=True).start()
+
+    start = time.perf_counter()
+    n_bytes = 0
+    try:
+        with open(watdiv_fifo, "rb") as watdiv_fs, \
+            os.fdopen(open_fifo_writer(loader_fifo, loader.is_alive), "wb") as loader_fs, \
+            open_nquads_writer(archive_file, get_compression(output)) as archive_fs:
+            for block in iter(lambda: watdiv_fs.read(BLOCK_SIZE), b""):
+                archive_fs.write(block)
+                loader_fs.write(block)
+                n_bytes += len(block)
+        watdiv_proc.wait()
+        loader.join()
+
+        if watdiv_proc.returncode != 0:
+            raise RuntimeError(f"{cmd} exited with code {watdiv_proc.returncode}")
+        if not stat.S_ISFIFO(os.lstat(watdiv_fifo).st_mode):
+            raise RuntimeError(f"WatDiv replaced the FIFO {watdiv_fifo} by a file, generate the data without --ingest")
+        if len(loader_errors) > 0:
+            raise RuntimeError(f"Could not load {output} into Virtuoso") from loader_errors[0]
+        os.replace(archive_file, output)
+    except OSError:
+        # The loader stopped reading (or never started), its error tells why
+        loader.join(timeout=60)
+        if len(loader_errors) > 0:
+            raise RuntimeError(f"Could not load {output} into Virtuoso") from loader_errors[0]
+        raise
+    finally:
+        if watdiv_proc.poll() is None:
+            watdiv_proc.kill()
+        for fifo in [watdiv_fifo, loader_fifo]:
+            if os.path.lexists(fifo) and stat.S_ISFIFO(os.lstat(fifo).st_mode):
+                os.remove(fifo)
+        if os.path.exists(archive_file):
+            os.remove(archive_file)
+
+    # The name ingest-data gives to ld_dir: zstd files are loaded from their plain copy
+    ingested_name = Path(strip_compression(output)).name if get_compression(output) == "zstd" else output.name
+    exec_statements(container_name, isql, [
+        "INSERT SOFT DB.DBA.load_list (ll_file, ll_graph, ll_state, ll_started, ll_done) "
+        f"VALUES ('{datapath}/{ingested_name}', '{graph}', 2, now(), now())"
+    ])
+    logger.info(f"Generated and loaded {output} ({n_bytes/1024/1024:.1f} MB) in {time.perf_counter() - start:.1f}s")
+
+@cli.command
+@click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("section", type=click.STRING)
+@click.argument("output", type=click.Path(file_okay=True, dir_okay=True))
+@click.option("--id", type=click.INT, default=0)
+@click.option("--ingest", is_flag=True, default=False, help="Load the data into Virtuoso while it is generated, see stream_to_virtuoso.")
+@click.option("--container-name", type=click.STRING, default=None)
+@click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
+@click.option("--datapath", type=click.STRING, default="/usr/share/proj/", help="The directory of the output, as seen by Virtuoso.")
+@click.option("--graph", type=click.STRING, default="http://example.com/datasets/default")
+@click.option("--shards", type=click.INT, default=1, help="Number of WatDiv processes generating the products, see generate_product_shards.")
+def generate(configfile, section, output, id, ingest, container_name, isql, datapath, graph, shards):
+
+    output_base = f"{Path(output).parent}/{section}{id}"
+
+    config = load_config(configfile, saveAs=f"{output_base}.yaml")["generation"]
+    schema_config = config["schema"]
+
+    if section == "product" and shards > 1:
+        generate_product_shards(config, output, output_base, shards)
+        return
+
+    model_file = f"{output_base}.txt.tmp"
+    write_model(schema_config, section, id, model_file)
+
     scale_factor = int(schema_config[section]["scale_factor"])
 
     cmd = f"{config['generator']['exec']} -d {model_file} {scale_factor}"
+
+    if ingest:
+        stream_to_virtuoso(cmd, output, container_name, isql, datapath, graph)
+        return
     
     # This consumes memory since it waits till the end and store the output in PIPE
     watdiv_proc = subprocess.run(cmd, capture_output=False, shell=True)
@@ -64,6 +314,11 @@ def generate(configfile, section, output, id):
     if watdiv_proc.returncode != 0:
         raise RuntimeError(watdiv_proc.stderr.read().decode())  
 
+    # WatDiv writes plain N-Quads, compress them if the output is e.g. vendor0.nq.gz
+    compression = get_compression(output)
+    if compression != "none":
+        compress_file(strip_compression(output), compression)
+
     # try: kill_process(watdiv_proc.pid)  
     # except:
     #     logger.exception(f"watdiv proc (PID: {watdiv_proc.pid}) is already killed, skipping...")
@@ -6,6 +6,8 @@ import click
 import pandas as pd
 import numpy as np
 from utils import load_config, fedshop_logger
+from artifacts import is_empty, read_table
+from source_index import SourceIndex, query_triples
 from tqdm import tqdm
 
 logger = fedshop_logger(Path(__file__).name)
@@ -21,11 +23,62 @@ def cli():
 # def __get_query_structures(configfile, queryfile):
 #     pass
 
+def source_name(source):
+    """Common name of a source, engines report www.vendor0.fr and the provenance queries http://www.vendor0.fr/.
+    """
+    return re.sub(r"^\w+://|/$", "", str(source))
+
+def get_oracle_metrics(source_index: SourceIndex, queryfile, batch_id, df: pd.DataFrame, cache: dict):
+    """Compare a source selection with the ground truth of the source index (see source_index.py).
+
+    - oracle_tpwss: number of relevant sources of all triple patterns.
+    - oracle_join_tpwss: same, once the sources are restricted by the joins (single BGP queries only).
+    - missing_sources: sources restricted by the joins and not selected, results may be missing.
+    - useless_sources: selected sources that are not relevant.
+
+    Args:
+        source_index (SourceIndex): the index.
+        queryfile (str): the instantiated query.
+        batch_id (int): the batch.
+        df (pd.DataFrame): the source selection, one column per triple pattern (tp<i> or g<i>).
+        cache (dict): ground truth already computed, by (queryfile, batch_id).
+
+    Returns:
+        dict: the metrics, empty if the columns do not match the triple patterns of the query.
+    """
+    key = (queryfile, batch_id)
+    if key not in cache:
+        triples, is_bgp = query_triples(queryfile)
+        sources = source_index.batch_sources(batch_id)
+        relevant = source_index.relevant_sources(triples, sources)
+        restricted = source_index.join_restricted_sources(triples, sources) if is_bgp else relevant
+        cache[key] = (
+            [ set(source_name(source_index.graphs[g]) for g in graph_ids) for graph_ids in relevant ],
+            [ set(source_name(source_index.graphs[g]) for g in graph_ids) for graph_ids in restricted ]
+        )
+    relevant, restricted = cache[key]
+
+    selected = [ set() for _ in relevant ]
+    for column in df.columns:
+        tp_search = re.search(r"^(tp|g)(\d+)$", str(column))
+        if tp_search is None or int(tp_search.group(2)) >= len(selected):
+            logger.warning(f"Column {column} does not match the triple patterns of {queryfile}")
+            return {}
+        selected[int(tp_search.group(2))].update(df[column].dropna().map(source_name))
+
+    return {
+        "oracle_tpwss": sum(len(r) for r in relevant),
+        "oracle_join_tpwss": sum(len(r) for r in restricted),
+        "missing_sources": sum(len(r - s) for r, s in zip(restricted, selected)),
+        "useless_sources": sum(len(s - r) for r, s in zip(relevant, selected))
+    }
+
 @cli.command()
 @click.argument("configfile", type=click.Path(exists=True, dir_okay=False, file_okay=True))
 @click.argument("outfile", type=click.Path(exists=False, dir_okay=False, file_okay=True))
 @click.argument("workload", type=click.Path(exists=True, dir_okay=False, file_okay=True), nargs=-1)
-def compute_metrics(configfile, outfile, workload):
+@click.option("--source-index", type=click.Path(exists=True, dir_okay=False, file_okay=True), default=None, help="Index built by source_index.py, adds the comparison with the ground truth.")
+def compute_metrics(configfile, outfile, workload, source_index):
     """Compute the metrics to evaluate source selection engines.
 
     TODO:
@@ -35,6 +88,7 @@ def compute_metrics(configfile, outfile, workload):
 
     Args:
         workload (_type_): List of all results obtained by executing provenance queries.
+        source_index (_type_): the source index, see get_oracle_metrics.
     """
     
     def get_rwss(df: pd.DataFrame, agg, is_evaluation_mode):
@@ -104,69 +158,74 @@ def compute_metrics(configfile, outfile, workload):
     vendor_edges = vendor_edges[1:].astype(int) + 1
     ratingsite_edges = ratingsite_edges[1:].astype(int) + 1
 
+    oracle = SourceIndex.load(source_index) if source_index is not None else None
+    oracle_cache = dict()
+
     records = []        
     for provenance_file in tqdm(workload):
-        with open(provenance_file, "r") as ss_fs:
-            name_search = re.search(r".*/(\w+)/(q\w+)/instance_(\d+)/batch_(\d+)/((attempt_(\d+)|test)/)?provenance.csv", provenance_file)
-            engine = name_search.group(1)
-            query = name_search.group(2)
-            instance = int(name_search.group(3))
-            batch = int(name_search.group(4))
-            attempt = name_search.group(7)
-            total_nb_sources = vendor_edges[batch] + ratingsite_edges[batch]
-            results_file = f"{Path(provenance_file).parent}/results.csv"
-            
-            is_evaluation_mode = ( (engine in CONFIG["evaluation"]["engines"]) and (attempt is not None) )       
-            
-            record = dict()
-            
-            if is_evaluation_mode:
-                record.update({
-                    "attempt": int(attempt),
-                    "engine": engine
-                })
-            
-            if len(ss_fs.read().strip()) == 0:
-                logger.debug(f"{provenance_file} is empty!")
-                record.update({
-                    "query": query,
-                    "instance": instance,
-                    "batch": batch,
-                    "nb_results": np.nan,
-                    "nb_distinct_sources": np.nan,
-                    "relevant_sources_selectivity": np.nan,
-                    "tpwss": np.nan,
-                    "avg_rwss": np.nan,
-                    "min_rwss": np.nan,
-                    "max_rwss": np.nan
-                    #"tp_specific_relevant_sources_selectivity": get_tp_specific_relevant_sources(source_selection_result),
-                    #"bgp_restricted_source_level_tp_selectivity": get_bgp_restricted_source_level_tp_selectivity(source_selection_result),
-                    #"xfed_join_restricted_source_level_tp_selectivity": get_xfed_join_restricted_source_level_tp_selectivity(source_selection_result)
-                })
-            else:
-                nb_results = np.nan
-                source_selection_result = pd.read_csv(provenance_file)
-                with open(results_file, "r") as rfs:
-                    if len(rfs.read().strip()) > 0:
-                        nb_results = len(pd.read_csv(results_file))
-                        
-                record.update({
-                    "query": query,
-                    "instance": instance,
-                    "batch": batch,
-                    "nb_results": nb_results,
-                    "nb_distinct_sources": get_distinct_sources(source_selection_result),
-                    "relevant_sources_selectivity": get_relevant_sources_selectivity(source_selection_result, total_nb_sources),
-                    "tpwss": get_tpwss(source_selection_result),
-                    "avg_rwss": get_rwss(source_selection_result, "mean", is_evaluation_mode),
-                    "min_rwss": get_rwss(source_selection_result, "min", is_evaluation_mode),
-                    "max_rwss": get_rwss(source_selection_result, "max", is_evaluation_mode)
-                    #"tp_specific_relevant_sources_selectivity": get_tp_specific_relevant_sources(source_selection_result),
-                    #"bgp_restricted_source_level_tp_selectivity": get_bgp_restricted_source_level_tp_selectivity(source_selection_result),
-                    #"xfed_join_restricted_source_level_tp_selectivity": get_xfed_join_restricted_source_level_tp_selectivity(source_selection_result)
-                })
+        name_search = re.search(r".*/(\w+)/(q\w+)/instance_(\d+)/batch_(\d+)/((attempt_(\d+)|test)/)?provenance\.(csv|parquet)", provenance_file)
+        engine = name_search.group(1)
+        query = name_search.group(2)
+        instance = int(name_search.group(3))
+        batch = int(name_search.group(4))
+        attempt = name_search.group(7)
+        total_nb_sources = vendor_edges[batch] + ratingsite_edges[batch]
+        results_file = f"{Path(provenance_file).parent}/results{Path(provenance_file).suffix}"
+        
+        is_evaluation_mode = ( (engine in CONFIG["evaluation"]["engines"]) and (attempt is not None) )       
+        
+        record = dict()
         
-            records.append(record)
+        if is_evaluation_mode:
+            record.update({
+                "attempt": int(attempt),
+                "engine": engine
+            })
+        
+        if is_empty(provenance_file):
+            logger.debug(f"{provenance_file} is empty!")
+            record.update({
+                "query": query,
+                "instance": instance,
+                "batch": batch,
+                "nb_results": np.nan,
+                "nb_distinct_sources": np.nan,
+                "relevant_sources_selectivity": np.nan,
+                "tpwss": np.nan,
+                "avg_rwss": np.nan,
+                "min_rwss": np.nan,
+                "max_rwss": np.nan
+                #"tp_specific_relevant_sources_selectivity": get_tp_specific_relevant_sources(source_selection_result),
+                #"bgp_restricted_source_level_tp_selectivity": get_bgp_restricted_source_level_tp_selectivity(source_selection_result),
+                #"xfed_join_restricted_source_level_tp_selectivity": get_xfed_join_restricted_source_level_tp_selectivity(source_selection_result)
+            })
+        else:
+            nb_results = np.nan
+            source_selection_result = read_table(provenance_file)
+            if not is_empty(results_file):
+                nb_results = len(read_table(results_file))
+                    
+            record.update({
+                "query": query,
+                "instance": instance,
+                "batch": batch,
+                "nb_results": nb_results,
+                "nb_distinct_sources": get_distinct_sources(source_selection_result),
+                "relevant_sources_selectivity": get_relevant_sources_selectivity(source_selection_result, total_nb_sources),
+                "tpwss": get_tpwss(source_selection_result),
+                "avg_rwss": get_rwss(source_selection_result, "mean", is_evaluation_mode),
+                "min_rwss": get_rwss(source_selection_result, "min", is_evaluation_mode),
+                "max_rwss": get_rwss(source_selection_result, "max", is_evaluation_mode)
+                #"tp_specific_relevant_sources_selectivity": get_tp_specific_relevant_sources(source_selection_result),
+                #"bgp_restricted_source_level_tp_selectivity": get_bgp_restricted_source_level_tp_selectivity(source_selection_result),
+                #"xfed_join_restricted_source_level_tp_selectivity": get_xfed_join_restricted_source_level_tp_selectivity(source_selection_result)
+            })
+
+            if oracle is not None:
+                queryfile = f"{CONFIG_GEN['workdir']}/benchmark/generation/{query}/instance_{instance}/injected.sparql"
+                record.update(get_oracle_metrics(oracle, queryfile, batch, source_selection_result, oracle_cache))
+    
+        records.append(record)
     
     metrics_df = pd.DataFrame.from_records(records)
     metrics_df.to_csv(outfile, index=False)
@@ -0,0 +1,82 @@
+"""Benchmark const.json conditions: DataFrame.query on the translated string vs the compiled NumPy predicate.
+
+The value selection is synthetic, with numerical, date and IRI columns named after the BSBM constants.
+Both paths are checked to select the same rows. The parsing time of the expressions is reported with and without
+pyparsing packrat caching.
+
+Usage: python fedshop/misc/bench_pandas_algebra.py --rows 1000000 --repeat 5
+"""
+
+import os
+from pathlib import Path
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+from pyparsing import ParserElement
+
+sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
+
+from algebra.pandas_algebra import compile_algebra, parse_expr, translate_query
+
+EXPRESSIONS = [
+    "`constValue1` < `value1`",
+    "`x` <= `p1` and `y` >= `p3`",
+    "`ProductFeature2` != `ProductFeature1` and `x` <= `p1` and `ProductFeature3` != `ProductFeature2` and `ProductFeature3` != `ProductFeature1` and `y` <= `p2`",
+    "`p3` <= `p1` and (`y` <= `p2` or `p3` <= `p2`) and `y` <= `p1`",
+    "not (`x` > `p1`) and (`currentDate` < `date` or `ProductFeature1` == `ProductFeature2`)",
+]
+
+def make_value_selection(n_rows, seed=42):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        column: rng.integers(0, 2000, n_rows)
+        for column in ["constValue1", "value1", "x", "y", "p1", "p2", "p3"]
+    })
+    for column in ["ProductFeature1", "ProductFeature2", "ProductFeature3"]:
+        df[column] = [ f"http://www.ratingsite0.fr/ProductFeature{i}" for i in rng.integers(0, 50, n_rows) ]
+    for column in ["currentDate", "date"]:
+        df[column] = pd.Timestamp("2008-01-01") + pd.to_timedelta(rng.integers(0, 365, n_rows), unit="D")
+    return df
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+@click.command()
+@click.option("--rows", type=click.INT, default=1000000)
+@click.option("--repeat", type=click.INT, default=5)
+def bench(rows, repeat):
+    df = make_value_selection(rows)
+
+    click.echo(f"{'expression':<50} {'query (ms)':>11} {'compiled (ms)':>14} {'speedup':>8}")
+    for expr in EXPRESSIONS:
+        # df.query parses the translated string on every call, as in create-workload-value-selection-with-constraints
+        query_time, expected = best_of(repeat, lambda: df.query(translate_query(parse_expr(expr))))
+        predicate = compile_algebra(parse_expr(expr))
+        compiled_time, mask = best_of(repeat, lambda: predicate(df))
+
+        if not expected.index.equals(df.index[mask]):
+            raise RuntimeError(f"{expr}: the compiled predicate does not select the same rows as DataFrame.query")
+
+        label = expr if len(expr) <= 50 else expr[:47] + "..."
+        click.echo(f"{label:<50} {query_time*1e3:>11.1f} {compiled_time*1e3:>14.1f} {query_time/compiled_time:>7.1f}x")
+
+    click.echo()
+    click.echo(f"{'parsing':<50} {'plain (ms)':>11} {'packrat (ms)':>14}")
+    for expr in EXPRESSIONS:
+        plain_time, _ = best_of(repeat, lambda: parse_expr(expr))
+        ParserElement.enable_packrat()
+        packrat_time, _ = best_of(repeat, lambda: parse_expr(expr))
+        ParserElement.disable_memoization()
+        label = expr if len(expr) <= 50 else expr[:47] + "..."
+        click.echo(f"{label:<50} {plain_time*1e3:>11.2f} {packrat_time*1e3:>14.2f}")
+
+if __name__ == "__main__":
+    bench()
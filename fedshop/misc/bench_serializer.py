@@ -0,0 +1,55 @@
+"""Benchmark translateAlgebra (algebra -> SPARQL) on synthetic queries of growing size.
+
+Usage: python fedshop/misc/bench_serializer.py --sizes 10,50,100,500 --repeat 5
+"""
+
+import os
+from pathlib import Path
+import sys
+import time
+
+import click
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+
+sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
+# rdflib's grammar recurses on long group graph patterns
+sys.setrecursionlimit(100000)
+
+from algebra.rdflib_algebra import translateAlgebra
+
+def make_query(n_triples):
+    """Build a BSBM-like query with n_triples triple patterns, split in 2 UNION branches, with a FILTER every 10 triples."""
+    branches = []
+    for branch_id in range(2):
+        patterns = []
+        for tp_id in range(branch_id, n_triples, 2):
+            patterns.append(f"?product bsbm:productPropertyNumeric{tp_id} ?value{tp_id} .")
+            if tp_id % 10 == 0:
+                patterns.append(f"FILTER (?value{tp_id} > {tp_id})")
+        branches.append("{ " + "\n".join(patterns) + " }")
+
+    return (
+        "PREFIX bsbm: <http://www4.wiwiss.fu-berlin.de/bizer/bsbm/v01/vocabulary/>\n"
+        "SELECT DISTINCT ?product WHERE {\n" + "\nUNION\n".join(branches) + "\n}\nORDER BY ?product\nLIMIT 10"
+    )
+
+@click.command()
+@click.option("--sizes", type=click.STRING, default="10,50,100,250,500,1000", help="Comma-separated number of triple patterns.")
+@click.option("--repeat", type=click.INT, default=5)
+def bench(sizes, repeat):
+    click.echo(f"{'triples':>8} {'chars':>8} {'best (ms)':>10} {'us/triple':>10}")
+    for size in map(int, sizes.split(",")):
+        query = make_query(size)
+        timings = []
+        for _ in range(repeat):
+            # translateQuery modifies the parse tree, start from a fresh one each time
+            translated = translateQuery(parseQuery(query))
+            start = time.perf_counter()
+            result = translateAlgebra(translated)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        click.echo(f"{size:>8} {len(result):>8} {best*1e3:>10.2f} {best*1e6/size:>10.1f}")
+
+if __name__ == "__main__":
+    bench()
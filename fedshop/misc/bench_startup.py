@@ -0,0 +1,92 @@
+"""Startup-time regression check for the fedshop CLIs.
+
+Snakemake starts fedshop/query.py hundreds of times per generation run, so import time matters.
+Each command is started with `python -X importtime <script> <command> --help`, the import time and the wall time are reported,
+and the script fails if the import time exceeds the budget or if a slow/network-bound module is loaded.
+
+Usage: python fedshop/misc/bench_startup.py --budget-ms 200 execute-query decompose-query instanciate-workload
+"""
+
+from pathlib import Path
+import re
+import subprocess
+import sys
+import time
+
+import click
+
+FEDSHOP_DIR = Path(__file__).parent.parent
+
+# Modules that must never be loaded when starting a command, either because they are slow or need network
+FORBIDDEN_MODULES = ["nltk", "ftlangdetect", "fasttext", "iso639", "SPARQLWrapper", "scipy"]
+
+def parse_importtime(stderr):
+    """Parse the output of `python -X importtime`.
+
+    Args:
+        stderr (str): the stderr of the process.
+
+    Returns:
+        dict: top-level module -> cumulative import time in microseconds.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match is None:
+            continue
+        _, cumulative, indent, module = match.groups()
+        imports[module] = (int(cumulative), len(indent))
+    return imports
+
+def measure(script, command):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", str(script), command, "--help"],
+        capture_output=True, text=True, cwd=FEDSHOP_DIR.parent
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"{script} {command} failed: {proc.stderr[-2000:]}")
+    return wall, parse_importtime(proc.stderr)
+
+@click.command()
+@click.argument("commands", nargs=-1)
+@click.option("--script", type=click.Path(exists=True, file_okay=True, dir_okay=False), default=str(FEDSHOP_DIR / "query.py"))
+@click.option("--budget-ms", type=click.FLOAT, default=200, help="Maximum import time per command.")
+@click.option("--repeat", type=click.INT, default=3)
+@click.option("--top", type=click.INT, default=5, help="Number of slowest imports to show.")
+def bench(commands, script, budget_ms, repeat, top):
+    commands = commands or ["execute-query", "decompose-query", "instanciate-workload"]
+    failed = False
+    for command in commands:
+        best_wall, best_imports = None, None
+        for _ in range(repeat):
+            wall, imports = measure(script, command)
+            if best_wall is None or wall < best_wall:
+                best_wall, best_imports = wall, imports
+
+        # Only count top-level imports (indent 1), nested ones are included in their parent
+        import_ms = sum(cumulative for cumulative, indent in best_imports.values() if indent == 1) / 1e3
+        status = "OK" if import_ms <= budget_ms else "OVER BUDGET"
+        click.echo(f"{command}: imports {import_ms:.0f} ms, wall {best_wall*1e3:.0f} ms (budget {budget_ms:.0f} ms) {status}")
+
+        slowest = sorted(
+            ((module, cumulative) for module, (cumulative, indent) in best_imports.items() if indent == 1),
+            key=lambda item: item[1], reverse=True
+        )[:top]
+        for module, cumulative in slowest:
+            click.echo(f"    {module:<40} {cumulative/1e3:>8.1f} ms")
+
+        loaded = { module.split(".")[0] for module in best_imports.keys() }
+        forbidden = sorted(loaded & set(FORBIDDEN_MODULES))
+        if len(forbidden) > 0:
+            click.echo(f"    loads forbidden modules: {', '.join(forbidden)}")
+            failed = True
+
+        failed = failed or (import_ms > budget_ms)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    bench()
@@ -1,11 +1,16 @@
-import glob
+import os
 import re
 from pathlib import Path
+import sys
 from tqdm import tqdm
 
-for nq_file in tqdm(glob.glob("experiments/bsbm/model/dataset/*.nq")):
-    with open(nq_file) as nq_fs, open(Path(nq_file).with_suffix('.nt'), "w") as nt_fs:
-        for line in nq_fs.readlines():
+sys.path.append(str(os.path.join(Path(__file__).parent.parent)))
+
+from compression import list_datafiles, open_nquads, strip_compression
+
+for nq_file in tqdm(list_datafiles("experiments/bsbm/model/dataset")):
+    with open_nquads(nq_file) as nq_fs, open(Path(strip_compression(nq_file)).with_suffix('.nt'), "w") as nt_fs:
+        for line in nq_fs:
             s, p, o, src = re.split(r"\t", line.strip())
             src, punc = re.split(r"\s+", src)
-            nt_fs.write("\t".join([s, p, o, punc]) + "\n")
\ No newline at end of file
+            nt_fs.write("\t".join([s, p, o, punc]) + "\n")
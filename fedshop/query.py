@@ -1,69 +1,55 @@
 from copy import deepcopy
 import glob
-from itertools import chain
+from itertools import chain, count
 import json
 from pathlib import Path
 from pprint import pprint
 import subprocess
 
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from pathlib import Path
-from tqdm import tqdm
-
-from rdflib.term import Variable
-from rdflib.plugins.sparql.parser import parseQuery
-from rdflib.plugins.sparql.algebra import _traverseAgg, traverse, translateQuery, pprintAlgebra
-from rdflib.plugins.sparql.parserutils import CompValue
-
-from algebra.rdflib_algebra import add_graph_to_triple_pattern, add_values_with_placeholders, collect_triple_variables, collect_variables, disable_offset, disable_orderby_limit, extract_where, inject_constant_into_placeholders, remove_filter_with_placeholders, replace_select_projection_with_graph, translateAlgebra
-from algebra.pandas_algebra import collect_constants, parse_expr, translate_query
-
 import re
-import numpy as np
-import pandas as pd
-from SPARQLWrapper import SPARQLWrapper, CSV
+from functools import lru_cache
 from io import BytesIO, StringIO
 import click
 
-from utils import load_config, fedshop_logger
+from utils import get_batch_endpoint, load_config, fedshop_logger
 logger = fedshop_logger(Path(__file__).name)
 
-import nltk
-
-nltk.download('stopwords', quiet=True)
-nltk.download('punkt', quiet=True)
+from sparql_client import SPARQL_CLIENT
+from artifacts import TableWriter, artifact_extension, is_empty, opt_artifact_path, read_table, write_table
+from result_cache import RESULT_CACHE, CachingReader, dataset_fingerprint
 
-from nltk.corpus import stopwords as nltk_stopwords
-from nltk.tokenize import word_tokenize, RegexpTokenizer
-
-tokenizer = RegexpTokenizer(r"\w+")
-
-from ftlangdetect import detect
-from iso639 import Lang
-import tempfile
+# This module is started hundreds of times by snakemake, so slow imports are done by the functions that use them:
+# - ftlangdetect (fastText) and iso639 in lang_detect,
+# - rdflib's SPARQL parser and algebra, and the algebra package, by the commands that parse or rewrite queries,
+# - numpy, pandas and tqdm by the functions working on results, so that dispatching a command stays cheap.
 
 PANDAS_RANDOM_STATE = 42
+INSTANCE_ID_VARIABLE = "fedshop_instance_id"
 WDQ_BIN_PATH = "fedshop/misc/wdq"
+STREAM_CHUNKSIZE = 100000
+# SQL state of the partial results returned by Virtuoso when a query reaches MaxQueryExecutionTime (anytime queries)
+VIRTUOSO_TIMEOUT_STATE = "S1TAT"
 
 @click.group
 def cli():
     pass
 
 
-stopwords = []
-for lang in ["english"]:
-    stopwords.extend(nltk_stopwords.words(lang))
-
-
 def lang_detect(txt):
+    from ftlangdetect import detect
+    from iso639 import Lang
+
     lines = str(txt).splitlines()
     result = Counter(map(lambda x: Lang(detect(text=x, low_memory=False)["lang"]).name.lower(), lines)).most_common(1)[
         0]
     return result
 
 
-def exec_query_on_endpoint(query, endpoint, error_when_timeout, timeout=None, default_graph=None):
+def exec_query_on_endpoint(query, endpoint, error_when_timeout, timeout=None, default_graph=None, method=None, fingerprint=None, accept="text/csv", retry=True):
     """Send a query to ANY endpoint
 
     Args:
@@ -71,36 +57,166 @@ def exec_query_on_endpoint(query, endpoint, error_when_timeout, timeout=None, de
         endpoint (_type_): _description_
         error_when_timeout (_type_): _description_
         timeout (_type_, optional): _description_. Defaults to None.
+        method (str, optional): HTTP method. Defaults to None, meaning POST only for queries too long for an URL.
+        fingerprint (str, optional): fingerprint of the data behind the endpoint, enables the result cache. Defaults to None.
+        accept (str, optional): the result format. Defaults to "text/csv".
+        retry (bool, optional): whether failed requests are retried, disable it when the query is measured. Defaults to True.
+
+    Raises:
+        RuntimeError: Virtuoso reached its execution time limit and only returned partial results (anytime query).
 
     Returns:
-        _type_: _description_
+        _type_: _description_ (the response is None when the result comes from the cache)
     """
-
-    sparql_endpoint = SPARQLWrapper(endpoint, defaultGraph=default_graph)
-    if error_when_timeout and timeout is not None:
-        sparql_endpoint.setTimeout(int(timeout))
-
-    sparql_endpoint.setMethod("GET")
-    sparql_endpoint.setReturnFormat(CSV)
-    sparql_endpoint.setQuery(query)
-
-    response = sparql_endpoint.query()
-    result = response.convert()
+    cache_endpoint = endpoint if default_graph is None else f"{endpoint}?default-graph-uri={default_graph}"
+    if accept != "text/csv":
+        # The same query may be cached in several formats
+        cache_endpoint = f"{cache_endpoint}#{accept}"
+    result = RESULT_CACHE.get(cache_endpoint, fingerprint, query)
+    if result is not None:
+        return None, result
+
+    response = SPARQL_CLIENT.query(
+        query, endpoint, method=method, default_graph=default_graph, accept=accept, retry=retry,
+        timeout=int(timeout) if error_when_timeout and timeout is not None else None
+    )
+    # Virtuoso answers 200 with the results found so far when the query times out, see VIRTUOSO_TIMEOUT_STATE
+    if response.headers.get("X-SQL-State") == VIRTUOSO_TIMEOUT_STATE:
+        raise RuntimeError(f"The query timed out on {endpoint}, the results are partial: {response.headers.get('X-SQL-Message')}")
+    result = response.content
+    RESULT_CACHE.set(cache_endpoint, fingerprint, query, result)
     return response, result
 
 
-def exec_query(query, endpoint, error_when_timeout=False):
+def exec_query(query, endpoint, error_when_timeout=False, method=None, fingerprint=None):
     """Send a query to an endpoint of certain batch and return results
 
     Args:
         query (_type_): _description_
         endpoint (_type_): _description_
         error_when_timeout (bool, optional): _description_. Defaults to False.
+        method (str, optional): HTTP method. Defaults to None, meaning chosen from the query length.
+        fingerprint (str, optional): fingerprint of the data behind the endpoint, enables the result cache. Defaults to None.
 
     Returns:
         _type_: _description_
     """
-    return exec_query_on_endpoint(query, endpoint, error_when_timeout)
+    return exec_query_on_endpoint(query, endpoint, error_when_timeout, method=method, fingerprint=fingerprint)
+
+def exec_query_stream(query, endpoint, chunksize=STREAM_CHUNKSIZE, method=None, fingerprint=None):
+    """Send a query to an endpoint and read the CSV results chunk by chunk, without loading the whole response in memory.
+
+    Args:
+        query (str): the query
+        endpoint (str): the SPARQL endpoint
+        chunksize (int, optional): the number of rows per chunk. Defaults to STREAM_CHUNKSIZE.
+        method (str, optional): HTTP method. Defaults to None, meaning chosen from the query length.
+        fingerprint (str, optional): fingerprint of the data behind the endpoint, enables the result cache. Defaults to None.
+
+    Raises:
+        RuntimeError: Virtuoso reached its execution time limit and only returned partial results, see exec_query_on_endpoint.
+
+    Yields:
+        pd.DataFrame: the chunks of the result, with the dtypes inferred from the first chunk, see infer_stream_dtypes.
+            An empty response yields one empty DataFrame.
+    """
+    import pandas as pd
+    def parse_chunks(stream):
+        # Inferring the dtypes of each chunk would give e.g. int64 for a chunk and float64 for the next one (missing values),
+        # so all the chunks are read as strings and cast to the dtypes of the first one
+        try:
+            chunks = pd.read_csv(stream, chunksize=chunksize, dtype=str)
+        except pd.errors.EmptyDataError:
+            yield pd.DataFrame()
+            return
+
+        dtypes = None
+        for chunk in chunks:
+            if dtypes is None:
+                dtypes = infer_stream_dtypes(chunk)
+            yield cast_stream_chunk(chunk, dtypes)
+
+    cached_result = RESULT_CACHE.get(endpoint, fingerprint, query)
+    if cached_result is not None:
+        with BytesIO(cached_result) as cached_stream:
+            yield from parse_chunks(cached_stream)
+        return
+
+    with SPARQL_CLIENT.query(query, endpoint, method=method, stream=True) as response:
+        # Partial results are neither parsed nor cached, see exec_query_on_endpoint
+        if response.headers.get("X-SQL-State") == VIRTUOSO_TIMEOUT_STATE:
+            raise RuntimeError(f"The query timed out on {endpoint}, the results are partial: {response.headers.get('X-SQL-Message')}")
+        stream = response.raw
+        if fingerprint is not None:
+            stream = CachingReader(stream, RESULT_CACHE, endpoint, fingerprint, query)
+        yield from parse_chunks(stream)
+
+def infer_stream_dtypes(chunk):
+    """Dtypes of a streamed result, inferred from its first chunk (read as strings).
+
+    Date columns are detected from their names, as in parse_csv_result. Integer columns are nullable (Int64),
+    so that the missing values of the next chunks fit, numeric columns are float64 and the others stay strings.
+
+    Returns:
+        dict: the dtype of each column, None for strings.
+    """
+    import pandas as pd
+    dtypes = {}
+    for column in chunk.columns:
+        values = chunk[column].dropna()
+        dtypes[column] = None
+        if "date" in column:
+            dtypes[column] = "datetime64[ns]"
+        elif not values.empty:
+            try:
+                pd.to_numeric(values)
+            except (TypeError, ValueError):
+                continue
+            dtypes[column] = "Int64" if values.str.fullmatch(r"[+-]?\d+").all() else "float64"
+    return dtypes
+
+def cast_stream_chunk(chunk, dtypes):
+    """Cast a chunk of a streamed result (read as strings) to the dtypes of the first chunk, see infer_stream_dtypes.
+
+    A column with values that do not fit (e.g. "A3" after numbers in the first chunk) stays strings in this chunk:
+    that is fine for CSV outfiles, TableWriter refuses it for Parquet ones.
+    """
+    import pandas as pd
+    for column, dtype in dtypes.items():
+        if dtype is None:
+            continue
+        if dtype.startswith("datetime"):
+            chunk[column] = pd.to_datetime(chunk[column])
+            continue
+        try:
+            chunk[column] = pd.to_numeric(chunk[column]).astype(dtype)
+        except (TypeError, ValueError):
+            logger.warning(f"Column {column} does not match the dtype {dtype} of the first chunk, the chunk keeps its strings")
+    return chunk
+
+def reservoir_sample(chunks, n, seed):
+    """Uniformly sample n rows from a stream of DataFrames, keeping at most n + chunksize rows in memory.
+
+    Each row gets a random key, the reservoir keeps the n rows with the smallest keys.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): the stream of rows
+        n (int): the number of rows to sample
+        seed (int): the random seed
+
+    Returns:
+        pd.DataFrame: the sample, in stream order
+    """
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    reservoir, reservoir_keys = None, np.empty(0)
+    for chunk in chunks:
+        keys = np.concatenate([reservoir_keys, rng.random(len(chunk))])
+        candidates = chunk if reservoir is None else pd.concat([reservoir, chunk], ignore_index=True)
+        kept = np.sort(np.argsort(keys, kind="stable")[:n])
+        reservoir, reservoir_keys = candidates.iloc[kept].reset_index(drop=True), keys[kept]
+    return reservoir
 
 @cli.command()
 @click.argument("endpoint", type=click.STRING)
@@ -111,7 +227,11 @@ def exec_query(query, endpoint, error_when_timeout=False):
 @click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
 @click.option("--ignore-errors", is_flag=True, default=False)
 @click.option("--dropna", is_flag=True, default=False)
-def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_errors, dropna):
+@click.option("--method", type=click.Choice(["GET", "POST"]), default=None, help="Defaults to GET, or POST if the query is too long for an URL.")
+@click.option("--stream", is_flag=True, default=False, help="Read the result by chunks, with --sample the rows are drawn by reservoir sampling.")
+@click.option("--chunksize", type=click.INT, default=STREAM_CHUNKSIZE, help="Number of rows per chunk with --stream.")
+@click.option("--fingerprint", type=click.STRING, default=None, help="Fingerprint of the data behind the endpoint (see result_cache.py), enables the result cache.")
+def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_errors, dropna, method, stream, chunksize, fingerprint):
     """Execute query, export to an output file and return number of rows .
 
     Args:
@@ -120,6 +240,10 @@ def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_
         sample ([type]): the number of rows randomly sampled
         ignore_errors ([type]): if set, ignore when the result is empty
         endpoint ([type]): the SPARQL endpoint
+        method ([type]): the HTTP method used to send the query
+        stream ([type]): if set, the memory used does not depend on the size of the result
+        chunksize ([type]): the number of rows per chunk when streaming
+        fingerprint ([type]): the fingerprint of the data behind the endpoint, results are cached if set
 
     Raises:
         RuntimeError: the result is empty
@@ -136,26 +260,257 @@ def execute_query(endpoint, queryfile, querydata, outfile, sample, seed, ignore_
     if query_text is None:
         raise RuntimeError("No query to execute...")
     
-    _, result = exec_query(query=query_text, endpoint=endpoint, error_when_timeout=False)
+    if stream:
+        return execute_query_stream(query_text, endpoint, outfile, sample, seed, ignore_errors, dropna, method, chunksize, queryfile=queryfile, fingerprint=fingerprint)
+    
+    _, result = exec_query(query=query_text, endpoint=endpoint, error_when_timeout=False, method=method, fingerprint=fingerprint)
+    csvOut = parse_csv_result(result)
+
+    if csvOut.empty and not ignore_errors:
+        logger.error(query_text)
+        raise RuntimeError(f"{queryfile} returns no result...")
+
+    if dropna:
+        csvOut.dropna(inplace=True)
+
+    if sample is not None:
+        csvOut = csvOut.sample(sample, random_state=seed)
+
+    if outfile: 
+        write_table(csvOut, outfile)
+
+    return csvOut
+
+def parse_csv_result(result):
+    """Parse the CSV result of a query, date columns are parsed.
+
+    Args:
+        result (bytes): the result, as returned by exec_query.
+
+    Returns:
+        pd.DataFrame: the result, empty if the response is empty.
+    """
+    import pandas as pd
+    if len(result.strip()) == 0:
+        return pd.DataFrame()
 
     with BytesIO(result) as header_stream, BytesIO(result) as data_stream:
         header = header_stream.readline().decode().strip().replace('"', '').split(",")
-        csvOut = pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
+        return pd.read_csv(data_stream, parse_dates=[h for h in header if "date" in h])
+
+def execute_query_stream(query_text, endpoint, outfile, sample, seed, ignore_errors, dropna, method, chunksize, queryfile=None, fingerprint=None):
+    """Streaming version of execute_query: chunks are written to outfile as they arrive, or go through reservoir sampling.
+
+    The dtypes of outfile are those of the first chunk, see exec_query_stream. The sample is small enough
+    to infer its dtypes once, as execute_query does.
+
+    Returns:
+        pd.DataFrame: the sample if sample is set, otherwise None (the result is only written to outfile).
+    """
+    n_rows = 0
+    def count_and_clean(chunks):
+        nonlocal n_rows
+        for chunk in chunks:
+            n_rows += len(chunk)
+            if dropna:
+                chunk = chunk.dropna()
+            yield chunk
+
+    chunks = count_and_clean(exec_query_stream(query_text, endpoint, chunksize=chunksize, method=method, fingerprint=fingerprint))
+
+    result = None
+    if sample is not None:
+        result = reservoir_sample(chunks, sample, seed)
+        if result is not None:
+            result = parse_csv_result(result.to_csv(index=False).encode())
+        if outfile and result is not None:
+            write_table(result, outfile)
+    elif outfile:
+        with TableWriter(outfile) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    else:
+        for _ in chunks: pass
+
+    if n_rows == 0 and not ignore_errors:
+        if outfile and os.path.exists(outfile):
+            os.remove(outfile)
+        logger.error(query_text)
+        raise RuntimeError(f"{queryfile} returns no result...")
+
+    return result
+
+def align_dtypes(reference, df):
+    """Give two frames the same columns and dtypes, so that equal rows are equal once concatenated.
+
+    Numeric columns are cast to float (e.g. int64 and float64 when values are missing),
+    other mismatching columns to strings (e.g. 10 and "10" when the other values of the column are not numbers).
+
+    Returns:
+        tuple: reference and df, with the columns of reference.
+    """
+    import pandas as pd
+    reference, df = reference.copy(), df.reindex(columns=reference.columns)
+    as_str = lambda column: column.astype(object).where(column.isna(), column.astype(str))
+    for column in reference.columns:
+        left, right = reference[column], df[column]
+        if left.dtype == right.dtype:
+            continue
+        if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right):
+            reference[column], df[column] = left.astype(float), right.astype(float)
+        else:
+            reference[column], df[column] = as_str(left), as_str(right)
+    return reference, df
+
+INCREMENTAL_UNSUPPORTED = [
+    "OptionalGraphPattern", "MinusGraphPattern", "SubSelect", "GraphGraphPattern", "ServiceGraphPattern",
+    "Builtin_EXISTS", "Builtin_NOTEXISTS", "Builtin_BOUND"
+]
+
+def check_monotone(algebra):
+    """Whether the results of a query on a superset of the data are a superset of its results.
 
-        if csvOut.empty and not ignore_errors:
-            logger.error(query_text)
-            raise RuntimeError(f"{queryfile} returns no result...")
+    Only SELECT queries made of triple patterns, FILTER, UNION, BIND and VALUES are accepted.
+    OPTIONAL, MINUS, (NOT) EXISTS and bound() may remove results when data is added,
+    aggregates and LIMIT/OFFSET change them, ORDER BY is not preserved, and GRAPH, SERVICE or subqueries are not handled by the graph filters.
 
-        if dropna:
-            csvOut.dropna(inplace=True)
+    Args:
+        algebra: the parsed query.
 
-        if sample is not None:
-            csvOut = csvOut.sample(sample, random_state=seed)
+    Returns:
+        str: why the query is not monotone, None if it is.
+    """
+    from rdflib.plugins.sparql.algebra import _traverseAgg
+    from rdflib.plugins.sparql.parserutils import CompValue
+    query_node = algebra[1]
+    if query_node.name != "SelectQuery":
+        return query_node.name
+    if "projection" not in query_node:
+        return "SELECT *"
+    if query_node.groupby is not None or query_node.having is not None:
+        return "GROUP BY"
+    # The new results are appended to the previous ones, out of order
+    if query_node.orderby is not None:
+        return "ORDER BY"
+
+    limitoffset = query_node.limitoffset
+    if limitoffset is not None:
+        if limitoffset.limit is not None:
+            return "LIMIT"
+        if limitoffset.offset is not None and int(limitoffset.offset) != 0:
+            return "OFFSET"
+
+    def collect_names(node, children):
+        names = list(chain(*[ child for child in children if isinstance(child, list) ]))
+        if isinstance(node, CompValue):
+            names.append(node.name)
+        return names
 
-        if outfile: 
-            csvOut.to_csv(outfile, index=False)
+    for name in _traverseAgg(query_node, collect_names):
+        if name in INCREMENTAL_UNSUPPORTED or name.startswith("Aggregate_"):
+            return name
+    return None
 
-        return csvOut
+def build_delta_queries(algebra, options, delta_graphs):
+    """Queries whose results, with the results on the previous graphs, are the results on all graphs.
+
+    With the triple patterns tp0..tpn, the i-th query only keeps the solutions where tpi matches a delta graph
+    and tp0..tpi-1 do not. Every new solution uses at least one triple of a delta graph and is returned exactly once:
+    by the query of its first triple pattern matching a delta graph. Solutions without any are the previous results.
+
+    The NOT IN filters are added next to their GRAPH clause, where the graph variable is always bound.
+    The IN filter is added to the outermost group: it also drops the solutions of the UNION branches without tpi.
+
+    Args:
+        algebra: the parsed query, monotone (see check_monotone).
+        options (dict): the query options.
+        delta_graphs (list[str]): the graphs added since the previous batch.
+
+    Returns:
+        list[str]: the queries.
+    """
+    from rdflib.plugins.sparql.parser import parseQuery
+    from rdflib.plugins.sparql.algebra import _traverseAgg
+    from algebra.rdflib_algebra import collect_graphs_variables
+    from algebra.rewrite import add_filter, add_graphs, drop_orderby_limit, filter_graphs, rewrite
+    graph_vars = _traverseAgg(rewrite(algebra, [add_graphs(count())])[1]["where"], collect_graphs_variables)
+    graph_list = ", ".join(f"<{graph}>" for graph in delta_graphs)
+
+    def graph_filter(graph_var, op):
+        return parseQuery(f"SELECT * WHERE {{ FILTER({graph_var.n3()} {op} ({graph_list})) }}")[1]["where"]["part"][0]
+
+    queries = []
+    for i, graph_var in enumerate(graph_vars):
+        graph_filters = { str(previous_var): graph_filter(previous_var, "NOT IN") for previous_var in graph_vars[:i] }
+        delta_algebra = rewrite(algebra, [
+            add_graphs(count()), filter_graphs(graph_filters), add_filter(graph_filter(graph_var, "IN")), drop_orderby_limit()
+        ])
+        queries.append(export_query(delta_algebra, options))
+    return queries
+
+@cli.command()
+@click.argument("endpoint", type=click.STRING)
+@click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("previous-results", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("outfile", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+@click.option("--graphs", type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True, help="Proxy mapping of the batch (virtuoso-proxy-mapping-batch<k>.json), its keys are the graphs.")
+@click.option("--previous-graphs", type=click.Path(exists=True, file_okay=True, dir_okay=False), required=True, help="Proxy mapping of the previous batch.")
+@click.option("--fingerprint", type=click.STRING, default=None, help="Fingerprint of the data behind the endpoint (see result_cache.py), enables the result cache.")
+@click.pass_context
+def execute_query_incremental(ctx: click.Context, endpoint, queryfile, previous_results, outfile, graphs, previous_graphs, fingerprint):
+    """Compute the results of a query on a batch from its results on the previous batch, see build_delta_queries.
+
+    The endpoint only evaluates the query around the graphs added since the previous batch.
+    Falls back to execute-query when the query is not monotone (see check_monotone), when the previous graphs
+    are not included in the graphs of the batch, or when the previous results are empty.
+
+    Args:
+        endpoint (str): the SPARQL endpoint, serving the graphs of the batch.
+        queryfile (str): the query.
+        previous_results (str): the results of the query on the previous batch.
+        outfile (str): the results on the batch.
+        graphs (str): the proxy mapping of the batch.
+        previous_graphs (str): the proxy mapping of the previous batch.
+        fingerprint (str): fingerprint of the data behind the endpoint.
+    """
+    import pandas as pd
+    algebra, options = parse_template(queryfile=queryfile)
+    with open(graphs, "r") as graphs_fs, open(previous_graphs, "r") as previous_graphs_fs:
+        batch_graphs = set(json.load(graphs_fs).keys())
+        previous_batch_graphs = set(json.load(previous_graphs_fs).keys())
+    delta_graphs = sorted(batch_graphs - previous_batch_graphs)
+
+    reason = check_monotone(algebra)
+    if reason is None and not previous_batch_graphs.issubset(batch_graphs):
+        reason = "the previous graphs are not all in the batch"
+    if reason is None and is_empty(previous_results):
+        reason = "empty previous results"
+
+    if reason is not None:
+        logger.info(f"{queryfile} is computed from scratch: {reason}")
+        ctx.invoke(execute_query, endpoint=endpoint, queryfile=queryfile, outfile=outfile, fingerprint=fingerprint)
+        return
+
+    # Timeouts and errors of the delta queries propagate as in execute-query, outfile is only written once all succeeded
+    frames = [ read_table(previous_results) ]
+    for query in build_delta_queries(algebra, options, delta_graphs) if len(delta_graphs) > 0 else []:
+        _, result = exec_query(query=query, endpoint=endpoint, error_when_timeout=False, fingerprint=fingerprint)
+        delta = parse_csv_result(result)
+        if not delta.empty:
+            frames.append(delta)
+
+    # The dtypes inferred for each frame may differ (e.g. 10 in a delta, "10" in previous results also holding "A1"),
+    # then equal rows would not be dropped as duplicates
+    # The second pass gives the first deltas the dtypes changed by the next ones
+    for _ in range(2):
+        for i in range(1, len(frames)):
+            frames[0], frames[i] = align_dtypes(frames[0], frames[i])
+    results = pd.concat(frames, ignore_index=True)
+    if str(algebra[1].modifier) == "DISTINCT":
+        results = results.drop_duplicates().reset_index(drop=True)
+
+    logger.info(f"{queryfile}: {len(results) - len(frames[0])} new results from {len(delta_graphs)} graphs")
+    write_table(results, outfile)
 
 def pretty_print_query(queryfile):
     cmd = f"./{WDQ_BIN_PATH} --no-execute --language en --query {queryfile}"
@@ -189,6 +544,12 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
     Returns:
         None
     """   
+    from rdflib.term import Variable
+    from rdflib.plugins.sparql.algebra import _traverseAgg, traverse
+    from rdflib.plugins.sparql.parserutils import CompValue
+    from algebra.rdflib_algebra import collect_triple_variables, collect_variables, extract_where
+    from algebra.rewrite import drop_offset, drop_orderby_limit, remove_filters, rewrite
+    from algebra.pandas_algebra import collect_constants, parse_expr
     
     def has_constant(node, children, consts):
         if isinstance(node, Variable):
@@ -329,15 +690,11 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
     for subq_id, (kind, subq_bgp_algebra) in enumerate(subq_bgp_algebras):
         subq_vars = set(map(str, _traverseAgg(subq_bgp_algebra, collect_triple_variables))) & cond_consts
 
-        subq_bgp_algebra = traverse(
-            subq_bgp_algebra, 
-            visitPost=lambda x: remove_filter_with_placeholders(
-                x, consts={"query": subq_vars, "filter": filter_consts}
-            )
-        )
-                        
-        subq_bgp_algebra = traverse(subq_bgp_algebra, visitPost=disable_orderby_limit)
-        subq_bgp_algebra = traverse(subq_bgp_algebra, visitPost=disable_offset)
+        subq_bgp_algebra = rewrite(subq_bgp_algebra, [
+            remove_filters({"query": subq_vars, "filter": filter_consts}),
+            drop_orderby_limit(),
+            drop_offset()
+        ])
                 
         if kind == "exclusive":
             subqueries[f"sq{subq_id}"] = {
@@ -346,7 +703,7 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
             }
                             
         elif kind == "join":
-            subq_consts = [ CompValue("vars", var=Variable(c)) for c in subq_vars ]    
+            subq_consts = [ CompValue("vars", var=Variable(c)) for c in sorted(subq_vars) ]    
             subq_algebra = traverse(algebra, visitPost=lambda node: build_sub_query(node, new_where=subq_bgp_algebra, new_proj=subq_consts))
             subqueries[f"sq{subq_id}"] = {
                 "kind": kind,
@@ -355,7 +712,7 @@ def build_value_selection_query(ctx: click.Context, queryfile, constfile, outfil
             
         elif kind == "optional":
             subq_vars = subq_vars & optional_consts
-            subq_consts = [ CompValue("vars", var=Variable(c)) for c in subq_vars ]    
+            subq_consts = [ CompValue("vars", var=Variable(c)) for c in sorted(subq_vars) ]    
             subq_algebra = traverse(algebra, visitPost=lambda node: build_sub_query(node, new_where=subq_bgp_algebra, new_proj=subq_consts))
             subqueries[f"sq{subq_id}"] = {
                 "kind": kind,
@@ -389,16 +746,60 @@ def instanciate_workload(ctx: click.Context, queryfile, value_selection, outfile
     Returns:
         None
     """
+    from algebra.rewrite import drop_offset, inject_constants, rewrite
                     
     value_selection_values = read_csv(value_selection) 
     placeholder_chosen_values = value_selection_values.to_dict(orient="records")[instance_id]
         
     # Open the original queryfile
-    algebra, options = ctx.invoke(parse_query, queryfile=queryfile)
-    algebra = traverse(algebra, visitPost=lambda node: inject_constant_into_placeholders(node, placeholder_chosen_values))
-    algebra = traverse(algebra, visitPost=disable_offset)
+    algebra, options = parse_template(queryfile=queryfile)
+    algebra = rewrite(algebra, [inject_constants(placeholder_chosen_values), drop_offset()])
     export_query(algebra, options, outfile=outfile)
 
+@cli.command()
+@click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("outdir", type=click.Path(file_okay=False, dir_okay=True))
+@click.option("--n-instances", type=click.INT, default=None, help="Only instanciate the first n instances. Defaults to all rows of the value selection.")
+@click.option("--decompose/--no-decompose", default=True, help="Also write composition.json, as decompose-query.")
+def instanciate_workload_all(queryfile, value_selection, outdir, n_instances, decompose):
+    """Instantiate all the instances of a query in one run, equivalent to instanciate-workload (and decompose-query) for each row.
+
+    The template is parsed once and every row of the value selection goes through the same rewrite passes.
+    Instance i is written to {outdir}/instance_{i}/injected.sparql and {outdir}/instance_{i}/composition.json.
+
+    Args:
+        queryfile (str): The path to the query template.
+        value_selection (str): The path to the workload value selection, one row per instance.
+        outdir (str): The directory of the query, e.g. experiments/bsbm/benchmark/generation/q01.
+        n_instances (int): Only instanciate the first n instances.
+        decompose (bool): Also write the composition of each instance.
+    """
+    from tqdm import tqdm
+    from algebra.rewrite import drop_offset, inject_constants, rewrite
+    
+    algebra, options = parse_template(queryfile=queryfile)
+    records = read_csv(value_selection).to_dict(orient="records")
+    if n_instances is not None:
+        if n_instances > len(records):
+            raise ValueError(f"{value_selection} only has {len(records)} instances, {n_instances} requested")
+        records = records[:n_instances]
+    
+    for instance_id, placeholder_chosen_values in enumerate(tqdm(records)):
+        instance_dir = Path(outdir) / f"instance_{instance_id}"
+        instance_dir.mkdir(parents=True, exist_ok=True)
+        
+        instance_algebra = rewrite(algebra, [inject_constants(placeholder_chosen_values), drop_offset()])
+        injected_query = export_query(instance_algebra, options, outfile=str(instance_dir / "injected.sparql"))
+        
+        if decompose:
+            # decompose-query works on the injected query, with prefixes expanded
+            injected_algebra, _ = parse_query_proc(querydata=injected_query)
+            with open(instance_dir / "composition.json", "w") as out_fs:
+                json.dump(decompose_algebra(injected_algebra), out_fs)
+    
+    logger.info(f"Instanciated {len(records)} instances of {queryfile} in {outdir}")
+
 @cli.command()
 @click.argument("provenance", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("opt-comp", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -418,14 +819,15 @@ def unwrap(provenance, opt_comp, def_comp):
         opt_comp (dict): _description_
         def_comp (dict): _description_
     """
+    import pandas as pd
 
-    provenance_df = pd.read_csv(provenance)
+    provenance_df = read_table(provenance)
 
     with open(opt_comp, 'r') as opt_comp_fs, open(def_comp, 'r') as def_comp_fs:
         opt_comp_dict = json.load(opt_comp_fs)
         def_comp_dict = json.load(def_comp_fs)
 
-        provenance_df.to_csv(f"{provenance}.opt", index=False)
+        write_table(provenance_df, opt_artifact_path(provenance))
 
         reversed_def_comp = dict()
         for k, v in def_comp_dict.items():
@@ -451,7 +853,7 @@ def unwrap(provenance, opt_comp, def_comp):
             .astype(str)
 
         result_df = result_df.reindex(sorted_columns, axis=1)
-        result_df.to_csv(provenance, index=False)
+        write_table(result_df, provenance)
 
 @cli.command()
 @click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -466,6 +868,24 @@ def decompose_query(ctx: click.Context, queryfile, outfile):
         outfile (_type_): the final output query
     """
 
+    algebra, _ = ctx.invoke(parse_query, queryfile=queryfile)
+    composition = decompose_algebra(algebra)
+        
+    with open(outfile, "w") as out_fs:
+        json.dump(composition, out_fs)
+
+def decompose_algebra(algebra):
+    """Triple patterns of a parsed query, see decompose-query.
+
+    Args:
+        algebra: the parsed query.
+
+    Returns:
+        dict: tp<id> -> (subject, predicate, object).
+    """
+    from rdflib.plugins.sparql.algebra import _traverseAgg
+    from rdflib.plugins.sparql.parserutils import CompValue
+
     def translate(node, children):
         
         if isinstance(node, CompValue):
@@ -488,17 +908,21 @@ def decompose_query(ctx: click.Context, queryfile, outfile):
         return list(chain(*children))
         
     composition = {}
-    algebra, _ = ctx.invoke(parse_query, queryfile=queryfile)
     for triple_id, triple in enumerate(_traverseAgg(algebra, visit_add_triple)):
         composition[f"tp{triple_id}"] = triple
-        
-    with open(outfile, "w") as out_fs:
-        json.dump(composition, out_fs)
+    return composition
 
 def parse_query_proc(queryfile=None, querydata=None):
+    from rdflib.plugins.sparql.parser import parseQuery
+    from algebra.cache import ALGEBRA_CACHE, digest
     if queryfile:
         with open(queryfile, "r") as qf:
             querydata = qf.read()
+    
+    cache_key = digest("parse", querydata)
+    cached = ALGEBRA_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
             
     misc = {
         "explicit_join_order": False
@@ -511,7 +935,20 @@ def parse_query_proc(queryfile=None, querydata=None):
         query = query.replace('DEFINE sql:select-option "order"', '')
     
     algebra = parseQuery(query)
+    ALGEBRA_CACHE.set(cache_key, (algebra, misc))
     return algebra, misc
+
+@lru_cache(maxsize=64)
+def parse_template(queryfile=None, querydata=None):
+    """Parse a query once per process.
+
+    The algebra is shared between callers: it must only be transformed with rewrite(), which leaves it untouched,
+    never with rdflib's traverse.
+
+    Returns:
+        tuple: the parsed algebra and the options, as parse_query.
+    """
+    return parse_query_proc(queryfile=queryfile, querydata=querydata)
     
 
 @cli.command()
@@ -537,6 +974,7 @@ def parse_query(queryfile, querydata, print_algebra, translate):
         RuntimeError: If both `queryfile` and `querydata` are None, indicating that no query is provided.
 
     """
+    from rdflib.plugins.sparql.algebra import translateQuery, pprintAlgebra
     
     if queryfile is None and querydata is None:
         raise RuntimeError("No query to parse...")
@@ -550,13 +988,23 @@ def parse_query(queryfile, querydata, print_algebra, translate):
     return algebra, misc
     
 def export_query(algebra, options, outfile=None):
-    translated = translateQuery(algebra)
-    query = translateAlgebra(translated)
-    
-    # Remove empty lines
-    with StringIO(query) as qfs:
-        qlines = [ line for line in qfs.readlines() if line.strip() != "" ]
-        query = "".join(qlines)
+    from rdflib.plugins.sparql.algebra import translateQuery
+    from algebra.rdflib_algebra import translateAlgebra
+    from algebra.cache import ALGEBRA_CACHE, digest, dumps, loads
+    algebra_data = dumps(algebra)
+    cache_key = digest("export", algebra_data, json.dumps(options, sort_keys=True))
+    query = ALGEBRA_CACHE.get(cache_key)
+    if query is None:
+        # translateQuery modifies the tree in place, work on a copy so that hits and misses behave the same
+        translated = translateQuery(loads(algebra_data))
+        query = translateAlgebra(translated)
+        
+        # Remove empty lines
+        with StringIO(query) as qfs:
+            qlines = [ line for line in qfs.readlines() if line.strip() != "" ]
+            query = "".join(qlines)
+        
+        ALGEBRA_CACHE.set(cache_key, query)
         
     # Create a temporary file to hold the query
     # with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
@@ -578,10 +1026,8 @@ def export_query(algebra, options, outfile=None):
     return query
     
 def read_csv(csv_file):
-    with open(csv_file, "r") as header_fs:
-        header = header_fs.readline().strip().replace('"', '').split(",")
-        tmp = pd.read_csv(csv_file, parse_dates=[h for h in header if "date" in h], low_memory=False)
-        return tmp
+    # The artifact may be stored as CSV or Parquet, see artifacts.py
+    return read_table(csv_file)
         
 @cli.command()
 @click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -603,12 +1049,253 @@ def build_provenance_query(ctx: click.Context, queryfile, outfile):
         None
     """
     
-    algebra, options = ctx.invoke(parse_query, queryfile=queryfile)
-    algebra = traverse(algebra, visitPost=add_graph_to_triple_pattern)
-    algebra = traverse(algebra, visitPost=replace_select_projection_with_graph)
-    algebra = traverse(algebra, visitPost=disable_orderby_limit)
-    algebra = traverse(algebra, visitPost=disable_offset)
-    export_query(algebra, options, outfile=outfile)
+    algebra, options = parse_template(queryfile=queryfile)
+    export_query(build_provenance_algebra(algebra), options, outfile=outfile)
+
+def build_provenance_algebra(algebra):
+    """The provenance query of a parsed query, see build-provenance-query.
+    """
+    from algebra.rewrite import add_graphs, drop_offset, drop_orderby_limit, project_graphs, rewrite
+    return rewrite(algebra, [add_graphs(count()), project_graphs(), drop_orderby_limit(), drop_offset()])
+
+def plan_provenance(algebra):
+    """Split a query into the per-pattern queries of the semi-join provenance engine, see compute-provenance.
+
+    Each triple pattern is wrapped in its GRAPH clause, numbered as in build-provenance-query.
+    Only a group of triple patterns and FILTERs is supported, each FILTER must only use the variables of one triple pattern.
+
+    Args:
+        algebra: the parsed query.
+
+    Returns:
+        tuple: the prologue, the patterns and the graph variables in the order of the provenance query,
+            or None if the query is not supported.
+    """
+    from rdflib.term import Variable
+    from rdflib.plugins.sparql.algebra import _traverseAgg
+    from rdflib.plugins.sparql.parserutils import CompValue
+    from algebra.rdflib_algebra import collect_graphs_variables, collect_variables
+    from algebra.rewrite import QUERY_NODES, add_graphs, rewrite
+    graph_algebra = rewrite(algebra, [add_graphs(count())])
+    prologue, query_node = graph_algebra[0], graph_algebra[1]
+    if query_node.name not in QUERY_NODES:
+        return None
+
+    where = query_node["where"]
+    if not isinstance(where, CompValue) or where.name != "GroupGraphPatternSub":
+        return None
+
+    patterns, filters = [], []
+    for part in where.part or []:
+        if part.name == "Filter":
+            conjuncts = _conjuncts(part["expr"])
+            filters.extend([part] if len(conjuncts) == 1 else [ CompValue("Filter", expr=expr) for expr in conjuncts ])
+        elif part.name == "GraphGraphPattern" and [ p.name for p in part["graph"]["part"] ] == ["TriplesBlock"]:
+            triples = part["graph"]["part"][0]["triples"]
+            patterns.append({
+                "graph": part["term"],
+                "part": part,
+                "variables": set(_traverseAgg(triples, collect_variables)),
+                "n_constants": sum( not isinstance(term, Variable) for triple in triples for term in triple ),
+                "filters": []
+            })
+        else:
+            # OPTIONAL, UNION, MINUS, BIND, VALUES, subqueries, nested GRAPH
+            return None
+
+    for filter_node in filters:
+        filter_variables = set(_traverseAgg(filter_node["expr"], collect_variables))
+        pattern = next(( p for p in patterns if filter_variables.issubset(p["variables"]) ), None)
+        if pattern is None:
+            return None
+        pattern["filters"].append(filter_node)
+
+    if len(patterns) == 0:
+        return None
+
+    for pattern in patterns:
+        others = set(chain(*[ p["variables"] for p in patterns if p is not pattern ]))
+        pattern["join_variables"] = sorted(pattern["variables"] & others)
+
+    graph_vars = _traverseAgg(where, collect_graphs_variables)
+    return prologue, patterns, graph_vars
+
+def _conjuncts(expr):
+    """Top-level conjuncts of a FILTER expression, FILTER(A && B) is FILTER(A) FILTER(B).
+    """
+    from rdflib.plugins.sparql.parserutils import CompValue
+    if isinstance(expr, CompValue) and expr.name == "ConditionalOrExpression" and not expr.other:
+        expr = expr["expr"]
+    if isinstance(expr, CompValue) and expr.name == "ConditionalAndExpression" and expr.other:
+        return list(chain(*[ _conjuncts(e) for e in [expr["expr"]] + list(expr["other"]) ]))
+    return [expr]
+
+def order_patterns(patterns):
+    """Greedy join order: most selective pattern first (constants, then filters), then patterns connected to those already joined.
+    """
+    remaining, ordered, bound = list(patterns), [], set()
+    while len(remaining) > 0:
+        candidates = [ p for p in remaining if len(p["variables"] & bound) > 0 ] or remaining
+        pattern = max(candidates, key=lambda p: (p["n_constants"], len(p["filters"])))
+        remaining.remove(pattern)
+        ordered.append(pattern)
+        bound.update(pattern["variables"])
+    return ordered
+
+def _json_term(binding):
+    """rdflib term of a binding in the SPARQL JSON results format.
+    """
+    from rdflib.term import Literal, URIRef
+    if binding["type"] == "uri":
+        return URIRef(binding["value"])
+    elif binding["type"] in ["literal", "typed-literal"]:
+        return Literal(binding["value"], lang=binding.get("xml:lang"), datatype=binding.get("datatype"))
+    elif binding["type"] == "bnode" and binding["value"].startswith("nodeID://"):
+        # Virtuoso names blank nodes with IRIs, that can be sent back in VALUES
+        return URIRef(binding["value"])
+    raise NotImplementedError(f"Cannot join on {binding}")
+
+def _pattern_query(prologue, pattern, projection, values=None):
+    """SELECT DISTINCT query of one pattern and its filters, restricted to the join keys in values.
+    """
+    from rdflib.plugins.sparql.algebra import translateQuery
+    from rdflib.plugins.sparql.parserutils import CompValue
+    from algebra.rdflib_algebra import translateAlgebra
+    from algebra.rewrite import clone
+    parts = [pattern["part"]] + pattern["filters"]
+    if values is not None:
+        variables, rows = values
+        parts.insert(0, CompValue(
+            "InlineData", 
+            var=variables, 
+            value=rows if len(variables) > 1 else [ row[0] for row in rows ]
+        ))
+
+    query_node = CompValue(
+        "SelectQuery",
+        modifier="DISTINCT",
+        projection=[ CompValue("vars", var=var) for var in projection ],
+        where=CompValue("GroupGraphPatternSub", part=parts)
+    )
+    # Not cached by export_query: the VALUES differ on every call. translateQuery modifies the tree, work on a copy.
+    return translateAlgebra(translateQuery(clone([prologue, query_node])))
+
+def fetch_pattern(prologue, pattern, projection, endpoint, keys=None, values_chunk=1000, fingerprint=None):
+    """Distinct bindings of the projection for one pattern, sent by chunks of join keys.
+
+    Args:
+        keys (pd.DataFrame, optional): distinct join keys (one column per variable), the semi-join reduction. Defaults to None.
+
+    Returns:
+        pd.DataFrame: one column per variable of the projection, holding rdflib terms.
+    """
+    import pandas as pd
+    from rdflib.term import Variable
+    columns = [ str(var) for var in projection ]
+    if keys is None:
+        chunks = [None]
+    else:
+        key_vars = [ Variable(column) for column in keys.columns ]
+        key_rows = keys.values.tolist()
+        chunks = [ (key_vars, key_rows[i:i+values_chunk]) for i in range(0, len(key_rows), values_chunk) ]
+
+    frames = []
+    for values in chunks:
+        query = _pattern_query(prologue, pattern, projection, values=values)
+        _, result = exec_query_on_endpoint(query, endpoint, error_when_timeout=False, fingerprint=fingerprint, accept="application/sparql-results+json")
+        bindings = json.loads(result)["results"]["bindings"]
+        frames.append(pd.DataFrame(
+            [ [ _json_term(binding[column]) for column in columns ] for binding in bindings ],
+            columns=columns, dtype=object
+        ))
+    return pd.concat(frames, ignore_index=True).drop_duplicates()
+
+def compute_provenance_semijoin(plan, endpoint, values_chunk=1000, fingerprint=None):
+    """Distinct combinations of graphs of a query, from per-pattern queries joined locally.
+
+    Patterns are fetched in join order. The distinct join keys of the partial result are sent in VALUES
+    with the next pattern, so that each query only returns the (graph, join keys) that can join.
+    The partial result is projected on the graph variables and the variables still to be joined.
+
+    Args:
+        plan (tuple): as returned by plan_provenance.
+        endpoint (str): the SPARQL endpoint.
+        values_chunk (int, optional): maximum number of join keys per query. Defaults to 1000.
+        fingerprint (str, optional): fingerprint of the data behind the endpoint, enables the result cache. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the provenance, with the same columns as the result of build-provenance-query.
+    """
+    import pandas as pd
+    from rdflib.term import Variable
+    prologue, patterns, graph_vars = plan
+    graph_columns = [ str(var) for var in graph_vars ]
+    ordered = order_patterns(patterns)
+
+    result = None
+    for i, pattern in enumerate(ordered):
+        needed = set(chain(*[ p["join_variables"] for p in ordered[i+1:] ]))
+        projection = [pattern["graph"]] + pattern["join_variables"]
+        shared = [] if result is None else [ str(var) for var in pattern["join_variables"] if str(var) in result.columns ]
+
+        keys = result[shared].drop_duplicates() if len(shared) > 0 else None
+        bindings = fetch_pattern(prologue, pattern, projection, endpoint, keys=keys, values_chunk=values_chunk, fingerprint=fingerprint)
+        logger.debug(f"{pattern['graph']}: {len(bindings)} bindings for {0 if keys is None else len(keys)} join keys")
+
+        if result is None:
+            result = bindings
+        elif len(shared) > 0:
+            result = result.merge(bindings, on=shared)
+        else:
+            result = result.merge(bindings, how="cross")
+
+        keep = [ column for column in result.columns if column in graph_columns or Variable(column) in needed ]
+        result = result[keep].drop_duplicates()
+        if result.empty:
+            return pd.DataFrame(columns=graph_columns)
+
+    result = result[graph_columns].astype(str).drop_duplicates()
+    return result.sort_values(graph_columns).reset_index(drop=True)
+
+@cli.command()
+@click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("endpoint", type=click.STRING)
+@click.argument("outfile", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+@click.option("--engine", type=click.Choice(["semijoin", "query"]), default="semijoin", help="semijoin: per-pattern queries joined locally, query: the query of build-provenance-query.")
+@click.option("--values-chunk", type=click.INT, default=1000, help="Maximum number of join keys per VALUES clause with the semijoin engine.")
+@click.option("--fingerprint", type=click.STRING, default=None, help="Fingerprint of the data behind the endpoint (see result_cache.py), enables the result cache.")
+@click.pass_context
+def compute_provenance(ctx: click.Context, queryfile, endpoint, outfile, engine, values_chunk, fingerprint):
+    """Compute the provenance (distinct combinations of graphs contributing to the results) of an instantiated query.
+
+    The output has the format of executing build-provenance-query: one column g<i> per triple pattern.
+    With the semijoin engine, the endpoint never evaluates the join across all graph variables,
+    whose size grows with the number of members to the power of the number of triple patterns.
+    Queries with OPTIONAL, UNION, MINUS, BIND, VALUES, subqueries or FILTERs across several triple patterns
+    fall back to the query engine.
+
+    Args:
+        queryfile (str): the instantiated query, e.g. injected.sparql.
+        endpoint (str): the SPARQL endpoint.
+        outfile (str): the provenance file.
+        engine (str): "semijoin" or "query".
+        values_chunk (int): maximum number of join keys per VALUES clause.
+        fingerprint (str): fingerprint of the data behind the endpoint.
+    """
+    algebra, options = parse_template(queryfile=queryfile)
+
+    plan = plan_provenance(algebra) if engine == "semijoin" else None
+    if plan is not None:
+        try:
+            write_table(compute_provenance_semijoin(plan, endpoint, values_chunk=values_chunk, fingerprint=fingerprint), outfile)
+            return
+        except NotImplementedError as e:
+            logger.warning(f"{queryfile}: {e}, falling back to the query engine")
+    elif engine == "semijoin":
+        logger.info(f"{queryfile} is not supported by the semijoin engine, falling back to the query engine")
+
+    query = export_query(build_provenance_algebra(algebra), options)
+    ctx.invoke(execute_query, endpoint=endpoint, querydata=query, outfile=outfile, ignore_errors=True, fingerprint=fingerprint)
         
 @cli.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -616,8 +1303,10 @@ def build_provenance_query(ctx: click.Context, queryfile, outfile):
 @click.argument("subqueryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
 @click.argument("n-instances", type=click.INT)
+@click.option("--batched", is_flag=True, default=False, help="Send the value selection of all exclusive instances in one query.")
+@click.option("--max-concurrency", type=click.INT, default=4, help="Maximum number of subqueries sent at the same time to the endpoint.")
 @click.pass_context
-def create_workload_value_selection(ctx: click.Context, configfile, constfile, subqueryfile, workload_value_selection, n_instances):
+def create_workload_value_selection(ctx: click.Context, configfile, constfile, subqueryfile, workload_value_selection, n_instances, batched, max_concurrency):
     """Create a value selection file from a query file
 
     Args:
@@ -627,11 +1316,14 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
         constfile (str): Path to the constfile.
         seed (int): Random seed for reproducibility.
         workload_value_selection (str): Path to the output workload value selection file.
+        batched (bool): If set, the exclusive value selection is done in one round-trip.
+        max_concurrency (int): Maximum number of subqueries sent at the same time to the endpoint.
     """
     
     # Read config
     config = load_config(configfile)
-    batch0_endpoint = config["generation"]["virtuoso"]["default_endpoint"]
+    batch0_endpoint = get_batch_endpoint(config, 0)
+    batch0_fingerprint = dataset_fingerprint(config["generation"]["workdir"], 0)
 
     # Get subqueries
     subqueries = {}
@@ -641,25 +1333,27 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
     b_require_exclusive = False
     exclusive_sq = None
 
-    for subq_id, subq_info in subqueries.items():
-        subq_kind = subq_info["kind"]
-        subq_text = subq_info["query"]
-        
-        subq_value_selection_file = f"{Path(subqueryfile).parent}/{Path(subqueryfile).stem}.{subq_id}.csv"
-        
-        if not os.path.exists(subq_value_selection_file):
-            logger.debug(f"Executing subquery:\n {subq_text}")
-            ctx.invoke(
-                execute_query, 
-                querydata = subq_text,
-                outfile=subq_value_selection_file, 
-                endpoint=batch0_endpoint
-            )
-        subqueries[subq_id]["subq_value_selection_file"] = subq_value_selection_file
+    # Subqueries are independent (UNION branches, OPTIONAL splits): run them concurrently
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {}
+        for subq_id, subq_info in subqueries.items():
+            subq_kind = subq_info["kind"]
+            subq_text = subq_info["query"]
             
-        if subq_kind == "exclusive":
-            b_require_exclusive = True
-            exclusive_sq = subq_text
+            subq_value_selection_file = f"{Path(subqueryfile).parent}/{Path(subqueryfile).stem}.{subq_id}{artifact_extension()}"
+            
+            if not os.path.exists(subq_value_selection_file):
+                logger.debug(f"Executing subquery:\n {subq_text}")
+                futures[executor.submit(execute_subquery, subq_text, batch0_endpoint, subq_value_selection_file, batch0_fingerprint)] = subq_id
+            subqueries[subq_id]["subq_value_selection_file"] = subq_value_selection_file
+                
+            if subq_kind == "exclusive":
+                b_require_exclusive = True
+                exclusive_sq = subq_text
+        
+        for future in as_completed(futures):
+            future.result()
+            logger.debug(f"Subquery {futures[future]} done")
                 
     # Update subqueries file
     with open(subqueryfile, "w") as sqfs:
@@ -675,7 +1369,8 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
             subqueries_file=subqueryfile,
             n_instances=n_instances,
             workload_value_selection=workload_value_selection,
-            constfile=constfile
+            constfile=constfile,
+            batched=batched
         )
     else:
         ctx.invoke(
@@ -686,6 +1381,20 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
             constfile=constfile
         )
 
+def execute_subquery(subq_text, endpoint, outfile, fingerprint=None):
+    """Stream the result of a value selection subquery to outfile.
+
+    The result is written to a temporary file first, so that an interrupted download is not mistaken for a complete one.
+    """
+    # Hidden temporary name, with the extension of outfile so that it is written in the same format
+    tmp_outfile = f"{Path(outfile).parent}/.part-{Path(outfile).name}"
+    execute_query_stream(
+        subq_text, endpoint, tmp_outfile, sample=None, seed=PANDAS_RANDOM_STATE, 
+        ignore_errors=False, dropna=False, method=None, chunksize=STREAM_CHUNKSIZE,
+        fingerprint=fingerprint
+    )
+    os.replace(tmp_outfile, outfile)
+
 @click.command()
 @click.argument("configfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.argument("excl-value-selection", type=click.Path(exists=True, file_okay=True, dir_okay=False))
@@ -696,12 +1405,36 @@ def create_workload_value_selection(ctx: click.Context, configfile, constfile, s
 @click.option("--workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
 @click.option("--constfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
+@click.option("--batched", is_flag=True, default=False, help="Send the value selection of all instances in one query.")
 @click.pass_context
-def create_workload_value_selection_with_exclusive(ctx: click.Context, configfile, excl_value_selection, subqueries_file, n_instances, queryfile, querydata, workload_value_selection, constfile, seed):
+def create_workload_value_selection_with_exclusive(ctx: click.Context, configfile, excl_value_selection, subqueries_file, n_instances, queryfile, querydata, workload_value_selection, constfile, seed, batched):
+    """Create the value selection for queries with an exclusive placeholder.
+
+    For each instance, the sampled exclusive value is inlined (VALUES) in the query to obtain the rest of the placeholders.
+    When batched, all sampled values are inlined in one VALUES clause tagged with the instance id,
+    the query is sent once (POST) and the result is split per instance.
+
+    Args:
+        excl_value_selection (str): Path to the value selection of the exclusive subquery.
+        n_instances (int): Number of instances to create.
+        queryfile (str): Path to the exclusive subquery file.
+        querydata (str): The exclusive subquery, if queryfile is not provided.
+        workload_value_selection (str): Path to the output workload value selection file.
+        constfile (str): Path to the constfile.
+        seed (int): Random seed for reproducibility.
+        batched (bool): If set, use one round-trip to the endpoint for all instances.
+    """
+    import pandas as pd
+    from tqdm import tqdm
+    from rdflib.plugins.sparql.algebra import _traverseAgg
+    from algebra.rdflib_algebra import collect_triple_variables
+    from algebra.rewrite import add_values, drop_offset, drop_orderby_limit, remove_filters, rewrite
+    from algebra.pandas_algebra import collect_constants, parse_expr
             
     # Read config
     config = load_config(configfile)
-    batch0_endpoint = config["generation"]["virtuoso"]["default_endpoint"]
+    batch0_endpoint = get_batch_endpoint(config, 0)
+    batch0_fingerprint = dataset_fingerprint(config["generation"]["workdir"], 0)
     
     # Composition
     comp = {}
@@ -715,7 +1448,8 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
         .reset_index(drop=True)
     )
         
-    subq_algebra, _ = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)
+    # The template is parsed once, rewrite() leaves it untouched
+    subq_algebra, options = parse_template(queryfile=queryfile, querydata=querydata)
     subq_variables = set(map(str, _traverseAgg(subq_algebra, collect_triple_variables)))
     
     cond_queries = [ q.get("query") for q in comp.values() if len(q) > 0 and q.get("query") ]
@@ -733,17 +1467,59 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
                 filter_consts.remove(const)
     
     tmp_dfs = []
+    
+    if batched:
+        inline_data = workload_subq_value_selection.to_dict(orient="list")
+        inline_data[INSTANCE_ID_VARIABLE] = list(range(n_instances))
+        tmp_query_algebra = rewrite(subq_algebra, [
+            add_values(inline_data),
+            remove_filters({"query": subq_variables | {INSTANCE_ID_VARIABLE}, "select": consts | {INSTANCE_ID_VARIABLE}, "filter": filter_consts}),
+            drop_orderby_limit(),
+            drop_offset()
+        ])
+        tmp_query_str = export_query(tmp_query_algebra, options)
+        
+        batch_query_result: pd.DataFrame = ctx.invoke(
+            execute_query, 
+            querydata=tmp_query_str, 
+            endpoint=batch0_endpoint,
+            method="POST",
+            fingerprint=batch0_fingerprint
+        )
+        
+        batch_query_result_per_instance = dict(list(batch_query_result.groupby(INSTANCE_ID_VARIABLE)))
+        for instance_id in tqdm(range(n_instances)):
+            if instance_id not in batch_query_result_per_instance:
+                logger.error(tmp_query_str)
+                raise RuntimeError(f"Instance {instance_id} returns no result...")
+            
+            tmp_query_result = (
+                batch_query_result_per_instance[instance_id]
+                .drop(columns=INSTANCE_ID_VARIABLE)
+                .reset_index(drop=True)
+            )
+            
+            tmp_df: pd.DataFrame = ctx.invoke(
+                create_workload_value_selection_with_constraints, 
+                value_selection_data=tmp_query_result, 
+                n_instances=1, 
+                seed=PANDAS_RANDOM_STATE+instance_id,
+                constfile=constfile
+            )
+            
+            tmp_dfs.append(tmp_df)
+            
+        workload_subq_value_selection = pd.concat(tmp_dfs, ignore_index=True)
+        write_table(workload_subq_value_selection, workload_value_selection)
+        return workload_subq_value_selection
+    
+    filter_removal = remove_filters({"query": subq_variables, "select": consts, "filter": filter_consts})
     for instance_id in tqdm(range(n_instances)):
-        tmp_query_algebra, options = ctx.invoke(parse_query, queryfile=queryfile, querydata=querydata)  
         inline_data = workload_subq_value_selection.iloc[instance_id]
         if isinstance(inline_data, pd.Series):
             inline_data = inline_data.to_frame().T
         inline_data = inline_data.to_dict(orient="list")
-        query_consts = set(map(str, _traverseAgg(tmp_query_algebra, collect_triple_variables)))
-        tmp_query_algebra = traverse(tmp_query_algebra, visitPost=lambda node: add_values_with_placeholders(node, inline_data))
-        tmp_query_algebra = traverse(tmp_query_algebra, visitPost=lambda node: remove_filter_with_placeholders(node, consts={"query": query_consts,"select": consts, "filter": filter_consts}))
-        tmp_query_algebra = traverse(tmp_query_algebra, disable_orderby_limit)
-        tmp_query_algebra = traverse(tmp_query_algebra, disable_offset)
+        tmp_query_algebra = rewrite(subq_algebra, [add_values(inline_data), filter_removal, drop_orderby_limit(), drop_offset()])
         tmp_query_str = export_query(tmp_query_algebra, options)
         
         # if not os.path.exists(tmp_query_result_file):              
@@ -751,6 +1527,7 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
             execute_query, 
             querydata=tmp_query_str, 
             endpoint=batch0_endpoint, 
+            fingerprint=batch0_fingerprint
         )        
         
         tmp_df: pd.DataFrame = ctx.invoke(
@@ -764,7 +1541,7 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
         tmp_dfs.append(tmp_df)
         
     workload_subq_value_selection = pd.concat(tmp_dfs, ignore_index=True)
-    workload_subq_value_selection.to_csv(workload_value_selection, index=False)
+    write_table(workload_subq_value_selection, workload_value_selection)
     return workload_subq_value_selection
                             
 @cli.command()
@@ -775,8 +1552,9 @@ def create_workload_value_selection_with_exclusive(ctx: click.Context, configfil
 @click.option("--workload-value-selection", type=click.Path(exists=False, file_okay=True, dir_okay=False))
 @click.option("--constfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
 @click.option("--seed", type=click.INT, default=PANDAS_RANDOM_STATE)
+@click.option("--compat-sampling", is_flag=True, default=False, help="Draw placeholder values like the former row by row implementation, to reproduce seeded results.")
 @click.pass_context
-def create_workload_value_selection_with_constraints(ctx: click.Context, value_selection, value_selection_data, n_instances, subquery_file, workload_value_selection, constfile, seed):
+def create_workload_value_selection_with_constraints(ctx: click.Context, value_selection, value_selection_data, n_instances, subquery_file, workload_value_selection, constfile, seed, compat_sampling):
     """Sample {n_instances} rows amongst the value selection. 
     The sampling is guaranteed to return results for provenance queries, using statistical criteria:
         1. Percentiles for numerical attribute: if value falls between 25-75 percentile
@@ -787,7 +1565,13 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
         value_selection (_type_): _description_
         workload_value_selection (_type_): _description_
         n_instances (_type_): _description_
+        compat_sampling (bool): If set, placeholder values are drawn as in the former row by row implementation.
     """
+    import numpy as np
+    import pandas as pd
+    from rdflib.plugins.sparql.algebra import _traverseAgg, traverse
+    from rdflib.plugins.sparql.parserutils import CompValue
+    from algebra.pandas_algebra import compile_algebra, parse_expr, translate_query
     
     with open(constfile, "r") as cfs:
         comp = json.load(cfs)
@@ -838,13 +1622,11 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
     
     numerical = df[numerical_cols]
     if not numerical.empty:
-        query = " or ".join([
-            f"( `{col}` >= {repr(numerical[col].quantile(0.10))} and `{col}` <= {repr(numerical[col].quantile(0.90))} )"
-            # f"( `{col}` > {repr(numerical[col].min())} and `{col}` < {repr(numerical[col].max())} )"
-            for col in numerical.columns
-        ])
-
-        df = df.query(query)   
+        mask = np.zeros(len(df), dtype=bool)
+        for col in numerical.columns:
+            values = numerical[col]
+            mask |= ((values >= values.quantile(0.10)) & (values <= values.quantile(0.90))).to_numpy()
+        df = df[mask]
     
     def has_only_placeholder(node, children):
         if isinstance(node, CompValue):
@@ -879,61 +1661,109 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
                 if right.name == "Placeholder":
                     return CompValue("Placeholder")
                 
-    def create_placeholder_value(row, placeholder_query):
-        """Create a placeholder value for a given row based on the placeholder query.
-    
+    def estimate_replacement_value_based_on_op(op, value):
+        epsilon = None
+        if str(value).isnumeric():
+            epsilon = 1
+        elif isinstance(value, pd.Timestamp):
+            epsilon = pd.Timedelta(days=1)
+        else:
+            raise ValueError(f"Unsupported value type {type(value)} for value {value}!")
+        
+        if op in ["=", "!=", "in"]:
+            return value
+        elif op in [">", ">="]:
+            return value - epsilon
+        elif op in ["<", "<="]:
+            return value + epsilon
+        else:
+            raise ValueError(f"Unsupported operator: {op}")
+                
+    def create_placeholder_values(result, placeholder_query):
+        """Fill the placeholder column for all the sampled rows at once.
+        
+        For each row, the value is drawn amongst the values of df[column] satisfying `column op threshold`, 
+        where column is the non-placeholder side and threshold is derived from the row value.
+        
+        - By default, df[column] is sorted once and, for each row, the candidates are a range (or two for !=) of the sorted values 
+        found by searchsorted. The values are then drawn uniformly in their range with one seeded generator.
+        - With compat_sampling, the draws are the same as with the former row by row implementation 
+        (candidates.sample(1, random_state=seed)): one boolean mask per distinct threshold, and the position drawn by a 
+        RandomState(seed) permutation of the number of candidates.
+
         Args:
-            row (dict): The row containing the values.
+            result (pd.DataFrame): The sampled rows.
             placeholder_query (dict): The placeholder query specifying the left and right column names and the operator.
 
         Raises:
-            ValueError: If the left column name is not found in the dataframe.
-            ValueError: If the right column name is not found in the dataframe.
+            ValueError: If a row has no candidate value.
 
         Returns:
-            dict: The updated row with the placeholder value filled.
+            pd.DataFrame: The rows with the placeholder column filled.
         """
         
         left, op, right = placeholder_query["left"]["column_name"], placeholder_query["op"]["op"], placeholder_query["right"]["column_name"]
         
-        def estimate_replacement_value_based_on_op(op, value):
-            epsilon = None
-            if str(value).isnumeric():
-                epsilon = 1
-            elif isinstance(value, pd.Timestamp):
-                epsilon = pd.Timedelta(days=1)
-            else:
-                raise ValueError(f"Unsupported value type {type(value)} for value {value}!")
-            
-            if op in ["=", "!=", "in"]:
-                return value
-            elif op in [">", ">="]:
-                return value - epsilon
-            elif op in ["<", "<="]:
-                return value + epsilon
-            else:
-                raise ValueError(f"Unsupported operator: {op}")
-        
         # Left is the placeholder, select random value in df[right]
         # x < p1
         if left not in df.columns:
-            logger.debug(f"Row: {row}")
-            subq = f"{right} {op} {repr(estimate_replacement_value_based_on_op(op, row[right]))}" 
-            logger.debug(f"subq: {subq}")
-            candidates = df.query(subq)[right]
-            if candidates.empty:
-                raise ValueError(f"Query {subq} returns no result!")
-            row[left] = candidates.sample(1, random_state=seed).item()
-        
+            placeholder, column = left, right
         # Right is the placeholder, select random value in df[left]
         elif right not in df.columns:
-            subq = f"{left} {op} {repr(estimate_replacement_value_based_on_op(op, row[left]))}" 
-            candidates = df.query(subq)[left]
-            if candidates.empty:
-                raise ValueError(f"Query {subq} returns no result!")
-            row[right] = candidates.sample(1, random_state=seed).item()
+            placeholder, column = right, left
+        else:
+            return result
+        
+        thresholds = [ estimate_replacement_value_based_on_op(op, value) for value in result[column] ]
+        candidates = df[column]
+        
+        def no_candidate(threshold):
+            return ValueError(f"Query {column} {op} {repr(threshold)} returns no result!")
+        
+        values = []
+        if compat_sampling:
+            positions = {}
+            for threshold in thresholds:
+                if op in ["=", "in"]: mask = candidates == threshold
+                elif op == "!=": mask = candidates != threshold
+                elif op == ">": mask = candidates > threshold
+                elif op == ">=": mask = candidates >= threshold
+                elif op == "<": mask = candidates < threshold
+                elif op == "<=": mask = candidates <= threshold
                 
-        return row
+                matches = candidates.to_numpy()[mask.to_numpy()]
+                if len(matches) == 0:
+                    raise no_candidate(threshold)
+                if len(matches) not in positions:
+                    positions[len(matches)] = np.random.RandomState(seed).permutation(len(matches))[0]
+                values.append(matches[positions[len(matches)]])
+        else:
+            sorted_candidates = candidates.dropna().sort_values(ignore_index=True)
+            n = len(sorted_candidates)
+            lower = sorted_candidates.searchsorted(thresholds, side="left")
+            upper = sorted_candidates.searchsorted(thresholds, side="right")
+            
+            # Candidates are sorted_candidates[start:end], except sorted_candidates[lower:upper] for !=
+            if op in ["=", "in"]: start, end = lower, upper
+            elif op == "!=": start, end = np.zeros(len(thresholds), dtype=int), n - (upper - lower)
+            elif op == ">": start, end = upper, np.full(len(thresholds), n)
+            elif op == ">=": start, end = lower, np.full(len(thresholds), n)
+            elif op == "<": start, end = np.zeros(len(thresholds), dtype=int), lower
+            elif op == "<=": start, end = np.zeros(len(thresholds), dtype=int), upper
+            
+            empty = np.flatnonzero(end <= start)
+            if len(empty) > 0:
+                raise no_candidate(thresholds[empty[0]])
+            
+            rng = np.random.default_rng(seed)
+            positions = start + (rng.random(len(thresholds)) * (end - start)).astype(int)
+            if op == "!=":
+                positions = np.where(positions >= lower, positions + (upper - lower), positions)
+            values = sorted_candidates.to_numpy()[positions]
+        
+        result = result.copy()
+        result[placeholder] = list(values)
+        return result
                     
     non_placeholder_queries = []
     non_placeholder_names = set()
@@ -952,8 +1782,8 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
         
         if not _traverseAgg(algebra, has_only_placeholder):
             logger.debug("Filtering on placeholder columns...")
-            query = translate_query(algebra)    
-            df = df.query(query)
+            logger.debug(f"Filter: {translate_query(algebra)}")
+            df = df[compile_algebra(algebra)(df)]
     
     if df.empty:
         raise ValueError("No results after filtering...")
@@ -964,12 +1794,12 @@ def create_workload_value_selection_with_constraints(ctx: click.Context, value_s
     # Get a value for the placeholder
     for placeholder_query in non_placeholder_queries:
         logger.debug(f"Placeholder query: {placeholder_query}")
-        result = result.apply(lambda row: create_placeholder_value(row, placeholder_query), axis=1) 
+        result = create_placeholder_values(result, placeholder_query)
     
     # Remove placeholder columns
     result.drop(columns=non_placeholder_names, axis=1, inplace=True)
     if workload_value_selection:
-        result.to_csv(workload_value_selection, index=False)
+        write_table(result, workload_value_selection)
     return result
 
 
@@ -0,0 +1,289 @@
+"""Persistent cache of SPARQL query results.
+
+The same queries are sent many times against the same data (value selection after a clean, stats, tests).
+Results are stored in a SQLite database, keyed by (endpoint, dataset fingerprint, normalized query hash).
+
+- The dataset fingerprint identifies the data loaded in Virtuoso: it is derived from the marker file written by
+  the ingest_data rule (virtuoso-data-batch<id>-ok.txt), so re-ingesting a batch invalidates its entries,
+  while editing unrelated parts of the config does not. Without fingerprint, queries are not cached.
+- The database is bounded (FEDSHOP_RESULT_CACHE_MAX_MB), least recently used entries are evicted first.
+  Results larger than FEDSHOP_RESULT_CACHE_MAX_ENTRY_MB are not cached. Streamed results are compressed while they are read
+  and spooled to a temporary file, see CachingReader.
+- FEDSHOP_CACHE_DIR sets the location, FEDSHOP_RESULT_CACHE=0 disables the cache.
+- `python fedshop/result_cache.py stats|list|purge|clear` to inspect or purge the cache.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+import click
+
+CACHE_DIR = os.environ.get("FEDSHOP_CACHE_DIR", ".fedshop_cache")
+CACHE_ENABLED = os.environ.get("FEDSHOP_RESULT_CACHE", "1") != "0"
+CACHE_MAX_BYTES = int(float(os.environ.get("FEDSHOP_RESULT_CACHE_MAX_MB", 2048)) * 1024 * 1024)
+CACHE_MAX_ENTRY_BYTES = int(float(os.environ.get("FEDSHOP_RESULT_CACHE_MAX_ENTRY_MB", 256)) * 1024 * 1024)
+# Compressed bytes of a streamed result kept in memory before spooling to disk, see CachingReader
+SPOOL_MAX_BYTES = 1024 * 1024
+
+# Literals (long ones first) and IRIs are matched as a whole, so that whitespace and # inside them are kept
+QUERY_TOKEN = re.compile(
+    r'(?P<literal>"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*')"
+    r'|(?P<iri><[^<>"{}|^`\\\s]*>)'
+    r"|(?P<comment>#[^\n]*)"
+    r"|(?P<space>\s+)"
+    r"|(?P<other>[^\s\"'<#]+|.)",
+    re.DOTALL
+)
+
+@click.group
+def cli():
+    pass
+
+def normalize_query(query):
+    """Normalize a query before hashing: comments are dropped and whitespace is collapsed, except inside literals and IRIs.
+    """
+    tokens = []
+    for match in QUERY_TOKEN.finditer(str(query)):
+        if match.lastgroup in ("comment", "space"):
+            if len(tokens) > 0 and tokens[-1] != " ":
+                tokens.append(" ")
+        else:
+            tokens.append(match.group())
+    return "".join(tokens).strip()
+
+def query_hash(query):
+    return hashlib.sha256(normalize_query(query).encode()).hexdigest()
+
+def dataset_fingerprint(workdir, batch_id):
+    """Fingerprint of the data ingested for a batch.
+
+    Args:
+        workdir (str): the experiment directory, e.g. experiments/bsbm.
+        batch_id (int): the batch.
+
+    Returns:
+        str: the fingerprint, or None if the batch has not been ingested through snakemake.
+    """
+    marker = Path(workdir) / f"virtuoso-data-batch{batch_id}-ok.txt"
+    if not marker.exists():
+        return None
+    hasher = hashlib.sha256(f"batch{batch_id}".encode())
+    hasher.update(str(marker.stat().st_mtime_ns).encode())
+    hasher.update(marker.read_bytes())
+    return hasher.hexdigest()[:16]
+
+class ResultCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, max_entry_bytes=CACHE_MAX_ENTRY_BYTES, enabled=CACHE_ENABLED):
+        self.path = os.path.join(cache_dir, "results.sqlite")
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.enabled = enabled
+        self._conn = None
+        # The connection is shared by the threads running subqueries
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # Several snakemake jobs share the database
+            self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "   key TEXT PRIMARY KEY, endpoint TEXT, fingerprint TEXT, query TEXT,"
+                "   size INTEGER, created REAL, last_access REAL, data BLOB"
+                ")"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results(last_access)")
+        return self._conn
+
+    @staticmethod
+    def make_key(endpoint, fingerprint, query):
+        return f"{endpoint}|{fingerprint}|{query_hash(query)}"
+
+    def get(self, endpoint, fingerprint, query):
+        """Lookup the result of a query.
+
+        Returns:
+            bytes: the raw result, or None if not cached.
+        """
+        if not self.enabled or fingerprint is None:
+            return None
+
+        key = self.make_key(endpoint, fingerprint, query)
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        return zlib.decompress(row[0])
+
+    def set(self, endpoint, fingerprint, query, data):
+        if not self.enabled or fingerprint is None:
+            return
+
+        if len(data) > self.max_entry_bytes:
+            return
+        self.set_compressed(endpoint, fingerprint, query, zlib.compress(data, 1))
+
+    def set_compressed(self, endpoint, fingerprint, query, compressed):
+        """Store a result already compressed with zlib, see CachingReader.
+        """
+        if not self.enabled or fingerprint is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.make_key(endpoint, fingerprint, query), endpoint, fingerprint, normalize_query(query), len(compressed), now, now, compressed)
+            )
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """Remove the least recently used entries until the cache fits in max_bytes.
+
+        Returns:
+            int: the number of removed entries.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def _evict(self, max_bytes):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        removed = 0
+        for key, size in self.conn.execute("SELECT key, size FROM results ORDER BY last_access").fetchall():
+            if total <= max_bytes:
+                break
+            self.conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+            removed += 1
+        return removed
+
+    def purge(self, endpoint=None, fingerprint=None, older_than=None):
+        """Remove the entries matching all given criteria.
+
+        Args:
+            endpoint (str, optional): only entries of this endpoint.
+            fingerprint (str, optional): only entries of this dataset fingerprint.
+            older_than (float, optional): only entries not accessed for this number of seconds.
+
+        Returns:
+            int: the number of removed entries.
+        """
+        clauses, params = [], []
+        if endpoint is not None:
+            clauses.append("endpoint = ?")
+            params.append(endpoint)
+        if fingerprint is not None:
+            clauses.append("fingerprint = ?")
+            params.append(fingerprint)
+        if older_than is not None:
+            clauses.append("last_access < ?")
+            params.append(time.time() - older_than)
+        where = f"WHERE {' AND '.join(clauses)}" if len(clauses) > 0 else ""
+        with self._lock:
+            return self.conn.execute(f"DELETE FROM results {where}", params).rowcount
+
+class CachingReader:
+    """File-like wrapper that stores what is read from a stream in the cache once the stream is exhausted.
+
+    What is read is compressed on the fly and spooled to a temporary file beyond SPOOL_MAX_BYTES,
+    so the memory used does not grow with the size of the result.
+    Nothing is stored if the stream is larger than the maximum entry size.
+    """
+    def __init__(self, stream, cache: ResultCache, endpoint, fingerprint, query):
+        self.stream = stream
+        self.cache = cache
+        self.key = (endpoint, fingerprint, query)
+        self._compressor = zlib.compressobj(1)
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        self._size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if self._spool is not None:
+            self._size += len(data)
+            if self._size > self.cache.max_entry_bytes:
+                self.close()
+            else:
+                self._spool.write(self._compressor.compress(data))
+        if (len(data) == 0 or size is None or size < 0) and self._spool is not None:
+            self._spool.write(self._compressor.flush())
+            self._spool.seek(0)
+            self.cache.set_compressed(*self.key, self._spool.read())
+            self.close()
+        return data
+
+    def close(self):
+        """Stop caching, e.g. when the stream is not read until the end.
+        """
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+RESULT_CACHE = ResultCache()
+
+@cli.command()
+def stats():
+    """Print the number of entries and the size of the cache, per endpoint and fingerprint.
+    """
+    rows = RESULT_CACHE.conn.execute(
+        "SELECT endpoint, fingerprint, COUNT(*), SUM(size) FROM results GROUP BY endpoint, fingerprint ORDER BY endpoint"
+    ).fetchall()
+    total = 0
+    for endpoint, fingerprint, count, size in rows:
+        click.echo(f"{endpoint} [{fingerprint}]: {count} entries, {size/1024/1024:.1f} MB")
+        total += size
+    click.echo(f"Total: {total/1024/1024:.1f} MB / {RESULT_CACHE.max_bytes/1024/1024:.0f} MB ({RESULT_CACHE.path})")
+
+@cli.command(name="list")
+@click.option("--limit", type=click.INT, default=20)
+def list_entries(limit):
+    """List the most recently used entries.
+    """
+    rows = RESULT_CACHE.conn.execute(
+        "SELECT endpoint, fingerprint, size, last_access, query FROM results ORDER BY last_access DESC LIMIT ?", (limit,)
+    ).fetchall()
+    for endpoint, fingerprint, size, last_access, query in rows:
+        click.echo(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_access))} {endpoint} [{fingerprint}] {size/1024:.1f} KB: {query[:100]}")
+
+@cli.command()
+@click.option("--endpoint", type=click.STRING)
+@click.option("--fingerprint", type=click.STRING)
+@click.option("--older-than", type=click.FLOAT, help="Remove entries not used for this number of days.")
+@click.option("--max-mb", type=click.FLOAT, help="Evict least recently used entries until the cache fits.")
+def purge(endpoint, fingerprint, older_than, max_mb):
+    """Remove entries matching the criteria.
+    """
+    if max_mb is not None:
+        removed = RESULT_CACHE.evict(int(max_mb * 1024 * 1024))
+    else:
+        if endpoint is None and fingerprint is None and older_than is None:
+            raise click.UsageError("Nothing to purge, use `clear` to remove everything")
+        removed = RESULT_CACHE.purge(endpoint=endpoint, fingerprint=fingerprint, older_than=older_than*86400 if older_than is not None else None)
+    RESULT_CACHE.conn.execute("VACUUM")
+    click.echo(f"Removed {removed} entries")
+
+@cli.command()
+def clear():
+    """Remove all entries.
+    """
+    removed = RESULT_CACHE.purge()
+    RESULT_CACHE.conn.execute("VACUUM")
+    click.echo(f"Removed {removed} entries")
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,379 @@
+"""Offline source selection, computed from the generated N-Quads instead of the Virtuoso containers.
+
+`build` scans the dataset (model/dataset/*.nq, compressed or not) once and stores, for each graph (federation member):
+
+- the predicates and the classes (objects of rdf:type) it uses,
+- for each predicate, the 64-bit hashes of its subjects and of its IRI objects, sorted.
+
+With the index, the relevant sources of a triple pattern (the sources having at least one matching triple, as an ASK
+query per source would tell) are exact for patterns whose constants are IRIs. Literal objects are not indexed,
+a pattern with a literal object is only checked through its predicate.
+
+Sources can also be restricted by the joins of a BGP: a source is kept for a pattern only if the values of each
+join variable in this source meet the values of the same variable in the sources kept for the other patterns,
+until nothing changes. The result contains the sources of the RSA provenance (sources contributing to at least one
+result), it is an upper bound since the values of a variable are not restricted by the constants of its pattern.
+
+Batches follow ingest-data.smk: batch k is made of vendor0..vendor{10(k+1)-1} and ratingsite0..ratingsite{10(k+1)-1}.
+
+Usage:
+    python fedshop/source_index.py build experiments/bsbm/model/dataset experiments/bsbm/model/source_index.npz
+    python fedshop/source_index.py source-selection <injected.sparql> experiments/bsbm/model/source_index.npz <outfile> --batch-id 9 --joins
+"""
+
+import csv
+from functools import partial
+import json
+import os
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from rdflib import RDF, URIRef, Variable
+from rdflib.plugins.sparql.algebra import _traverseAgg, translatePath, translatePName, translatePrologue, traverse
+from rdflib.plugins.sparql.parserutils import CompValue
+from tqdm import tqdm
+
+from compression import list_datafiles, open_nquads
+from utils import fedshop_logger
+logger = fedshop_logger(Path(__file__).name)
+
+MEMBERS_PER_BATCH = 10
+RDF_TYPE = f"<{RDF.type}>"
+
+@click.group
+def cli():
+    pass
+
+def hash_terms(terms):
+    """64-bit hashes of terms in N-Triples syntax, e.g. <http://www.vendor0.fr/Offer1>.
+
+    Args:
+        terms (Iterable[str]): the terms.
+
+    Returns:
+        np.ndarray: the hashes (uint64).
+    """
+    return pd.util.hash_pandas_object(pd.Series(terms, dtype=object), index=False).to_numpy()
+
+def batch_members(batch_id):
+    """Stems of the data files ingested for a batch, see get_data_files in ingest-data.smk.
+    """
+    n_members = MEMBERS_PER_BATCH * (batch_id + 1)
+    return [ f"vendor{i}" for i in range(n_members) ] + [ f"ratingsite{i}" for i in range(n_members) ]
+
+def read_nquads(path, chunksize=1000000):
+    """Read a N-Quads file generated by WatDiv by chunks, decompressing it on the fly, see open_nquads.
+
+    Yields:
+        pd.DataFrame: the columns s, p, o, g, in N-Triples syntax.
+    """
+    with open_nquads(path) as nq_fs:
+        chunks = pd.read_csv(
+            nq_fs, sep="\t", header=None, names=["s", "p", "o", "g"], dtype=str,
+            quoting=csv.QUOTE_NONE, na_filter=False, chunksize=chunksize
+        )
+        for chunk in chunks:
+            chunk["g"] = chunk["g"].str.replace(r"\s*\.\s*$", "", regex=True)
+            yield chunk
+
+class SourceIndex:
+    """Per graph summaries of the dataset, see the module docstring.
+
+    Args:
+        graphs (list[str]): the graph IRIs.
+        files (list[str]): the stem of the data file of each graph, e.g. vendor0.
+        predicates (list[set]): the predicates of each graph.
+        classes (list[set]): the classes of each graph.
+        subjects (dict): (graph id, predicate) -> sorted hashes of the subjects.
+        objects (dict): (graph id, predicate) -> sorted hashes of the IRI objects.
+        literal_objects (set): the (graph id, predicate) having literal objects.
+    """
+    def __init__(self, graphs, files, predicates, classes, subjects, objects, literal_objects):
+        self.graphs = graphs
+        self.files = files
+        self.predicates = predicates
+        self.classes = classes
+        self.subjects = subjects
+        self.objects = objects
+        self.literal_objects = literal_objects
+
+    @classmethod
+    def build(cls, datafiles, chunksize=1000000):
+        """Scan the N-Quads files.
+
+        Args:
+            datafiles (list[str]): the files.
+            chunksize (int, optional): number of quads read at once. Defaults to 1000000.
+        """
+        graphs, files, predicates, classes = [], [], [], []
+        subjects, objects, literal_objects = {}, {}, set()
+        graph_ids = {}
+
+        for datafile in tqdm(datafiles):
+            subject_chunks, object_chunks = {}, {}
+            for chunk in read_nquads(datafile, chunksize=chunksize):
+                s_hashes = hash_terms(chunk["s"])
+                o_hashes = hash_terms(chunk["o"])
+                is_iri = chunk["o"].str.startswith("<").to_numpy()
+
+                for (graph, predicate), rows in chunk.groupby(["g", "p"], sort=False).indices.items():
+                    graph_id = graph_ids.get(graph)
+                    if graph_id is None:
+                        graph_id = graph_ids[graph] = len(graphs)
+                        graphs.append(graph.strip("<>"))
+                        files.append(Path(datafile).name.split(".")[0])
+                        predicates.append(set())
+                        classes.append(set())
+
+                    key = (graph_id, predicate.strip("<>"))
+                    predicates[graph_id].add(key[1])
+                    if predicate == RDF_TYPE:
+                        classes[graph_id].update(chunk["o"].iloc[rows].str.strip("<>").unique())
+
+                    iri_rows = rows[is_iri[rows]]
+                    if len(iri_rows) < len(rows):
+                        literal_objects.add(key)
+                    subject_chunks.setdefault(key, []).append(s_hashes[rows])
+                    object_chunks.setdefault(key, []).append(o_hashes[iri_rows])
+
+            # Files are summarized one by one to bound the memory
+            for key, chunks in subject_chunks.items():
+                subjects[key] = np.unique(np.concatenate(chunks))
+            for key, chunks in object_chunks.items():
+                objects[key] = np.unique(np.concatenate(chunks))
+
+        return cls(graphs, files, predicates, classes, subjects, objects, literal_objects)
+
+    def save(self, path):
+        keys = sorted(self.subjects.keys())
+        meta = {
+            "graphs": self.graphs,
+            "files": self.files,
+            "predicates": [ sorted(p) for p in self.predicates ],
+            "classes": [ sorted(c) for c in self.classes ],
+            "keys": keys,
+            "literal_objects": sorted(self.literal_objects)
+        }
+        arrays = {}
+        for i, key in enumerate(keys):
+            arrays[f"s{i}"] = self.subjects[key]
+            arrays[f"o{i}"] = self.objects[key]
+        # np.savez appends .npz to other file names
+        with open(path, "wb") as index_fs:
+            np.savez(index_fs, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            keys = [ tuple(key) for key in meta["keys"] ]
+            subjects = { key: data[f"s{i}"] for i, key in enumerate(keys) }
+            objects = { key: data[f"o{i}"] for i, key in enumerate(keys) }
+        return cls(
+            meta["graphs"], meta["files"], [ set(p) for p in meta["predicates"] ], [ set(c) for c in meta["classes"] ],
+            subjects, objects, set( tuple(key) for key in meta["literal_objects"] )
+        )
+
+    def batch_sources(self, batch_id=None):
+        """Ids of the graphs of a batch, all graphs if batch_id is None.
+        """
+        if batch_id is None:
+            return list(range(len(self.graphs)))
+        members = set(batch_members(batch_id))
+        return [ graph_id for graph_id, stem in enumerate(self.files) if stem in members ]
+
+    def _keys(self, graph_id, predicate):
+        if isinstance(predicate, URIRef):
+            return [(graph_id, str(predicate))] if str(predicate) in self.predicates[graph_id] else []
+        return [ (graph_id, p) for p in self.predicates[graph_id] ]
+
+    @staticmethod
+    def _contains(hashes, value):
+        position = np.searchsorted(hashes, value)
+        return position < len(hashes) and hashes[position] == value
+
+    def is_relevant(self, graph_id, triple):
+        """Whether a graph has a triple matching a pattern.
+
+        Args:
+            graph_id (int): the graph.
+            triple (tuple): subject, predicate, object as rdflib terms, variables are anything else than URIRef/Literal.
+        """
+        s, p, o = triple
+        keys = self._keys(graph_id, p)
+        if len(keys) == 0:
+            return False
+        if isinstance(p, URIRef) and p == RDF.type and isinstance(o, URIRef) and str(o) not in self.classes[graph_id]:
+            return False
+
+        s_hash = hash_terms([s.n3()])[0] if isinstance(s, URIRef) else None
+        o_hash = hash_terms([o.n3()])[0] if isinstance(o, URIRef) else None
+        for key in keys:
+            if s_hash is not None and not self._contains(self.subjects[key], s_hash):
+                continue
+            if o_hash is not None and not self._contains(self.objects[key], o_hash):
+                continue
+            return True
+        return False
+
+    def relevant_sources(self, triples, sources):
+        """Relevant sources of each triple pattern.
+
+        Args:
+            triples (list[tuple]): the triple patterns.
+            sources (list[int]): the candidate graphs, e.g. batch_sources(batch_id).
+
+        Returns:
+            list[list[int]]: the relevant graphs of each triple pattern.
+        """
+        return [ [ g for g in sources if self.is_relevant(g, triple) ] for triple in triples ]
+
+    def _values(self, graph_id, triple, var):
+        """Hashes of the values a variable can take in a pattern for one graph, None if unknown (literals).
+        """
+        s, p, o = triple
+        values = []
+        for key in self._keys(graph_id, p):
+            if s == var:
+                values.append(self.subjects[key])
+            elif o == var:
+                if key in self.literal_objects:
+                    return None
+                values.append(self.objects[key])
+            else:
+                return None
+        return np.unique(np.concatenate(values)) if len(values) > 0 else np.empty(0, dtype=np.uint64)
+
+    def join_restricted_sources(self, triples, sources):
+        """Relevant sources of each triple pattern of a BGP, restricted by the joins.
+
+        Args:
+            triples (list[tuple]): the triple patterns, joined.
+            sources (list[int]): the candidate graphs.
+
+        Returns:
+            list[list[int]]: the graphs of each triple pattern.
+        """
+        selection = [ set(graph_ids) for graph_ids in self.relevant_sources(triples, sources) ]
+        variables = {}
+        for tp_id, triple in enumerate(triples):
+            for term in (triple[0], triple[2]):
+                if isinstance(term, Variable):
+                    variables.setdefault(term, set()).add(tp_id)
+
+        joins = { var: sorted(tp_ids) for var, tp_ids in variables.items() if len(tp_ids) > 1 }
+        values = {}
+        def get_values(tp_id, graph_id, var):
+            key = (tp_id, graph_id, var)
+            if key not in values:
+                values[key] = self._values(graph_id, triples[tp_id], var)
+            return values[key]
+
+        changed = True
+        while changed:
+            changed = False
+            for var, tp_ids in joins.items():
+                for tp_id in tp_ids:
+                    for other_id in tp_ids:
+                        if other_id == tp_id:
+                            continue
+                        other_values = [ get_values(other_id, g, var) for g in selection[other_id] ]
+                        if any( v is None for v in other_values ):
+                            continue
+                        other_values = np.unique(np.concatenate(other_values)) if len(other_values) > 0 else np.empty(0, dtype=np.uint64)
+                        for graph_id in list(selection[tp_id]):
+                            graph_values = get_values(tp_id, graph_id, var)
+                            if graph_values is not None and not np.isin(graph_values, other_values, assume_unique=True).any():
+                                selection[tp_id].remove(graph_id)
+                                changed = True
+
+        return [ sorted(graph_ids) for graph_ids in selection ]
+
+def query_triples(queryfile):
+    """Triple patterns of a query, in the order of decompose-query (tp0, tp1, ...).
+
+    Returns:
+        tuple: the triples (rdflib terms, prefixes are resolved) and whether the query is a single BGP,
+            i.e. without OPTIONAL, UNION, MINUS or subqueries.
+    """
+    from query import parse_query_proc
+
+    algebra, _ = parse_query_proc(queryfile=queryfile)
+    prologue = translatePrologue(algebra[0], None)
+    query = traverse(algebra[1], visitPost=partial(translatePName, prologue=prologue))
+    query = traverse(query, visitPost=translatePath)
+
+    def collect(node, children):
+        if isinstance(node, CompValue):
+            if node.name == "TriplesBlock":
+                children.append([ tuple(triple[:3]) for triple in node["triples"] ])
+            elif node.name in ["OptionalGraphPattern", "GroupOrUnionGraphPattern", "MinusGraphPattern", "SubSelect"]:
+                children.append([None])
+        return [ item for child in children if isinstance(child, list) for item in child ]
+
+    items = _traverseAgg(query, collect)
+    triples = [ item for item in items if item is not None ]
+    return triples, len(triples) == len(items)
+
+def source_selection_table(index: SourceIndex, selection):
+    """Source selection in the format of the engines' provenance.csv: one column per triple pattern.
+    """
+    return pd.DataFrame({
+        f"tp{tp_id}": pd.Series([ index.graphs[g] for g in graph_ids ], dtype=object)
+        for tp_id, graph_ids in enumerate(selection)
+    })
+
+@cli.command()
+@click.argument("datadir", type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.argument("outfile", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+@click.option("--datafiles", type=click.STRING, default="*.nq*", help="Glob of the data files in datadir, plain or compressed.")
+@click.option("--chunksize", type=click.INT, default=1000000, help="Number of quads read at once.")
+def build(datadir, outfile, datafiles, chunksize):
+    """Build the source index of a dataset, e.g. experiments/bsbm/model/dataset.
+
+    Args:
+        datadir (str): the directory of the N-Quads files.
+        outfile (str): the index file.
+        datafiles (str): glob of the data files.
+        chunksize (int): number of quads read at once.
+    """
+    files = list_datafiles(datadir, datafiles)
+    if len(files) == 0:
+        raise FileNotFoundError(f"No {datafiles} file in {datadir}")
+
+    index = SourceIndex.build(files, chunksize=chunksize)
+    index.save(outfile)
+    logger.info(f"Indexed {len(index.graphs)} graphs from {len(files)} files into {outfile} ({os.stat(outfile).st_size/1024/1024:.1f} MB)")
+
+@cli.command()
+@click.argument("queryfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("index", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("outfile", type=click.Path(exists=False, file_okay=True, dir_okay=False))
+@click.option("--batch-id", type=click.INT, default=None, help="Only the sources of this batch. Defaults to all sources.")
+@click.option("--joins", is_flag=True, default=False, help="Restrict the sources by the joins, for queries made of one BGP.")
+def source_selection(queryfile, index, outfile, batch_id, joins):
+    """Write the sources of each triple pattern of a query, as the engines' provenance.csv.
+
+    Args:
+        queryfile (str): the query, e.g. injected.sparql.
+        index (str): the index written by build.
+        outfile (str): the source selection.
+        batch_id (int): the batch.
+        joins (bool): restrict the sources by the joins.
+    """
+    source_index = SourceIndex.load(index)
+    triples, is_bgp = query_triples(queryfile)
+    sources = source_index.batch_sources(batch_id)
+    if joins and not is_bgp:
+        logger.warning(f"{queryfile} is not a single BGP, the sources are not restricted by the joins")
+
+    if joins and is_bgp:
+        selection = source_index.join_restricted_sources(triples, sources)
+    else:
+        selection = source_index.relevant_sources(triples, sources)
+    source_selection_table(source_index, selection).to_csv(outfile, index=False)
+
+if __name__ == "__main__":
+    cli()
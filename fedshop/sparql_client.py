@@ -0,0 +1,124 @@
+"""Shared HTTP client for SPARQL endpoints and the proxy.
+
+One keep-alive `requests.Session` is kept per endpoint (scheme + host + port), so that consecutive queries reuse
+the same connections instead of opening a new one each time.
+
+- Pool size, retries and backoff are set with FEDSHOP_HTTP_POOL_SIZE, FEDSHOP_HTTP_RETRIES and FEDSHOP_HTTP_BACKOFF.
+  Read errors (e.g. a timeout while the endpoint evaluates the query) are never retried, and measured queries are sent
+  with retry=False so that their time is the time of a single request.
+- Queries are sent with GET, or POST when the encoded URL would be longer than MAX_GET_LENGTH.
+- gzip/deflate compressed responses are accepted and decoded transparently, also when streaming.
+"""
+
+import os
+import threading
+from urllib.parse import urlencode, urlsplit
+
+# requests is imported with the first session: this module is loaded by every command, most never send a query
+
+MAX_GET_LENGTH = 2048
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class SPARQLClient:
+    def __init__(self, pool_size=10, retries=3, backoff=0.5):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url, retry=True):
+        """Get the keep-alive session for the endpoint of an URL.
+
+        Args:
+            url (str): the URL.
+            retry (bool, optional): whether failed requests are retried. Defaults to True.
+
+        Returns:
+            requests.Session: the session.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc, retry)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+                max_retries = Retry(
+                    total=self.retries, backoff_factor=self.backoff, status_forcelist=RETRY_STATUS,
+                    read=0, allowed_methods=["GET", "POST"], raise_on_status=False
+                ) if retry else Retry(total=0, raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=max_retries)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Accept-Encoding": "gzip, deflate"})
+                self._sessions[key] = session
+        return session
+
+    def get(self, url, retry=True, **kwargs):
+        return self.session(url, retry=retry).get(url, **kwargs)
+
+    def query(self, query, endpoint, method=None, timeout=None, default_graph=None, accept="text/csv", stream=False, retry=True):
+        """Send a SPARQL query.
+
+        Args:
+            query (str): the query.
+            endpoint (str): the SPARQL endpoint.
+            method (str, optional): "GET" or "POST". Defaults to None, meaning GET unless the query is too long for an URL.
+            timeout (float, optional): timeout in seconds. Defaults to None.
+            default_graph (str, optional): the default graph URI. Defaults to None.
+            accept (str, optional): the result format. Defaults to "text/csv".
+            stream (bool, optional): if set, the body is not read, use Response.raw or Response.iter_content. Defaults to False.
+            retry (bool, optional): whether connection errors and error statuses are retried. Defaults to True.
+
+        Raises:
+            requests.HTTPError: the endpoint answered with an error.
+
+        Returns:
+            requests.Response: the response.
+        """
+        params = {"query": query}
+        if default_graph is not None:
+            params["default-graph-uri"] = default_graph
+
+        if method is None:
+            method = "GET" if len(endpoint) + len(urlencode(params)) + 1 <= MAX_GET_LENGTH else "POST"
+
+        session = self.session(endpoint, retry=retry)
+        headers = {"Accept": accept}
+        if method.upper() == "GET":
+            response = session.get(endpoint, params=params, headers=headers, timeout=timeout, stream=stream)
+        else:
+            response = session.post(endpoint, data=params, headers=headers, timeout=timeout, stream=stream)
+
+        response.raise_for_status()
+        if stream:
+            # Let urllib3 decompress the body when it is read from Response.raw
+            response.raw.decode_content = True
+        return response
+
+    def ping(self, endpoint):
+        """Check an endpoint, without retry and ignoring proxy environment variables.
+
+        Returns:
+            int: the HTTP status code, -1 if the endpoint is unreachable.
+        """
+        import requests
+        try:
+            return self.get(endpoint, retry=False, proxies={"http": "", "https": ""}).status_code
+        except requests.exceptions.RequestException:
+            return -1
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+SPARQL_CLIENT = SPARQLClient(
+    pool_size=int(os.environ.get("FEDSHOP_HTTP_POOL_SIZE", 10)),
+    retries=int(os.environ.get("FEDSHOP_HTTP_RETRIES", 3)),
+    backoff=float(os.environ.get("FEDSHOP_HTTP_BACKOFF", 0.5))
+)
@@ -1,4 +1,6 @@
 import ast
+from contextlib import contextmanager
+import fcntl
 import importlib
 from io import BytesIO
 import json
@@ -8,18 +10,14 @@ import re
 import subprocess
 import sys
 import time
-import colorlog
-import numpy as np
-import requests
-from scipy.stats import norm, truncnorm
-from omegaconf import OmegaConf
-import psutil
-import pandas as pd
-from rdflib import Literal, URIRef
 
 import logging
 
+# Every command imports this module: pandas, omegaconf, psutil and requests (sparql_client) are imported
+# by the functions that use them, so that starting a command stays cheap
+
 def fedshop_logger(logname):
+    import colorlog
     logger = logging.getLogger(logname)
     logger.setLevel(logging.DEBUG)
 
@@ -50,6 +48,169 @@ def docker_check_container_running(container_name):
     except subprocess.CalledProcessError:
         return False
 
+def wait_for_endpoint(endpoint, timeout=None):
+    """Poll a SPARQL endpoint until it answers, with an increasing interval (0.1s to 1s).
+
+    Returns:
+        bool: True if the endpoint answered before the timeout (in seconds).
+    """
+    from sparql_client import SPARQL_CLIENT
+    start = time.perf_counter()
+    interval = 0.1
+    while SPARQL_CLIENT.ping(endpoint) != 200:
+        if timeout is not None and time.perf_counter() - start > timeout:
+            return False
+        LOGGER.debug(f"Waiting for {endpoint} to start...")
+        time.sleep(interval)
+        interval = min(interval * 2, 1)
+    return True
+
+@contextmanager
+def container_switch_lock(compose_file, switch_log=None):
+    """File lock held while the containers of a compose file are stopped or started, see activate_container.
+    """
+    lock_file = f"{switch_log}.lock" if switch_log is not None else f"/tmp/fedshop-{Path(compose_file).stem}.lock"
+    Path(lock_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, "w") as lock_fs:
+        fcntl.flock(lock_fs, fcntl.LOCK_EX)
+        yield
+
+def activate_container(container_name, compose_file, endpoint, switch_log=None):
+    """Make sure that a container is the running one among the containers of a compose file.
+
+    If the container is not running, the containers of the compose file are stopped, the container is started,
+    and the endpoint is polled until it answers. Concurrent jobs switch one at a time (file lock on switch_log),
+    so a job waiting for the lock finds the container running and does not switch again.
+
+    Args:
+        container_name (str): the container, e.g. docker-bsbm-virtuoso-2.
+        compose_file (str): the compose file defining the container.
+        endpoint (str): the endpoint served by the container.
+        switch_log (str, optional): CSV file to which the duration of each switch is appended, see container_switch_report.
+
+    Returns:
+        bool: whether the container had to be started.
+    """
+    if docker_check_container_running(container_name):
+        return False
+
+    with container_switch_lock(compose_file, switch_log):
+        if docker_check_container_running(container_name):
+            return False
+
+        start = time.perf_counter()
+        subprocess.run(f"docker compose -f {compose_file} stop", shell=True, check=True)
+        stopped = time.perf_counter()
+        subprocess.run(f"docker start {container_name}", shell=True, check=True)
+        started = time.perf_counter()
+        wait_for_endpoint(endpoint)
+        ready = time.perf_counter()
+
+        LOGGER.info(f"Switched to {container_name} in {ready - start:.1f}s (stop {stopped - start:.1f}s, start {started - stopped:.1f}s, warm-up {ready - started:.1f}s)")
+        if switch_log is not None:
+            new_file = not os.path.exists(switch_log)
+            with open(switch_log, "a") as log_fs:
+                if new_file:
+                    log_fs.write("timestamp,container,stop_time,start_time,warmup_time,switch_time\n")
+                log_fs.write(f"{time.time():.0f},{container_name},{stopped - start:.3f},{started - stopped:.3f},{ready - started:.3f},{ready - start:.3f}\n")
+    return True
+
+def clone_container_database(source_container, target_container, compose_file, switch_log=None, database_dir="/database"):
+    """Copy the Virtuoso database of a container into another one.
+
+    Both containers are stopped, so the database files are consistent (Virtuoso checkpoints when it shuts down).
+    The database directory of the target is emptied first, from a throwaway container sharing its volumes,
+    so that no file of an earlier start (virtuoso.trx, .pxa, temp DB) is replayed over the copy.
+    Then the database directory is streamed from one container to the other with `docker cp`.
+
+    Args:
+        source_container (str): the container to copy from, e.g. docker-bsbm-virtuoso-1.
+        target_container (str): the container to copy to, created beforehand.
+        compose_file (str): the compose file defining the containers.
+        switch_log (str, optional): the log of activate_container, whose lock is held during the copy.
+        database_dir (str, optional): the database directory in the containers.
+
+    Raises:
+        RuntimeError: the database directory of the target is not a volume, so it cannot be emptied.
+
+    Returns:
+        float: the duration of the copy, in seconds.
+    """
+    with container_switch_lock(compose_file, switch_log):
+        start = time.perf_counter()
+        subprocess.run(f"docker stop {source_container} {target_container}", shell=True, check=True, stdout=subprocess.DEVNULL)
+        mounts = subprocess.check_output(
+            f"docker inspect -f '{{{{range .Mounts}}}}{{{{println .Destination}}}}{{{{end}}}}' {target_container}", shell=True
+        ).decode().split()
+        if database_dir not in mounts:
+            raise RuntimeError(f"{database_dir} is not a volume of {target_container}, its stale files cannot be removed before the copy")
+        image = subprocess.check_output(f"docker inspect -f '{{{{.Config.Image}}}}' {target_container}", shell=True).decode().strip()
+        subprocess.run(
+            f"docker run --rm --volumes-from {target_container} --entrypoint /bin/sh {image} -c 'rm -rf {database_dir}/..?* {database_dir}/.[!.]* {database_dir}/*'",
+            shell=True, check=True
+        )
+        # `docker cp` archives the directory itself, extracting it at the root of the target recreates it
+        subprocess.run(
+            f"set -o pipefail; docker cp {source_container}:{database_dir} - | docker cp - {target_container}:{Path(database_dir).parent}",
+            shell=True, check=True, executable="/bin/bash"
+        )
+        duration = time.perf_counter() - start
+    LOGGER.info(f"Copied the database of {source_container} into {target_container} in {duration:.1f}s")
+    return duration
+
+def container_switch_report(switch_log, since=None):
+    """Number of switches and time spent switching, per container.
+
+    Args:
+        switch_log (str): the CSV file written by activate_container.
+        since (float, optional): only the switches after this timestamp.
+
+    Returns:
+        pd.DataFrame: one row per container and a total row, or None if there was no switch.
+    """
+    import pandas as pd
+    if not os.path.exists(switch_log):
+        return None
+    switches = pd.read_csv(switch_log)
+    if since is not None:
+        switches = switches[switches["timestamp"] >= since]
+    if switches.empty:
+        return None
+    report = switches.groupby("container").agg(
+        switches=("switch_time", "size"), stop_time=("stop_time", "sum"), start_time=("start_time", "sum"),
+        warmup_time=("warmup_time", "sum"), switch_time=("switch_time", "sum")
+    )
+    report.loc["total"] = report.sum()
+    return report.astype({"switches": int})
+
+def get_virtuoso_deployment(config):
+    """The Virtuoso deployment: "per_batch" (one container per batch, the default) or "single".
+
+    In the "single" deployment, one container loads the data of all batches once, and each batch is a graph group
+    (generation.virtuoso.batch_members) exposed by its own endpoint, see get_batch_endpoint.
+    """
+    return config["generation"]["virtuoso"].get("deployment", "per_batch")
+
+def get_batch_container(config, batch_id):
+    """Name of the Virtuoso container serving a batch.
+    """
+    service_name = config["generation"]["virtuoso"]["service_name"]
+    if get_virtuoso_deployment(config) == "single":
+        return f"docker-{service_name}-1"
+    return f"docker-{service_name}-{int(batch_id)+1}"
+
+def get_batch_endpoint(config, batch_id):
+    """SPARQL endpoint serving the data of a batch.
+
+    Returns:
+        str: the default endpoint of the batch's container, or in the "single" deployment,
+            http://localhost:<batch_port + batch_id>/batch<batch_id>/sparql.
+    """
+    virtuoso_config = config["generation"]["virtuoso"]
+    if get_virtuoso_deployment(config) == "single":
+        return f"http://localhost:{int(virtuoso_config['batch_port']) + int(batch_id)}/batch{batch_id}/sparql"
+    return virtuoso_config["default_endpoint"]
+
 def check_container_status(compose_file, service_name, container_name):
     if docker_check_container_running(container_name):
         return "running"
@@ -78,15 +239,20 @@ def get_docker_endpoints(compose_file, service_name):
     containers = get_virtuoso_containers(compose_file, service_name)
     return [get_docker_endpoint_by_container_name(c) for c in containers]
 
-# Register resolvers
-try:
-    OmegaConf.register_new_resolver("get_docker_endpoints", get_docker_endpoints)
-    OmegaConf.register_new_resolver("get_virtuoso_containers", get_virtuoso_containers)
-    OmegaConf.register_new_resolver("get_docker_endpoint", get_docker_endpoint_by_container_name)
-except Exception:
-    pass
+def register_resolvers():
+    """Register the resolvers of the configs, once omegaconf is needed."""
+    from omegaconf import OmegaConf
+    for name, resolver in [
+        ("get_docker_endpoints", get_docker_endpoints),
+        ("get_virtuoso_containers", get_virtuoso_containers),
+        ("get_docker_endpoint", get_docker_endpoint_by_container_name),
+    ]:
+        if not OmegaConf.has_resolver(name):
+            OmegaConf.register_new_resolver(name, resolver)
 
 def str2n3(value):
+    import pandas as pd
+    from rdflib import Literal, URIRef
     if str(value).startswith("http") or str(value).startswith("nodeID"): 
         return URIRef(value).n3()
     elif re.match(r"\d{4}-\d{2}-\d{2}", str(value)):
@@ -106,6 +272,8 @@ def load_config(filename, saveAs=None):
     Returns:
         [type]: [description]
     """
+    from omegaconf import OmegaConf
+    register_resolvers()
     
     custom_loader_file = f"{Path(filename).parent}/omega_conf.py"
     if os.path.exists(custom_loader_file):
@@ -143,6 +311,7 @@ def create_stats(statsfile, failed_reason=None):
     """Create stats.csv from metrics.txt files
     """
     
+    import pandas as pd
     baseDir = Path(statsfile).parent
     
     print(statsfile)
@@ -182,6 +351,7 @@ def create_stats(statsfile, failed_reason=None):
             fs.write(f"{','.join(result.values())}\n")    
     
 def kill_process(proc_pid):
+    import psutil
     try:
         process = psutil.Process(proc_pid)
         LOGGER.debug(f"Killing {process.pid} {process.name}")
@@ -194,14 +364,7 @@ def kill_process(proc_pid):
         pass
     
 def ping(endpoint):
-    proxies = {
-        "http": "",
-        "https": "",
-    }
-    try:
-        response = requests.get(endpoint, proxies=proxies)
-        # print(response.status_code, response.text)
-        return response.status_code
-    except: return -1
+    from sparql_client import SPARQL_CLIENT
+    return SPARQL_CLIENT.ping(endpoint)
 
 
@@ -11,39 +11,152 @@ This module contains the utility functions to create a proxy between each named
 
 - However, localhost:xxxx is not readily understandable thus hampers the development process.
 - This proxy aims to map SH_GRAPH_URIVARCHAR to SH_HOSTVARCHAR, e.g http://ex.org/swdf -> localhost:8895/sparql
+
+Statements are sent to one isql process per container, kept open for the lifetime of the command (see IsqlSession),
+instead of one `docker exec` per statement. FEDSHOP_ISQL_SESSION=0 falls back to one process per statement.
 """
 
+import atexit
+from fnmatch import fnmatch
+import glob
 from io import StringIO
+import json
 import os
 import re
 import subprocess
+import time
+from urllib.parse import urlsplit
+import uuid
 import click
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
+from compression import compress_file, get_compression, open_nquads, strip_compression
 from utils import LOGGER
 
 @click.group
 def cli():
     pass
 
+ISQL_SESSION_ENABLED = os.environ.get("FEDSHOP_ISQL_SESSION", "1") != "0"
+
+def isql_command(container_name, isql, *args, interactive=False):
+    isql = isql.strip('"')
+    if container_name:
+        return ["docker", "exec"] + (["-i"] if interactive else []) + [container_name, isql] + list(args)
+    return [isql] + list(args)
+
+class IsqlSession:
+    """An isql process reading statements from its standard input.
+
+    After the statements of a call, a marker query is sent: its result ends the output of the call.
+
+    Args:
+        container_name (str): the Virtuoso container, None to run isql locally.
+        isql (str): the path to the isql executable.
+    """
+    def __init__(self, container_name, isql):
+        self.proc = subprocess.Popen(
+            isql_command(container_name, isql, "BANNER=OFF", interactive=True),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+        )
+
+    def execute(self, statements):
+        """Execute statements, in order.
+
+        Args:
+            statements (list[str]): the SQL statements, with or without the trailing semicolon.
+
+        Raises:
+            RuntimeError: a statement failed, the other statements are executed anyway.
+
+        Returns:
+            str: the output of isql.
+        """
+        marker = f"fedshop-{uuid.uuid4().hex}"
+        script = "".join(f"{statement.strip().rstrip(';')};\n" for statement in statements)
+        self.proc.stdin.write(f"{script}SELECT concat('{marker}', '') AS fedshop_marker;\n")
+        self.proc.stdin.flush()
+
+        lines = self._read_until(lambda line: line.strip().endswith(marker))
+        # The footer of the marker query ("1 Rows. -- 0 msec.")
+        self._read_until(lambda line: re.search(r"\d+ Rows\.", line) is not None)
+        # Drop the header of the marker query
+        header = max([ i for i, line in enumerate(lines) if "fedshop_marker" in line ], default=len(lines))
+        lines = lines[:header]
+
+        output = "".join(lines)
+        errors = [ line.strip() for line in lines if "*** Error" in line ]
+        if len(errors) > 0:
+            raise RuntimeError("\n".join(errors))
+        return output
+
+    def _read_until(self, is_last):
+        lines = []
+        while True:
+            line = self.proc.stdout.readline()
+            if line == "":
+                raise RuntimeError(f"isql exited with code {self.proc.wait()}:\n{''.join(lines)}")
+            if is_last(line):
+                return lines
+            lines.append(line)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+ISQL_SESSIONS = {}
+
+def get_isql_session(container_name, isql):
+    """The open session for a container (or the local isql), created at first use.
+    """
+    key = (container_name, isql)
+    if key not in ISQL_SESSIONS:
+        ISQL_SESSIONS[key] = IsqlSession(container_name, isql)
+    return ISQL_SESSIONS[key]
+
+@atexit.register
+def close_isql_sessions():
+    for session in ISQL_SESSIONS.values():
+        session.close()
+    ISQL_SESSIONS.clear()
+
+def exec_statements(container_name, isql, statements):
+    """Execute statements in one call, through the session or, if disabled, one isql process per statement.
+
+    Returns:
+        str: the output of isql.
+    """
+    if ISQL_SESSION_ENABLED:
+        return get_isql_session(container_name, isql).execute(statements)
+
+    outputs = []
+    for statement in statements:
+        proc = subprocess.run(isql_command(container_name, isql, f"EXEC={statement}"), check=True, stdout=subprocess.PIPE)
+        outputs.append(proc.stdout.decode("utf-8"))
+    return "".join(outputs)
+
 @cli.command()
 @click.option("--container-name", type=click.STRING)
 @click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
 @click.option("--exec", type=click.STRING)
 @click.option("--return_output", is_flag=True, default=False)
 def isql_exec(container_name, isql, exec, return_output):
-    if not isql.startswith('"'):
-        isql = f'"{isql}"'
-    cmd = f'{isql} "EXEC={exec}"'
-    if container_name:
-        cmd = f'docker exec {container_name} {isql} "EXEC={exec}"'
-    
-    #click.echo (f"Executing command: {cmd}")
-    proc = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE)
+    output = exec_statements(container_name, isql, [exec])
     if return_output:
-        return proc.stdout.decode("utf-8")
+        return output
+
+@cli.command()
+@click.option("--container-name", type=click.STRING)
+@click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
+@click.argument("scriptfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def isql_script(container_name, isql, scriptfile):
+    """Execute a SQL script in one call, statements are separated by a semicolon at the end of a line.
+    """
+    with open(scriptfile, "r") as script_fs:
+        statements = [ statement for statement in re.split(r";\s*$", script_fs.read(), flags=re.M) if len(statement.strip()) > 0 ]
+    click.echo(exec_statements(container_name, isql, statements))
 
 @cli.command
 @click.option("--container-name", type=click.STRING)
@@ -194,6 +307,28 @@ def remove_sparql_endpoint(ctx: click.Context, container_name, isql, vhost, lhos
     exec_cmd = f"DELETE FROM DB.DBA.SYS_SPARQL_HOST WHERE SH_HOST = \'{vhost}:{lhost}\' ;"
     ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=exec_cmd)
     
+def sparql_endpoint_statements(host, graph_uri, lpath, on_duplicate):
+    """The statements creating an endpoint whose default graph is graph_uri, see create_sparql_endpoint.
+    """
+    vhost, vport = host.split(":")
+    lhost = f":{vport}"
+
+    statements = [
+        f"DB.DBA.VHOST_REMOVE(vhost=>\'{vhost}\', lhost=>\'{lhost}\', lpath=>\'{lpath}\') ;",
+        f"DELETE FROM DB.DBA.SYS_SPARQL_HOST WHERE SH_HOST = \'{vhost}:{lhost}\' ;",
+        f"DB.DBA.VHOST_DEFINE(vhost=>\'{vhost}\', lhost=>\'{lhost}\', lpath=>\'{lpath}\', ppath=>\'/!sparql/\', is_dav=>1, vsp_user=>\'dba\',opts=>vector (\'browse_sheet\', \'\', \'noinherit\', \'yes\')) ;"
+    ]
+
+    if vhost == "*ini*": vhost = "localhost"
+    if vport == "*ini*": vport = "8890"
+    sh_host = f"{vhost}:{vport}" # e.g localhost:8890/vendor0/sparql
+
+    insert_mode = "INTO"
+    if on_duplicate:
+        insert_mode = "REPLACING" if on_duplicate == "REPLACE" else "SOFT"
+    statements.append(f"INSERT {insert_mode} DB.DBA.SYS_SPARQL_HOST (SH_HOST, SH_GRAPH_URI) VALUES (\'{sh_host}\', \'{graph_uri}\');")
+    return statements
+
 @cli.command()
 @click.option("--container-name", type=click.STRING)
 @click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
@@ -201,23 +336,30 @@ def remove_sparql_endpoint(ctx: click.Context, container_name, isql, vhost, lhos
 @click.argument("graph-uri", type=click.STRING)
 @click.option("--lpath", type=click.STRING, default="/sparql")
 @click.option("--on-duplicate", type=click.Choice(["IGNORE", "REPLACE"]))
-@click.pass_context
-def create_sparql_endpoint(ctx: click.Context, container_name, isql, host, graph_uri, lpath, on_duplicate):
-    vhost, vport = host.split(":")
-    lhost = f":{vport}"
+def create_sparql_endpoint(container_name, isql, host, graph_uri, lpath, on_duplicate):
+    click.echo(f"Creating SPARQL endpoint {host}{lpath} for graph {graph_uri}.")
+    exec_statements(container_name, isql, sparql_endpoint_statements(host, graph_uri, lpath, on_duplicate))
 
-    ctx.invoke(remove_sparql_endpoint, container_name=container_name, isql=isql, vhost=vhost, lhost=lhost, lpath=lpath)
-    
-    exec_cmd = f"DB.DBA.VHOST_DEFINE(vhost=>\'{vhost}\', lhost=>\'{lhost}\', lpath=>\'{lpath}\', ppath=>\'/!sparql/\', is_dav=>1, vsp_user=>\'dba\',opts=>vector (\'browse_sheet\', \'\', \'noinherit\', \'yes\')) ;"
-    #exec_cmd = f"DB.DBA.VHOST_DEFINE(lpath=>\'{lpath}\', ppath=>\'/!sparql/\', is_dav=>1, vsp_user=>\'dba\',opts=>vector (\'browse_sheet\', \'\', \'noinherit\', \'yes\')) ;"
-    ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=exec_cmd)
+@cli.command()
+@click.option("--container-name", type=click.STRING)
+@click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
+@click.argument("mappingfile", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--on-duplicate", type=click.Choice(["IGNORE", "REPLACE"]))
+def create_sparql_endpoints(container_name, isql, mappingfile, on_duplicate):
+    """Create the endpoints of a proxy mapping (graph -> http://host:port/lpath) in one call.
 
-    #ctx.invoke(remove_sparql_host, container_name=container_name, isql=isql, graph_uri=graph_uri, host=host)
-    if vhost == "*ini*": vhost = "localhost"
-    if vport == "*ini*": vport = "8890"
-    sh_host = f"{vhost}:{vport}" # e.g localhost:8890/vendor0/sparql
+    Args:
+        mappingfile (str): the mapping, e.g. virtuoso-proxy-mapping-batch<k>.json.
+    """
+    with open(mappingfile, "r") as mapping_fs:
+        mapping = json.load(mapping_fs)
 
-    ctx.invoke(update_sparql_host, container_name=container_name, isql=isql, graph_uri=graph_uri, host=sh_host, on_duplicate=on_duplicate)
+    statements = []
+    for graph_uri, endpoint in mapping.items():
+        endpoint = urlsplit(endpoint)
+        statements.extend(sparql_endpoint_statements(endpoint.netloc, graph_uri, endpoint.path, on_duplicate))
+    exec_statements(container_name, isql, statements)
+    click.echo(f"Created {len(mapping)} SPARQL endpoints.")
 
 @cli.command()
 @click.option("--container-name", type=click.STRING)
@@ -283,38 +425,288 @@ def update_graph_group(ctx: click.Context, action, container_name, isql, graph_g
 
     ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=exec_cmd)
 
+@cli.command()
+@click.option("--container-name", type=click.STRING)
+@click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
+@click.option("--host", type=click.STRING, required=True, help="The host of the endpoint, e.g localhost:34100")
+@click.option("--lpath", type=click.STRING, default="/sparql")
+@click.option("--members", type=click.STRING, required=True, help="Comma-separated IRIs of the graphs of the batch.")
+@click.argument("graph-group", type=click.STRING)
+@click.pass_context
+def create_batch_endpoint(ctx: click.Context, container_name, isql, host, lpath, members, graph_group):
+    """
+    Expose the graphs of a batch through one endpoint, when one Virtuoso serves all batches.
+
+    The graph group is the default graph of the endpoint, and its members are the only named graphs,
+    so that queries with GRAPH clauses do not see the graphs of the other batches.
+
+    Args:
+        ctx (click.Context): The Click context.
+        container_name: The name of the container.
+        isql: The isql command.
+        host: The host of the endpoint.
+        lpath: The path of the endpoint.
+        members: The IRIs of the graphs of the batch.
+        graph_group: The IRI of the graph group of the batch.
+
+    Returns:
+        None
+    """
+    members = [ member.strip() for member in members.split(",") ]
+
+    ctx.invoke(create_graph_group, container_name=container_name, isql=isql, drop_first=True, graph_uri=graph_group)
+    exec_statements(container_name, isql, [
+        f"DB.DBA.RDF_GRAPH_GROUP_INS(group_iri=>\'{graph_group}\', memb_iri=>\'{member}\') ;" for member in members
+    ])
+
+    ctx.invoke(create_sparql_endpoint, container_name=container_name, isql=isql, host=host, graph_uri=graph_group, lpath=lpath, on_duplicate="REPLACE")
+
+    defines = " ".join(f"define input:named-graph-uri <{member}>" for member in members)
+    exec_cmd = f"UPDATE DB.DBA.SYS_SPARQL_HOST SET SH_DEFINES = \'{defines}\' WHERE SH_HOST = \'{host}\' ;"
+    ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=exec_cmd)
+
+LOAD_STATES = { 0: "waiting", 1: "loading", 2: "loaded" }
+
+def read_load_list(container_name, isql, datapath, datafiles):
+    """The entries of DB.DBA.load_list for the given files.
+
+    Args:
+        datapath (str): the directory of the files, as seen by Virtuoso.
+        datafiles (list[str]): the file names or masks, as given to ld_dir.
+
+    Returns:
+        pd.DataFrame: one row per file, with columns file, state, started, done, error.
+    """
+    datapath = datapath.rstrip("/")
+    output = exec_statements(container_name, isql, [
+        "SELECT concat(ll_file, '|', cast(ll_state AS VARCHAR), '|', coalesce(cast(ll_started AS VARCHAR), ''), '|', "
+        "coalesce(cast(ll_done AS VARCHAR), ''), '|', coalesce(ll_error, '')) AS load_entry "
+        f"FROM DB.DBA.load_list WHERE ll_file LIKE '{datapath}/%' ;"
+    ])
+
+    records = []
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith(datapath):
+            continue
+        ll_file, ll_state, ll_started, ll_done, ll_error = line.split("|", 4)
+        if not any(fnmatch(os.path.basename(ll_file), datafile) for datafile in datafiles):
+            continue
+        records.append({
+            "file": os.path.basename(ll_file), "state": LOAD_STATES.get(int(ll_state), ll_state),
+            "started": ll_started or None, "done": ll_done or None, "error": ll_error or None
+        })
+    return pd.DataFrame.from_records(records, columns=["file", "state", "started", "done", "error"])
+
+def count_triples(filename):
+    """Number of lines of a N-Quads file, plain or compressed, read in 1MB blocks."""
+    with open_nquads(filename, "rb") as fs:
+        return sum(block.count(b"\n") for block in iter(lambda: fs.read(1 << 20), b""))
+
+def count_graph_triples(filename):
+    """Number of distinct quads of each graph of a N-Quads file, i.e. the triples of each graph once loaded.
+
+    WatDiv writes the terms separated by tabs, the graph IRI is the 4th field (see source_index.read_nquads),
+    lines separated by spaces end with the graph IRI. Duplicated lines are counted once.
+
+    Returns:
+        dict: graph IRI -> number of triples.
+    """
+    quads = {}
+    with open_nquads(filename, "rb") as fs:
+        for line in fs:
+            line = line.strip()
+            if len(line) == 0 or line.startswith(b"#"):
+                continue
+            terms = line.rstrip(b".").rstrip().split(b"\t")
+            graph = terms[3].strip() if len(terms) >= 4 else terms[-1].rsplit(None, 1)[-1]
+            if not (graph.startswith(b"<") and graph.endswith(b">")):
+                continue
+            quads.setdefault(graph[1:-1].decode("utf-8"), set()).add(hash(line))
+    return { graph: len(lines) for graph, lines in quads.items() }
+
+def read_graph_counts(container_name, isql):
+    """Number of triples of each graph in Virtuoso.
+
+    Returns:
+        dict: graph IRI -> number of triples.
+    """
+    output = exec_statements(container_name, isql, [
+        "SELECT concat('graph|', id_to_iri(G), '|', cast(count(*) AS VARCHAR)) AS graph_count FROM DB.DBA.RDF_QUAD GROUP BY G ;"
+    ])
+    counts = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("graph|"):
+            graph, count = line[len("graph|"):].rsplit("|", 1)
+            counts[graph] = int(count)
+    return counts
+
 @cli.command()
 @click.option("--container-name", type=click.STRING)
 @click.option("--isql", type=click.STRING, default="/opt/virtuoso-opensource/bin/isql")
 @click.option("--datapath", type=click.STRING, default="/usr/share/proj/")
 @click.option("--datafiles", type=click.STRING, default="*.nq")
+@click.option("--loaders", type=click.INT, default=os.cpu_count(), help="Number of rdf_loader_run started at once. Defaults to the number of cores.")
+@click.option("--local-datapath", type=click.Path(exists=True, file_okay=False, dir_okay=True), default=None, help="The data directory on this machine, to count the triples. Defaults to --datapath.")
+@click.option("--report", type=click.Path(file_okay=True, dir_okay=False), default=None, help="JSON file receiving the ingestion report.")
+@click.option("--poll-interval", type=click.FLOAT, default=5)
+@click.option("--check-graphs", is_flag=True, default=False, help="Compare the triples of each graph with the content of the files, requires the local data.")
+@click.option("--previous-report", type=click.Path(exists=True, file_okay=True, dir_okay=False), default=None, help="Report of the ingestion this database was copied from, its graphs are expected unchanged.")
 @click.pass_context
-def ingest_data(ctx: click.Context, container_name, isql, datapath, datafiles):
+def ingest_data(ctx: click.Context, container_name, isql, datapath, datafiles, loaders, local_datapath, report, poll_interval, check_graphs, previous_report):
     """
     Ingests data into the Virtuoso RDF store.
 
+    The files are registered with ld_dir, then loaded by several rdf_loader_run, each in its own isql process.
+    DB.DBA.load_list is polled meanwhile to report the progress.
+
     Args:
         ctx (click.Context): The Click context object.
         container_name (str): The name of the Virtuoso container.
         isql (str): The path to the isql executable.
         datapath (str): The path to the directory containing the data files.
+        datafiles (str): Comma-separated file names or masks, plain (.nq) or compressed (.nq.gz, .nq.zst).
+        loaders (int): The number of loaders.
+        local_datapath (str): The data directory on this machine, used to count the triples.
+        report (str): The JSON file receiving the duration, triples, throughput and per-file state.
+        poll_interval (float): Seconds between two reads of the load list.
+        check_graphs (bool): Whether to check the number of triples of each graph after the load.
+            The expected numbers are those of the previous report, plus the distinct quads of the loaded files,
+            i.e. what a full load of all these files gives.
+        previous_report (str): The report of the ingestion the database was copied from, see check_graphs.
 
     Returns:
         None
     """
     datafiles = [ datafile.strip() for datafile in datafiles.split(",") ]
+    local_datapath = local_datapath or (datapath if container_name is None else None)
+    loaders = max(loaders or 1, 1)
+    if (check_graphs or previous_report is not None) and local_datapath is None:
+        raise click.UsageError("--check-graphs and --previous-report require --local-datapath")
+
+    # Virtuoso loads gzip files as is, zstd files are decompressed next to themselves for the time of the load
+    local_files, staged_files = {}, []
+    if any(get_compression(datafile) == "zstd" for datafile in datafiles):
+        if local_datapath is None:
+            raise click.UsageError("zstd data files require --local-datapath")
+        plain_datafiles = []
+        for datafile in datafiles:
+            if get_compression(datafile) != "zstd":
+                plain_datafiles.append(datafile)
+                continue
+            for local_file in sorted(glob.glob(os.path.join(local_datapath, datafile))):
+                staged_files.append(compress_file(local_file, "none", remove=False))
+                plain_datafile = os.path.basename(strip_compression(local_file))
+                local_files[plain_datafile] = local_file
+                plain_datafiles.append(plain_datafile)
+        datafiles = plain_datafiles
+
+    def get_local_file(datafile):
+        return local_files.get(datafile, os.path.join(local_datapath, datafile))
     
     # Grant permissions to the SPARQL user
-    ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec='grant select on \\\"DB.DBA.SPARQL_SINV_2\\\" to \\\"SPARQL\\\";')
-    ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec='grant execute on \\\"DB.DBA.SPARQL_SINV_IMP\\\" to \\\"SPARQL\\\";')
-
-    # Load the data
-    for datafile in tqdm(datafiles):
-        ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=f"ld_dir('{datapath}', '{datafile}', 'http://example.com/datasets/default');")    
-    
-    # Launch the ingest process and checkpoint
-    ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=f"rdf_loader_run(log_enable=>2);")
+    exec_statements(container_name, isql, [
+        'grant select on "DB.DBA.SPARQL_SINV_2" to "SPARQL";',
+        'grant execute on "DB.DBA.SPARQL_SINV_IMP" to "SPARQL";'
+    ])
+
+    # Register the files in one call
+    exec_statements(container_name, isql, [
+        f"ld_dir('{datapath}', '{datafile}', 'http://example.com/datasets/default');" for datafile in datafiles
+    ])
+
+    triples = {}
+    def loaded_triples(load_list):
+        if local_datapath is None:
+            return None
+        for datafile in load_list.loc[(load_list["state"] == "loaded") & load_list["error"].isna(), "file"]:
+            if datafile not in triples:
+                local_file = get_local_file(datafile)
+                triples[datafile] = count_triples(local_file) if os.path.exists(local_file) else 0
+        return sum(triples.values())
+
+    # Launch the loaders, each one takes the next waiting file until there is none
+    LOGGER.info(f"Loading {len(read_load_list(container_name, isql, datapath, datafiles))} files with {loaders} loaders...")
+    start = time.perf_counter()
+    loader_procs = [
+        subprocess.Popen(isql_command(container_name, isql, "EXEC=rdf_loader_run(log_enable=>2);"), stdout=subprocess.DEVNULL)
+        for _ in range(loaders)
+    ]
+
+    states = {}
+    while True:
+        running = any(proc.poll() is None for proc in loader_procs)
+        load_list = read_load_list(container_name, isql, datapath, datafiles)
+        for record in load_list.itertuples():
+            if states.get(record.file) != record.state:
+                states[record.file] = record.state
+                if record.error is not None:
+                    LOGGER.error(f"{record.file}: {record.error}")
+                elif record.state != "waiting":
+                    LOGGER.debug(f"{record.file}: {record.state}")
+
+        elapsed = time.perf_counter() - start
+        n_triples = loaded_triples(load_list)
+        throughput = f", {n_triples/elapsed:.0f} triples/s" if n_triples is not None and elapsed > 0 else ""
+        LOGGER.info(f"{(load_list['state'] == 'loaded').sum()}/{len(load_list)} files loaded in {elapsed:.0f}s{throughput}")
+
+        if not running:
+            break
+        time.sleep(poll_interval)
+
+    failed_loaders = [ proc.returncode for proc in loader_procs if proc.returncode != 0 ]
+    for staged_file in staged_files:
+        os.remove(staged_file)
     ctx.invoke(isql_exec, container_name=container_name, isql=isql, exec=f"checkpoint;")
+    duration = time.perf_counter() - start
+
+    errors = load_list.dropna(subset=["error"])
+
+    # Graph counts: the graphs of the copied database are expected unchanged, those of the files as in the files
+    graphs, mismatches = None, {}
+    if check_graphs or previous_report is not None:
+        expected = {}
+        if previous_report is not None:
+            with open(previous_report, "r") as report_fs:
+                previous_graphs = json.load(report_fs).get("graphs")
+            if previous_graphs is None:
+                raise RuntimeError(f"{previous_report} has no graph counts, the previous ingestion must use --check-graphs")
+            expected.update(previous_graphs)
+        for datafile in load_list["file"]:
+            for graph, count in count_graph_triples(get_local_file(datafile)).items():
+                expected[graph] = expected.get(graph, 0) + count
+
+        actual = read_graph_counts(container_name, isql)
+        graphs = { graph: actual.get(graph, 0) for graph in expected.keys() }
+        mismatches = {
+            graph: { "expected": expected[graph], "actual": graphs[graph] }
+            for graph in expected.keys() if expected[graph] != graphs[graph]
+        }
+        for graph, counts in mismatches.items():
+            LOGGER.error(f"{graph}: {counts['actual']} triples, {counts['expected']} expected")
+        LOGGER.info(f"{len(graphs) - len(mismatches)}/{len(graphs)} graphs have the expected number of triples")
+
+    if report is not None:
+        n_triples = loaded_triples(load_list)
+        load_list["triples"] = load_list["file"].map(triples)
+        with open(report, "w") as report_fs:
+            json.dump({
+                "loaders": loaders,
+                "files": len(load_list),
+                "duration": duration,
+                "triples": n_triples,
+                "throughput": n_triples / duration if n_triples is not None and duration > 0 else None,
+                "errors": len(errors),
+                "load_list": json.loads(load_list.to_json(orient="records")),
+                "graphs": graphs,
+                "graph_mismatches": mismatches
+            }, report_fs, indent=2)
+
+    if len(errors) > 0 or len(failed_loaders) > 0:
+        raise RuntimeError(f"{len(errors)} files could not be loaded, {len(failed_loaders)} loaders failed, see the logs above")
+    if len(mismatches) > 0:
+        raise RuntimeError(f"{len(mismatches)} graphs do not have the expected number of triples, see the logs above")
 
 @cli.command()
 @click.option("--container-name", type=click.STRING)
@@ -0,0 +1,203 @@
+"""Long-lived worker for the fedshop CLIs.
+
+The generation pipeline starts `python fedshop/query.py ...` for every rule, each time re-importing pandas, rdflib
+and the config resolvers. The worker imports the CLI modules once and serves their click commands on a Unix socket:
+
+- `python fedshop/worker.py serve` starts the worker.
+- `python fedshop/worker.py call query execute-query ...` is the thin client, equivalent to `python fedshop/query.py execute-query ...`.
+  It only imports the standard library and click. When no worker is listening, it falls back to running the script.
+
+Every request is served in a process forked from the worker, so that commands keep their isolation (global state, cwd)
+while sharing the already imported modules. The client passes its stdin/stdout/stderr to the worker, so the output of the
+command ends up where it would have without the worker (e.g. snakemake logs).
+
+The command runs with the environment of the client. The FEDSHOP_* variables are also read when the modules are imported
+(e.g. FEDSHOP_ARTIFACT_FORMAT), so when they differ from the ones the worker was started with, the worker declines
+the request and the client runs the script itself.
+
+Protocol: the client sends one byte along with its 3 standard file descriptors (SCM_RIGHTS),
+followed by one JSON line {"script": ..., "args": [...], "cwd": ..., "env": {...}}.
+The worker answers with one JSON line {"returncode": ...}, where returncode is null if the request was declined.
+"""
+
+import importlib
+import json
+import os
+from pathlib import Path
+import socket
+import sys
+
+import click
+
+FEDSHOP_DIR = Path(__file__).parent
+WORKER_SOCKET = os.environ.get("FEDSHOP_WORKER_SOCKET", ".fedshop_cache/worker.sock")
+ENV_PREFIX = "FEDSHOP_"
+
+def fedshop_environ(environ):
+    """The FEDSHOP_* variables of an environment, which the worker and the client must agree on.
+
+    FEDSHOP_WORKER_SOCKET is left out, the socket is also given on the command line.
+    """
+    return { k: v for k, v in environ.items() if k.startswith(ENV_PREFIX) and k != "FEDSHOP_WORKER_SOCKET" }
+
+@click.group
+def cli():
+    pass
+
+def run_command(script, args):
+    """Run a click command of a fedshop script in the current process.
+
+    Args:
+        script (str): the script name, e.g. "query" for fedshop/query.py.
+        args (list): the command line arguments.
+
+    Returns:
+        int: the return code.
+    """
+    module = importlib.import_module(script)
+    sys.argv = [str(FEDSHOP_DIR / f"{script}.py"), *args]
+    try:
+        module.cli.main(args=args, prog_name=f"{script}.py", standalone_mode=True)
+        returncode = 0
+    except SystemExit as e:
+        if e.code is None: returncode = 0
+        elif isinstance(e.code, int): returncode = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return returncode
+
+@cli.command()
+@click.option("--socket", "socket_path", type=click.Path(file_okay=True, dir_okay=False), default=WORKER_SOCKET)
+@click.option("--preload", type=click.STRING, default="query", help="Comma-separated scripts to import at startup.")
+@click.option("--max-jobs", type=click.INT, default=40, help="Maximum number of commands running at the same time.")
+def serve(socket_path, preload, max_jobs):
+    """Start the worker.
+
+    Args:
+        socket_path (str): the Unix socket to listen on.
+        preload (str): comma-separated scripts to import at startup.
+        max_jobs (int): maximum number of commands running at the same time.
+    """
+    import socketserver
+
+    sys.path.insert(0, str(FEDSHOP_DIR))
+    for script in filter(None, preload.split(",")):
+        importlib.import_module(script)
+    worker_environ = fedshop_environ(os.environ)
+
+    class CommandHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # Runs in the forked child
+            msg, fds, _, _ = socket.recv_fds(self.request, 1, 3)
+            # e.g. `ping` connects without sending anything
+            if len(msg) == 0:
+                return
+            request = json.loads(self.rfile.readline())
+
+            if fedshop_environ(request["env"]) != worker_environ:
+                for fd in fds:
+                    os.close(fd)
+                self.wfile.write((json.dumps({"returncode": None}) + "\n").encode())
+                return
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            for target_fd, fd in enumerate(fds):
+                os.dup2(fd, target_fd)
+                os.close(fd)
+
+            returncode = run_command(request["script"], request["args"])
+            self.wfile.write((json.dumps({"returncode": returncode}) + "\n").encode())
+
+    class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        max_children = max_jobs
+
+    Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    with WorkerServer(socket_path, CommandHandler) as server:
+        print(f"Worker listening on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+def call_worker(script, args, socket_path=WORKER_SOCKET):
+    """Run a fedshop command through the worker.
+
+    Args:
+        script (str): the script name, e.g. "query" for fedshop/query.py.
+        args (list): the command line arguments.
+        socket_path (str, optional): the worker socket. Defaults to WORKER_SOCKET.
+
+    Returns:
+        int: the return code, or None if no worker is listening or it was started with other FEDSHOP_* variables.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        client.close()
+        return None
+
+    with client:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socket.send_fds(client, [b"\0"], [0, 1, 2])
+        request = {"script": script, "args": list(args), "cwd": os.getcwd(), "env": dict(os.environ)}
+        client.sendall((json.dumps(request) + "\n").encode())
+
+        with client.makefile("rb") as response_fs:
+            response = response_fs.readline()
+
+    # The worker died before answering
+    if len(response) == 0:
+        return 1
+    return json.loads(response)["returncode"]
+
+@cli.command(context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False})
+@click.argument("script", type=click.STRING)
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+@click.option("--socket", "socket_path", type=click.Path(file_okay=True, dir_okay=False), default=WORKER_SOCKET)
+def call(script, args, socket_path):
+    """Run `python fedshop/<script>.py <args>` through the worker, or directly if the worker is not running
+    or was started with other FEDSHOP_* variables.
+
+    Args:
+        script (str): the script name, e.g. "query" for fedshop/query.py.
+        args (list): the command line arguments.
+        socket_path (str): the worker socket.
+    """
+    returncode = call_worker(script, args, socket_path=socket_path)
+    if returncode is None:
+        script_path = str(FEDSHOP_DIR / f"{script}.py")
+        os.execv(sys.executable, [sys.executable, script_path, *args])
+    sys.exit(returncode)
+
+@cli.command()
+@click.option("--socket", "socket_path", type=click.Path(file_okay=True, dir_okay=False), default=WORKER_SOCKET)
+def ping(socket_path):
+    """Exit with 0 if the worker is listening.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(1)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    cli()
@@ -14,7 +14,8 @@ import sys
 smk_directory = os.path.abspath(workflow.basedir)
 sys.path.append(os.path.join(Path(smk_directory).parent, "fedshop"))
 
-from utils import ping, fedshop_logger, load_config, create_stats, docker_check_container_running
+from utils import ping, fedshop_logger, load_config, create_stats, activate_container, get_batch_container
+from artifacts import artifact_extension, read_table
 
 #===============================
 # EVALUATION PHASE:
@@ -59,6 +60,9 @@ N_QUERY_INSTANCES = CONFIG_GEN["n_query_instances"]
 N_BATCH = CONFIG_GEN["n_batch"]
 LAST_BATCH = N_BATCH-1
 
+# Duration of the switches between Virtuoso containers, see activate_container
+CONTAINER_SWITCH_LOG = f"{WORK_DIR}/container-switches.csv"
+
 # Config per batch
 N_VENDOR=CONFIG_GEN["schema"]["vendor"]["params"]["vendor_n"]
 N_RATINGSITE=CONFIG_GEN["schema"]["ratingsite"]["params"]["ratingsite_n"]
@@ -150,7 +154,10 @@ rule compute_metrics:
             attempt_id=ATTEMPT_ID
         ),
     output: "{benchDir}/eval_metrics_batch{batch_id}.csv"
-    shell: "python fedshop/metrics.py compute-metrics {CONFIGFILE} {output} {input.provenance}"
+    params:
+        # Built by the build_source_index rule of ingest-data.smk
+        source_index_opt=f"--source-index={WORK_DIR}/model/source_index.npz" if os.path.exists(f"{WORK_DIR}/model/source_index.npz") else ""
+    shell: "python fedshop/metrics.py compute-metrics {CONFIGFILE} {output} {input.provenance} {params.source_index_opt}"
 
 rule transform_provenance:
     input: "{benchDir}/{engine}/{query}/instance_{instance_id}/batch_{batch_id}/attempt_{attempt_id}/source_selection.txt"
@@ -167,13 +174,13 @@ rule transform_results:
         # Transform results
         shell("python fedshop/engines/{wildcards.engine}.py transform-results {input} {output}")
         if os.stat(str(output)).st_size > 0:
-            expected_results = pd.read_csv(f"{WORK_DIR}/benchmark/generation/{wildcards.query}/instance_{wildcards.instance_id}/batch_{wildcards.batch_id}/results.csv").dropna(how="all", axis=1)
+            expected_results = read_table(f"{WORK_DIR}/benchmark/generation/{wildcards.query}/instance_{wildcards.instance_id}/batch_{wildcards.batch_id}/results{artifact_extension()}").dropna(how="all", axis=1)
             expected_results = expected_results.reindex(sorted(expected_results.columns), axis=1)
             expected_results = expected_results \
                 .sort_values(expected_results.columns.to_list()) \
                 .reset_index(drop=True) 
             
-            engine_results = pd.read_csv(str(output)).dropna(how="all", axis=1)
+            engine_results = read_table(str(output)).dropna(how="all", axis=1)
             engine_results = engine_results.reindex(sorted(engine_results.columns), axis=1)
             engine_results = engine_results \
                 .sort_values(engine_results.columns.to_list()) \
@@ -207,22 +214,11 @@ rule evaluate_engines:
         result_csv="{benchDir}/{engine}/{query}/instance_{instance_id}/batch_{batch_id}/attempt_{attempt_id}/results.csv",
         last_batch=LAST_BATCH
     run: 
-        SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-{int(wildcards.batch_id)+1}"
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, wildcards.batch_id)
 
         if USE_DOCKER:
-            if not docker_check_container_running(SPARQL_CONTAINER_NAME):
-                shell(f'docker compose -f {SPARQL_COMPOSE_FILE} stop')
-                shell(f"docker start {SPARQL_CONTAINER_NAME}")
-                while not ping(SPARQL_DEFAULT_ENDPOINT):
-                    LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
-                    time.sleep(1)
-
-            if not docker_check_container_running(PROXY_CONTAINER_NAME):
-                shell(f'docker compose -f {PROXY_COMPOSE_FILE} stop')
-                shell(f"docker start {PROXY_CONTAINER_NAME}")
-                while not ping(PROXY_SPARQL_ENDPOINT):
-                    LOGGER.debug(f"Waiting for {PROXY_SPARQL_ENDPOINT} to start...")
-                    time.sleep(1)
+            activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+            activate_container(PROXY_CONTAINER_NAME, PROXY_COMPOSE_FILE, PROXY_SPARQL_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
         
 
 
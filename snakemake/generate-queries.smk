@@ -3,7 +3,6 @@ import os
 from pathlib import Path
 import glob
 import time
-import requests
 import subprocess
 import re
 from itertools import product
@@ -13,7 +12,10 @@ smk_directory = os.path.abspath(workflow.basedir)
 print(smk_directory)
 sys.path.append(os.path.join(Path(smk_directory).parent, "fedshop"))
 
-from utils import ping, fedshop_logger, load_config, docker_check_container_running
+from utils import ping, fedshop_logger, load_config, activate_container, get_batch_container, get_batch_endpoint
+from sparql_client import SPARQL_CLIENT
+from result_cache import dataset_fingerprint
+from artifacts import artifact_extension
 LOGGER = fedshop_logger(Path(__file__).name)
 
 #===============================
@@ -56,6 +58,12 @@ N_QUERY_INSTANCES = CONFIG_GEN["n_query_instances"]
 VERBOSE = CONFIG_GEN["verbose"]
 N_BATCH = CONFIG_GEN["n_batch"]
 
+# Extension of the value selections, results and provenance: .csv or .parquet, from FEDSHOP_ARTIFACT_FORMAT (see artifacts.py)
+ARTIFACT_EXT = artifact_extension()
+
+# Duration of the switches between Virtuoso containers, see activate_container
+CONTAINER_SWITCH_LOG = f"{WORK_DIR}/container-switches.csv"
+
 QUERY_DIR = f"{WORK_DIR}/queries"
 MODEL_DIR = f"{WORK_DIR}/model"
 BENCH_DIR = f"{WORK_DIR}/benchmark/generation"
@@ -72,18 +80,32 @@ INSTANCE_ID = str(config["instance"]).split(",") if config.get("instance") is no
 
 DEBUG = eval(str(config["debug"])) if config.get("explain") is not None else False
 
+# Commands of fedshop/query.py go through the worker (fedshop/worker.py), which falls back to a new process when not running
+QUERY_WORKER = eval(str(config["query_worker"])) if config.get("query_worker") is not None else True
+QUERY_WORKER_SOCKET = os.environ.get("FEDSHOP_WORKER_SOCKET", ".fedshop_cache/worker.sock")
+QUERY_TOOLKIT = f"python fedshop/worker.py call --socket={QUERY_WORKER_SOCKET} query"
+QUERY_WORKER_PROCESS = None
+
+# Instanciate all the instances of a query with one command instead of one command per instance
+BULK_INSTANCIATE = eval(str(config["bulk_instanciate"])) if config.get("bulk_instanciate") is not None else True
+
+# Value selection of all the instances of a query in one request to the endpoint instead of one request per instance
+BATCHED_VALUE_SELECTION = eval(str(config["batched_value_selection"])) if config.get("batched_value_selection") is not None else True
+
+# Expected source selection: "semijoin" (per triple pattern queries joined locally) or "query" (one provenance query)
+PROVENANCE_ENGINE = str(config["provenance_engine"]) if config.get("provenance_engine") is not None else "semijoin"
+
+# Expected results of batch k computed from the results of batch k-1 and the graphs added by batch k (see execute-query-incremental)
+# Opt-in (--config incremental_results=True) until the delta queries are checked against a full evaluation
+INCREMENTAL_RESULTS = eval(str(config["incremental_results"])) if config.get("incremental_results") is not None else False
+
 
 #=================
 # USEFUL FUNCTIONS
 #=================
 
 def ping(endpoint):
-    try:
-        req = requests.get(endpoint)
-        LOGGER.debug(f"{req}")
-        return req.status_code == 200
-    except requests.exceptions.ConnectionError:
-        return False
+    return SPARQL_CLIENT.ping(endpoint) == 200
 
 def get_results_per_batch(wildcards):
     def combinator(benchDir, query, instance_id, batch_id):
@@ -91,7 +113,7 @@ def get_results_per_batch(wildcards):
             yield benchDir_u, query_u, instance_id_u, batch_id_u
 
     return expand(
-        "{benchDir}/{query}/instance_{instance_id}/results-batch{batch_id}.csv",
+        "{benchDir}/{query}/instance_{instance_id}/results-batch{batch_id}" + ARTIFACT_EXT,
         combinator,
         benchDir=BENCH_DIR,
         query=QUERY_PATH,
@@ -99,10 +121,38 @@ def get_results_per_batch(wildcards):
         batch_id=BATCHES
     )
 
+def start_query_worker():
+    ping_cmd = f"python fedshop/worker.py ping --socket={QUERY_WORKER_SOCKET}"
+    if subprocess.run(ping_cmd, shell=True).returncode == 0:
+        return None
+    worker = subprocess.Popen(f"exec python fedshop/worker.py serve --socket={QUERY_WORKER_SOCKET}", shell=True)
+    while subprocess.run(ping_cmd, shell=True).returncode != 0:
+        if worker.poll() is not None:
+            LOGGER.warning("Could not start the query worker, commands will run in new processes")
+            return None
+        time.sleep(0.5)
+    return worker
+
+def stop_query_worker():
+    if QUERY_WORKER_PROCESS is not None:
+        QUERY_WORKER_PROCESS.terminate()
+        QUERY_WORKER_PROCESS.wait()
+
 #=================
 # PIPELINE
 #=================
 
+onstart:
+    global QUERY_WORKER_PROCESS
+    if QUERY_WORKER:
+        QUERY_WORKER_PROCESS = start_query_worker()
+
+onsuccess:
+    stop_query_worker()
+
+onerror:
+    stop_query_worker()
+
 rule all:
     input: 
         expand(
@@ -112,64 +162,109 @@ rule all:
 
 rule generate_batch:
     input: 
-        expand(
-            "{{benchDir}}/{query}/instance_{instance_id}/results-batch{{batch_id}}.csv",
+        results=expand(
+            "{{benchDir}}/{query}/instance_{instance_id}/results-batch{{batch_id}}" + ARTIFACT_EXT,
+            query=QUERY_PATH, 
+            instance_id=INSTANCE_ID
+        ),
+        # Expected source selection, used by the evaluation (e.g. the rsa engine)
+        provenance=expand(
+            "{{benchDir}}/{query}/instance_{instance_id}/batch_{{batch_id}}/provenance" + ARTIFACT_EXT,
             query=QUERY_PATH, 
             instance_id=INSTANCE_ID
         )
     output: "{benchDir}/generate-batch{batch_id}.txt"
     shell: "echo 'ok' > {output}"
         
+def previous_results(wildcards):
+    batch_id = int(wildcards.batch_id)
+    if not INCREMENTAL_RESULTS or batch_id == 0:
+        return []
+    return f"{wildcards.benchDir}/{wildcards.query}/instance_{wildcards.instance_id}/results-batch{batch_id-1}{ARTIFACT_EXT}"
+
 rule execute_instances:
-    input: "{benchDir}/{query}/instance_{instance_id}/injected.sparql"
-    output: "{benchDir}/{query}/instance_{instance_id}/results-batch{batch_id}.csv"
+    input: 
+        query="{benchDir}/{query}/instance_{instance_id}/injected.sparql",
+        previous_results=previous_results
+    output: "{benchDir}/{query}/instance_{instance_id}/results-batch{batch_id}" + ARTIFACT_EXT
     params:
-        endpoint_batch0 = SPARQL_DEFAULT_ENDPOINT
+        endpoint = lambda wildcards: get_batch_endpoint(CONFIG, wildcards.batch_id)
     run:
-        SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-{int(wildcards.batch_id)+1}"
-        if USE_DOCKER and not docker_check_container_running(SPARQL_CONTAINER_NAME):
-            shell(f'docker compose -f {SPARQL_COMPOSE_FILE} stop')
-            shell(f"docker start {SPARQL_CONTAINER_NAME}")
-            while not ping(SPARQL_DEFAULT_ENDPOINT):
-                LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
-                time.sleep(1)
-
-        composition_file = f"{Path(str(input)).parent}/composition.json"
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, wildcards.batch_id)
+        if USE_DOCKER:
+            activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+
+        composition_file = f"{Path(str(input.query)).parent}/composition.json"
         if not os.path.exists(composition_file):
-            shell("python fedshop/query.py decompose-query {input} {composition_file}")
-        shell("python fedshop/query.py execute-query {params.endpoint_batch0} --queryfile={input} --outfile={output}")
+            shell("{QUERY_TOOLKIT} decompose-query {input.query} {composition_file}")
+        fingerprint = dataset_fingerprint(WORK_DIR, wildcards.batch_id)
+        fingerprint_opt = f"--fingerprint={fingerprint}" if fingerprint is not None else ""
 
-rule instanciate_workload:
-    threads: 1
-    input: 
-        queryfile=expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR),
-        workload_value_selection="{benchDir}/{query}/workload_value_selection.csv"
-    output:
-        injected_query="{benchDir}/{query}/instance_{instance_id}/injected.sparql",
+        # The graphs of each batch are listed in the proxy mappings written by ingest-data.smk
+        graphs = f"{WORK_DIR}/virtuoso-proxy-mapping-batch{wildcards.batch_id}.json"
+        previous_graphs = f"{WORK_DIR}/virtuoso-proxy-mapping-batch{int(wildcards.batch_id)-1}.json"
+        if len(input.previous_results) > 0 and os.path.exists(graphs) and os.path.exists(previous_graphs):
+            shell("{QUERY_TOOLKIT} execute-query-incremental {params.endpoint} {input.query} {input.previous_results} {output} --graphs={graphs} --previous-graphs={previous_graphs} {fingerprint_opt}")
+        else:
+            shell("{QUERY_TOOLKIT} execute-query {params.endpoint} --queryfile={input.query} --outfile={output} {fingerprint_opt}")
+
+rule compute_provenance:
+    input: "{benchDir}/{query}/instance_{instance_id}/injected.sparql"
+    output: "{benchDir}/{query}/instance_{instance_id}/batch_{batch_id}/provenance" + ARTIFACT_EXT
     params:
-        batch_id = 0
+        endpoint = lambda wildcards: get_batch_endpoint(CONFIG, wildcards.batch_id),
+        provenance_engine = PROVENANCE_ENGINE
     run:
-        shell("python fedshop/query.py instanciate-workload {input.queryfile} {input.workload_value_selection} {output.injected_query} {wildcards.instance_id}")
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, wildcards.batch_id)
+        if USE_DOCKER:
+            activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+
+        fingerprint = dataset_fingerprint(WORK_DIR, wildcards.batch_id)
+        fingerprint_opt = f"--fingerprint={fingerprint}" if fingerprint is not None else ""
+        shell("{QUERY_TOOLKIT} compute-provenance {input} {params.endpoint} {output} --engine={params.provenance_engine} {fingerprint_opt}")
+
+if BULK_INSTANCIATE:
+    # All the instances of a query are written by one command, which parses the template once
+    rule instanciate_workload_all:
+        threads: 1
+        input: 
+            queryfile=expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR),
+            workload_value_selection="{benchDir}/{query}/workload_value_selection" + ARTIFACT_EXT
+        output:
+            injected_queries=expand("{{benchDir}}/{{query}}/instance_{instance_id}/injected.sparql", instance_id=range(N_QUERY_INSTANCES)),
+            compositions=expand("{{benchDir}}/{{query}}/instance_{instance_id}/composition.json", instance_id=range(N_QUERY_INSTANCES))
+        params:
+            n_query_instances = N_QUERY_INSTANCES
+        run:
+            shell("{QUERY_TOOLKIT} instanciate-workload-all {input.queryfile} {input.workload_value_selection} {wildcards.benchDir}/{wildcards.query} --n-instances={params.n_query_instances}")
+else:
+    rule instanciate_workload:
+        threads: 1
+        input: 
+            queryfile=expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR),
+            workload_value_selection="{benchDir}/{query}/workload_value_selection" + ARTIFACT_EXT
+        output:
+            injected_query="{benchDir}/{query}/instance_{instance_id}/injected.sparql",
+        params:
+            batch_id = 0
+        run:
+            shell("{QUERY_TOOLKIT} instanciate-workload {input.queryfile} {input.workload_value_selection} {output.injected_query} {wildcards.instance_id}")
         
 rule create_workload_value_selection:
     threads: 5
     input: 
         value_selection_infos="{benchDir}/{query}/value_selection.json"
-    output: "{benchDir}/{query}/workload_value_selection.csv"
+    output: "{benchDir}/{query}/workload_value_selection" + ARTIFACT_EXT
     params:
         n_query_instances = N_QUERY_INSTANCES,
+        batched_opt = "--batched" if BATCHED_VALUE_SELECTION else ""
     run:
-        SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-1"
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, 0)
         if USE_DOCKER :
-            if not docker_check_container_running(SPARQL_CONTAINER_NAME):
-                shell(f'docker compose -f {SPARQL_COMPOSE_FILE} stop')
-                shell(f"docker start {SPARQL_CONTAINER_NAME}")
-            while not ping(SPARQL_DEFAULT_ENDPOINT):
-                LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
-                time.sleep(1)
+            activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
 
         constfile = f"{QUERY_DIR}/{wildcards.query}.const.json"
-        shell(f"python fedshop/query.py create-workload-value-selection {CONFIGFILE} {constfile} {input.value_selection_infos} {output} {params.n_query_instances}")
+        shell(f"{QUERY_TOOLKIT} create-workload-value-selection {CONFIGFILE} {constfile} {input.value_selection_infos} {output} {params.n_query_instances} {params.batched_opt}")
 
 rule build_value_selection_query:
     threads: 5
@@ -177,4 +272,4 @@ rule build_value_selection_query:
         constfile = expand("{queryDir}/{{query}}.const.json", queryDir=QUERY_DIR),
         queryfile = expand("{queryDir}/{{query}}.sparql", queryDir=QUERY_DIR)
     output: "{benchDir}/{query}/value_selection.json"
-    shell: "python fedshop/query.py build-value-selection-query {input.queryfile} {input.constfile} {output}"
+    shell: "{QUERY_TOOLKIT} build-value-selection-query {input.queryfile} {input.constfile} {output}"
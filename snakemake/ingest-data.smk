@@ -4,16 +4,18 @@ import numpy as np
 import os
 from pathlib import Path
 import re
+from urllib.parse import urlsplit
 
 import sys
 smk_directory = os.path.abspath(workflow.basedir)
 sys.path.append(os.path.join(Path(smk_directory).parent, "fedshop"))
 
-from utils import ping, fedshop_logger, load_config, docker_check_container_running
+from compression import dataset_suffix
+from utils import ping, fedshop_logger, load_config, activate_container, clone_container_database, get_batch_container, get_batch_endpoint, get_virtuoso_deployment
+from sparql_client import SPARQL_CLIENT
 from itertools import product
 from omegaconf import OmegaConf
 import time
-import requests
 
 print(config)
 
@@ -55,9 +57,28 @@ if USE_DOCKER:
 N_QUERY_INSTANCES = CONFIG_GEN["n_query_instances"]
 VERBOSE = CONFIG_GEN["verbose"]
 N_BATCH = CONFIG_GEN["n_batch"]
+# e.g. .nq.gz, see fedshop/compression.py
+DATASET_SUFFIX = dataset_suffix(CONFIG_GEN.get("dataset_compression", "none"))
 
 BATCHES = range(N_BATCH)
 
+# Duration of the switches between Virtuoso containers, see activate_container
+CONTAINER_SWITCH_LOG = f"{WORK_DIR}/container-switches.csv"
+
+# Number of Virtuoso loaders started at once, defaults to the number of cores
+LOADERS = int(config["loaders"]) if config.get("loaders") is not None else None
+
+# "single": one container serves all batches through graph groups, see get_virtuoso_deployment
+SINGLE_VIRTUOSO = get_virtuoso_deployment(CONFIG) == "single"
+
+# Members are loaded into the single Virtuoso as they are generated, see stream_to_virtuoso in generate.py
+STREAM_INGESTION = CONFIG_GEN["virtuoso"].get("stream_ingestion", False)
+if STREAM_INGESTION and not SINGLE_VIRTUOSO:
+    raise ValueError("stream_ingestion requires the single Virtuoso deployment, where each member is loaded once")
+
+# Batch k copies the database of batch k-1 instead of loading everything again, see clone_container_database
+INCREMENTAL_INGESTION = USE_DOCKER and not SINGLE_VIRTUOSO and CONFIG_GEN["virtuoso"].get("incremental_ingestion", False)
+
 if "batches" in config:
     BATCHES = str(config["batches"]).split(",")
     if len(BATCHES) == 0:
@@ -76,18 +97,36 @@ def validate(filename):
         f.write("ok")
 
 def ping(endpoint):
-    try:
-        req = requests.get(endpoint)
-        #LOGGER.debug(f"Response code: {req.status_code} for {endpoint}")
-        return req.status_code == 200
-    except requests.exceptions.ConnectionError:
-        return False
-
-def get_data_files(wildcards):
-    n_vendor = 10 * (int(wildcards.batch_id) + 1)
-    n_ratingsite = 10 * (int(wildcards.batch_id) + 1)
+    return SPARQL_CLIENT.ping(endpoint) == 200
+
+def get_batch_data_files(batch_id):
+    n_vendor = 10 * (batch_id + 1)
+    n_ratingsite = 10 * (batch_id + 1)
     
-    return [ f"{DATA_DIR}/vendor{vendor_id}.nq" for vendor_id in range(n_vendor) ] + [ f"{DATA_DIR}/ratingsite{ratingsite_id}.nq" for ratingsite_id in range(n_ratingsite) ]
+    return [ f"{DATA_DIR}/vendor{vendor_id}{DATASET_SUFFIX}" for vendor_id in range(n_vendor) ] + [ f"{DATA_DIR}/ratingsite{ratingsite_id}{DATASET_SUFFIX}" for ratingsite_id in range(n_ratingsite) ]
+
+def get_ingested_data_files(wildcards):
+    """The files loaded when ingesting a batch.
+
+    With a single Virtuoso, or with incremental ingestion, batch k only loads the files that are not in batch k-1, after batch k-1.
+    """
+    batch_id = int(wildcards.batch_id)
+    datafiles = get_batch_data_files(batch_id)
+    if not (SINGLE_VIRTUOSO or INCREMENTAL_INGESTION) or batch_id == 0:
+        return datafiles
+    previous_datafiles = set(get_batch_data_files(batch_id-1))
+    return [ f for f in datafiles if f not in previous_datafiles ]
+
+def get_previous_ingestion(wildcards):
+    batch_id = int(wildcards.batch_id)
+    if not (SINGLE_VIRTUOSO or INCREMENTAL_INGESTION) or batch_id == 0:
+        return []
+    return f"{wildcards.workDir}/virtuoso-data-batch{batch_id-1}-ok.txt"
+
+def get_member_port(member_name):
+    """With a single Virtuoso, each member has one endpoint shared by all the batches, on a fixed port."""
+    last_batch_members = list(CONFIG_GEN["virtuoso"]["federation_members"][f"batch{N_BATCH-1}"].keys())
+    return NET_PORT + last_batch_members.index(member_name)
 
 #=================
 # PIPELINE
@@ -106,13 +145,9 @@ rule create_federation_endpoints:
     input: "{workDir}/virtuoso-data-batch{batch_id}-ok.txt"
     output: "{workDir}/virtuoso-federation-endpoints-batch{batch_id}-ok.txt"
     run:
-        SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-{int(wildcards.batch_id)+1}"
-        shell(f'docker compose -f {SPARQL_COMPOSE_FILE} stop')
-        shell(f'docker start {SPARQL_CONTAINER_NAME}')
-
-        while not ping(SPARQL_DEFAULT_ENDPOINT):
-            LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
-            time.sleep(1)
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, wildcards.batch_id)
+        activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+        isql_opt = f"--container-name={SPARQL_CONTAINER_NAME}" if USE_DOCKER else f'--isql="{VIRTUOSO_PATH_TO_ISQL}"'
 
         global NET_PORT
         proxy_mapping = {}
@@ -126,45 +161,84 @@ rule create_federation_endpoints:
         federation_members_info = CONFIG_GEN["virtuoso"]["federation_members"][f"batch{wildcards.batch_id}"]
         for fed_member_name, fed_member_iri in federation_members_info.items():
             lpath = f"/{fed_member_name}/sparql"
-            host = f"localhost:{NET_PORT}"
+            port = get_member_port(fed_member_name) if SINGLE_VIRTUOSO else NET_PORT
+            host = f"localhost:{port}"
             proxy_target = f"http://{host}{lpath}"
             proxy_mapping[fed_member_iri] = proxy_target
-            
-            if USE_DOCKER:
-                shell(f"python fedshop/virtuoso.py create-sparql-endpoint --container-name={SPARQL_CONTAINER_NAME} --on-duplicate=REPLACE --host={host} --lpath={lpath} {fed_member_iri}")
-            else:
-                shell(f'python fedshop/virtuoso.py create-sparql-endpoint --isql="{VIRTUOSO_PATH_TO_ISQL}" --on-duplicate=REPLACE --host={host} --lpath={lpath} {fed_member_iri}')
 
-            NET_PORT += 1
+            if not SINGLE_VIRTUOSO:
+                NET_PORT += 1
 
         with open(virtuoso_mapping_file, "w") as f:
             json.dump(proxy_mapping, f)
+
+        # All the endpoints are created with one isql script
+        shell(f"python fedshop/virtuoso.py create-sparql-endpoints {isql_opt} --on-duplicate=REPLACE {virtuoso_mapping_file}")
+
+        if SINGLE_VIRTUOSO:
+            batch_endpoint = urlsplit(get_batch_endpoint(CONFIG, wildcards.batch_id))
+            graph_group = CONFIG_GEN["virtuoso"]["batch_members"][int(wildcards.batch_id)]
+            members = ",".join(federation_members_info.values())
+            shell(f"python fedshop/virtuoso.py create-batch-endpoint {isql_opt} --host={batch_endpoint.netloc} --lpath={batch_endpoint.path} --members={members} {graph_group}")
+
         validate(str(output))
         
 rule ingest_data:
     input:
-        datafiles=get_data_files,
+        datafiles=get_ingested_data_files,
+        previous_ingestion=get_previous_ingestion,
         containers_created="{workDir}/virtuoso-containers-ok.txt"
     output: "{workDir}/virtuoso-data-batch{batch_id}-ok.txt"
     run:
-        SPARQL_CONTAINER_NAME = f"docker-{SPARQL_SERVICE_NAME}-{int(wildcards.batch_id)+1}"
+        SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, wildcards.batch_id)
+        datafiles = [ f.replace(DATA_DIR + "/", "") for f in input.datafiles ]
+        # The ingestion report (duration, triples, throughput, per-file state) is written next to the marker
+        loader_opts = f"--report {wildcards.workDir}/virtuoso-data-batch{wildcards.batch_id}-report.json"
+        if LOADERS is not None:
+            loader_opts += f" --loaders {LOADERS}"
+        if INCREMENTAL_INGESTION:
+            # The graphs of batch k-1 must be unchanged, the new ones must contain the triples of their file
+            loader_opts += " --check-graphs"
+            batch_id = int(wildcards.batch_id)
+            if batch_id > 0:
+                clone_container_database(get_batch_container(CONFIG, batch_id-1), SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, switch_log=CONTAINER_SWITCH_LOG)
+                loader_opts += f" --previous-report {wildcards.workDir}/virtuoso-data-batch{batch_id-1}-report.json"
         if USE_DOCKER:
-            if not docker_check_container_running(SPARQL_CONTAINER_NAME):
-                shell(f'docker compose -f {SPARQL_COMPOSE_FILE} stop')
-                shell(f"docker start {SPARQL_CONTAINER_NAME}")
-            while not ping(SPARQL_DEFAULT_ENDPOINT):
-                LOGGER.debug(f"Waiting for {SPARQL_DEFAULT_ENDPOINT} to start...")
-                time.sleep(1)
-
-            
-            datafiles = [ f.replace(DATA_DIR + "/", "") for f in input.datafiles ]
-            shell(f'python fedshop/virtuoso.py ingest-data --container-name {SPARQL_CONTAINER_NAME} --datafiles "{",".join(datafiles)}"')
+            activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+            shell(f'python fedshop/virtuoso.py ingest-data --container-name {SPARQL_CONTAINER_NAME} --datafiles "{",".join(datafiles)}" --local-datapath {DATA_DIR} {loader_opts}')
         else:
-            shell(f'python fedshop/virtuoso.py ingest-data --isql "{VIRTUOSO_PATH_TO_ISQL}" --datapath {os.path.realpath(VIRTUOSO_PATH_TO_DATA)} --datafiles "{",".join(datafiles)}"')
+            shell(f'python fedshop/virtuoso.py ingest-data --isql "{VIRTUOSO_PATH_TO_ISQL}" --datapath {os.path.realpath(VIRTUOSO_PATH_TO_DATA)} --datafiles "{",".join(datafiles)}" {loader_opts}')
         
         validate(str(output))
 
+if STREAM_INGESTION:
+    rule generate_and_ingest_member:
+        priority: 12
+        threads: 5
+        input:
+            product=ancient(CONFIG_GEN["schema"]["product"]["export_output_dir"]),
+            containers_created=f"{WORK_DIR}/virtuoso-containers-ok.txt"
+        output: DATA_DIR + "/{section}{member_id}" + DATASET_SUFFIX
+        wildcard_constraints:
+            section="vendor|ratingsite",
+            member_id=r"\d+"
+        run:
+            SPARQL_CONTAINER_NAME = get_batch_container(CONFIG, 0)
+            # The data directory as seen by Virtuoso must be the one given to ingest-data, see ingest_data
+            if USE_DOCKER:
+                activate_container(SPARQL_CONTAINER_NAME, SPARQL_COMPOSE_FILE, SPARQL_DEFAULT_ENDPOINT, switch_log=CONTAINER_SWITCH_LOG)
+                virtuoso_opts = f"--container-name {SPARQL_CONTAINER_NAME}"
+            else:
+                virtuoso_opts = f'--isql "{VIRTUOSO_PATH_TO_ISQL}" --datapath {os.path.realpath(VIRTUOSO_PATH_TO_DATA)}'
+            shell(f"python fedshop/generate.py generate {CONFIGFILE} {wildcards.section} {output} --id {wildcards.member_id} --ingest {virtuoso_opts}")
+
+rule build_source_index:
+    input: expand("{dataDir}/{member}{suffix}", dataDir=DATA_DIR, suffix=DATASET_SUFFIX, member=[ f"{kind}{i}" for kind in ["vendor", "ratingsite"] for i in range(10 * N_BATCH) ])
+    output: f"{MODEL_DIR}/source_index.npz"
+    shell: "python fedshop/source_index.py build {DATA_DIR} {output} --datafiles '*{DATASET_SUFFIX}'"
+
 rule create_batches:
     output: "{workDir}/virtuoso-containers-ok.txt"
     run:
-        shell(f"docker compose -f {SPARQL_COMPOSE_FILE} create --no-recreate --scale {SPARQL_SERVICE_NAME}={N_BATCH} && touch {output}")
\ No newline at end of file
+        n_containers = 1 if SINGLE_VIRTUOSO else N_BATCH
+        shell(f"docker compose -f {SPARQL_COMPOSE_FILE} create --no-recreate --scale {SPARQL_SERVICE_NAME}={n_containers} && touch {output}")
\ No newline at end of file
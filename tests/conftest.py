@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The fedshop modules import each other by their flat name, as when they are run as scripts
+sys.path.append(str(Path(__file__).parent.parent / "fedshop"))
@@ -0,0 +1,39 @@
+import os
+
+from algebra.cache import AlgebraCache
+
+ENTRY = "x" * 1000
+
+def test_memory_is_bounded(tmp_path):
+    cache = AlgebraCache(cache_dir=str(tmp_path), memory_max_bytes=2500, enabled=True)
+    for key in ["aa1", "aa2", "aa3"]:
+        cache.set(key, ENTRY)
+    assert list(cache._memory.keys()) == ["aa2", "aa3"]
+
+    # Entries evicted from memory are still found on disk
+    assert cache.get("aa1") == ENTRY
+    assert list(cache._memory.keys()) == ["aa3", "aa1"]
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = AlgebraCache(cache_dir=str(tmp_path), max_bytes=10**6, enabled=True)
+    for i, key in enumerate(["aa1", "aa2", "aa3"]):
+        cache.set(key, ENTRY)
+        os.utime(cache._path(key), (i, i))
+    cache.clear()
+    # Reading an entry makes it the most recently used
+    assert cache.get("aa1") == ENTRY
+
+    size = os.path.getsize(cache._path("aa1"))
+    assert cache.evict(max_bytes=2 * size) == 1
+    assert not os.path.exists(cache._path("aa2"))
+    assert os.path.exists(cache._path("aa1")) and os.path.exists(cache._path("aa3"))
+
+def test_purge(tmp_path):
+    cache = AlgebraCache(cache_dir=str(tmp_path), enabled=True)
+    cache.set("aa1", ENTRY)
+    cache.set("bb2", ENTRY)
+    os.utime(cache._path("aa1"), (0, 0))
+
+    assert cache.purge(older_than=3600) == 1
+    assert cache.get("aa1") is None and cache.get("bb2") == ENTRY
+    assert cache.purge() == 1 and cache.entries() == []
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+from artifacts import TableWriter, read_table, write_table
+
+pytest.importorskip("pyarrow")
+
+CHUNKS = [
+    pd.DataFrame({
+        "product": ["http://ex.org/Product1", "http://ex.org/Product2"],
+        "price": pd.array([10, 20], dtype="Int64"),
+        "rating": [1.5, 2.5],
+        "date": pd.to_datetime(["2008-01-01", "2008-01-02"]),
+    }),
+    pd.DataFrame({
+        "product": ["http://ex.org/Product3", "http://ex.org/Product4"],
+        "price": pd.array([30, None], dtype="Int64"),
+        "rating": [3.5, None],
+        "date": pd.to_datetime(["2008-01-03", "2008-01-04"]),
+    }),
+]
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet"])
+def test_table_writer_keeps_numeric_columns(tmp_path, extension):
+    path = tmp_path / f"results{extension}"
+    with TableWriter(path) as writer:
+        for chunk in CHUNKS:
+            writer.write(chunk)
+
+    df = read_table(path)
+    assert df["price"].dtype == "float64" and df["price"].tolist()[:3] == [10, 20, 30] and pd.isna(df["price"][3])
+    assert df["rating"].dtype == "float64"
+    assert pd.api.types.is_datetime64_any_dtype(df["date"])
+    assert df["product"].tolist() == [f"http://ex.org/Product{i}" for i in range(1, 5)]
+
+def test_write_table_keeps_integer_columns(tmp_path):
+    path = tmp_path / "results.parquet"
+    write_table(CHUNKS[0], path)
+    assert read_table(path)["price"].dtype == "int64"
+
+def test_table_writer_refuses_chunks_of_another_schema(tmp_path):
+    with pytest.raises(RuntimeError, match="schema of the first chunk"):
+        with TableWriter(tmp_path / "results.parquet") as writer:
+            writer.write(CHUNKS[0])
+            writer.write(CHUNKS[1].assign(price=["A3", "B4"]))
@@ -0,0 +1,41 @@
+import pytest
+
+import generate
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+def test_merge_product_shard(tmp_path):
+    output_dir, shard_dir = tmp_path / "product", tmp_path / "shard1"
+    write(output_dir / "Product0.nt", "<http://ex.org/Product0> <http://ex.org/label> \"product 0\" .\n")
+    write(output_dir / "ProductFeature.nt", "<http://ex.org/ProductFeature1> <http://ex.org/label> \"feature 1\" .\n")
+    write(output_dir / "ProductType2" / "ProductType2.nt", "<http://ex.org/ProductType2> <http://ex.org/label> \"type 2\" .\n")
+    # The shard numbers its products from 0, its features and types are copies of those of the first shard
+    write(shard_dir / "Product0.nt",
+        "<http://ex.org/Product0> <http://ex.org/label> \"product 0 of shard 1\" .\n"
+        "<http://ex.org/Product0> <http://ex.org/type> <http://ex.org/ProductType2> .\n"
+    )
+    write(shard_dir / "ProductFeature.nt",
+        "<http://ex.org/ProductFeature1> <http://ex.org/label> \"feature 1\" .\n"
+        "<http://ex.org/Product0> <http://ex.org/productFeature> <http://ex.org/ProductFeature1> .\n"
+    )
+    write(shard_dir / "ProductType2" / "ProductType2.nt", "<http://ex.org/ProductType2> <http://ex.org/label> \"type 2\" .\n")
+
+    generate.merge_product_shard(str(shard_dir), str(output_dir), 10)
+
+    assert (output_dir / "Product0.nt").read_text() == "<http://ex.org/Product0> <http://ex.org/label> \"product 0\" .\n"
+    assert (output_dir / "Product10.nt").read_text() == (
+        "<http://ex.org/Product10> <http://ex.org/label> \"product 0 of shard 1\" .\n"
+        "<http://ex.org/Product10> <http://ex.org/type> <http://ex.org/ProductType2> .\n"
+    )
+    assert (output_dir / "ProductFeature.nt").read_text() == (
+        "<http://ex.org/ProductFeature1> <http://ex.org/label> \"feature 1\" .\n"
+        "<http://ex.org/Product10> <http://ex.org/productFeature> <http://ex.org/ProductFeature1> .\n"
+    )
+    assert (output_dir / "ProductType2" / "ProductType2.nt").read_text() == "<http://ex.org/ProductType2> <http://ex.org/label> \"type 2\" .\n"
+
+def test_product_shards_require_seed_option(tmp_path):
+    config = { "schema": {}, "generator": { "exec": "watdiv", "seed_option": None, "seed": 0 } }
+    with pytest.raises(ValueError, match="seed_option"):
+        generate.generate_product_shards(config, str(tmp_path / "product"), str(tmp_path / "product0"), 2)
@@ -0,0 +1,120 @@
+from io import BytesIO
+
+import pandas as pd
+import pytest
+
+import query
+from artifacts import read_table
+from result_cache import ResultCache
+
+ENDPOINT = "http://localhost:8890/sparql"
+FINGERPRINT = "test"
+QUERY = "SELECT * WHERE { ?product ?p ?o }"
+
+# In the first chunk (2 rows), price and code look like integers: price has a missing value and code letters later on
+RESULT = b"""\
+"product","price","code","date","label"
+"http://ex.org/Product1",10,1,"2008-01-01","a label"
+"http://ex.org/Product2",20,2,"2008-01-02","another, label"
+"http://ex.org/Product3",30,"A3","2008-01-03","a label"
+"http://ex.org/Product4",,"B4","2008-01-04",
+"""
+
+@pytest.fixture
+def cached_result(tmp_path, monkeypatch):
+    """Serve the results from a result cache, so that no endpoint is needed."""
+    def serve(result):
+        cache = ResultCache(cache_dir=str(tmp_path / "cache"), enabled=True)
+        cache.set(ENDPOINT, FINGERPRINT, QUERY, result)
+        monkeypatch.setattr(query, "RESULT_CACHE", cache)
+    return serve
+
+def execute(outfile, stream, **kwargs):
+    options = dict(
+        endpoint=ENDPOINT, queryfile=None, querydata=QUERY, outfile=str(outfile), sample=None, seed=query.PANDAS_RANDOM_STATE,
+        ignore_errors=False, dropna=False, method=None, stream=stream, chunksize=2, fingerprint=FINGERPRINT
+    )
+    options.update(kwargs)
+    return query.execute_query.callback(**options)
+
+def test_streamed_result_equals_in_memory_result(tmp_path, cached_result):
+    cached_result(RESULT)
+    execute(tmp_path / "in_memory.csv", stream=False)
+    execute(tmp_path / "streamed.csv", stream=True)
+
+    pd.testing.assert_frame_equal(read_table(tmp_path / "streamed.csv"), read_table(tmp_path / "in_memory.csv"))
+
+def test_streamed_parquet_result(tmp_path, cached_result):
+    pytest.importorskip("pyarrow")
+    # Without code, all the chunks fit the dtypes of the first one
+    cached_result(pd.read_csv(BytesIO(RESULT)).drop(columns="code").to_csv(index=False).encode())
+    execute(tmp_path / "streamed.parquet", stream=True)
+
+    streamed = read_table(tmp_path / "streamed.parquet")
+    assert streamed["price"].dtype == "float64"
+    assert streamed["price"].tolist()[:3] == [10, 20, 30] and pd.isna(streamed["price"][3])
+    assert pd.api.types.is_datetime64_any_dtype(streamed["date"])
+
+def test_streamed_chunks_have_the_dtypes_of_the_first_one(cached_result):
+    cached_result(RESULT)
+    chunks = list(query.exec_query_stream(QUERY, ENDPOINT, chunksize=2, fingerprint=FINGERPRINT))
+
+    assert [ str(chunk["price"].dtype) for chunk in chunks ] == ["Int64", "Int64"]
+    assert chunks[1]["price"].isna().tolist() == [False, True]
+    # "A3" does not fit the integers of the first chunk, the second chunk keeps its strings
+    assert chunks[0]["code"].tolist() == [1, 2] and chunks[1]["code"].tolist() == ["A3", "B4"]
+
+def test_streamed_partial_result_is_not_cached(monkeypatch, cached_result):
+    class Response:
+        headers = { "X-SQL-State": query.VIRTUOSO_TIMEOUT_STATE, "X-SQL-Message": "RC...: Returning incomplete results" }
+        raw = BytesIO(RESULT)
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            pass
+
+    cached_result(b"")
+    query.RESULT_CACHE.purge()
+    monkeypatch.setattr(query.SPARQL_CLIENT, "query", lambda *args, **kwargs: Response())
+    with pytest.raises(RuntimeError, match="partial"):
+        list(query.exec_query_stream(QUERY, ENDPOINT, fingerprint=FINGERPRINT))
+    assert query.RESULT_CACHE.get(ENDPOINT, FINGERPRINT, QUERY) is None
+
+def test_streamed_sample_equals_in_memory_result(tmp_path, cached_result):
+    cached_result(RESULT)
+    sample = execute(tmp_path / "sample.csv", stream=True, sample=4)
+    in_memory = execute(tmp_path / "in_memory.csv", stream=False)
+
+    pd.testing.assert_frame_equal(sample, in_memory)
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_empty_result(tmp_path, cached_result, stream):
+    cached_result(b"")
+    outfile = tmp_path / "empty.csv"
+    execute(outfile, stream=stream, ignore_errors=True)
+    assert outfile.exists()
+
+    with pytest.raises(RuntimeError):
+        execute(tmp_path / "error.csv", stream=stream)
+
+def test_align_dtypes_drops_equal_rows():
+    # "10" is a string in the previous results, as other codes are not numbers, and an integer in the delta
+    previous = pd.DataFrame({ "code": ["A1", "10"], "price": [1.5, None] })
+    delta = pd.DataFrame({ "code": [10, 20], "price": [None, 2] })
+    previous, delta = query.align_dtypes(previous, delta)
+
+    results = pd.concat([previous, delta], ignore_index=True).drop_duplicates()
+    assert results["code"].tolist() == ["A1", "10", "20"]
+    assert results["price"].dtype == float
+
+def test_partial_result_is_not_cached(tmp_path, monkeypatch, cached_result):
+    class Response:
+        headers = { "X-SQL-State": query.VIRTUOSO_TIMEOUT_STATE, "X-SQL-Message": "RC...: Returning incomplete results" }
+        content = RESULT
+
+    cached_result(b"")
+    query.RESULT_CACHE.purge()
+    monkeypatch.setattr(query.SPARQL_CLIENT, "query", lambda *args, **kwargs: Response())
+    with pytest.raises(RuntimeError, match="partial"):
+        query.exec_query_on_endpoint(QUERY, ENDPOINT, error_when_timeout=True, fingerprint=FINGERPRINT)
+    assert query.RESULT_CACHE.get(ENDPOINT, FINGERPRINT, QUERY) is None
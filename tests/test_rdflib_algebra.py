@@ -0,0 +1,17 @@
+import pytest
+from rdflib.plugins.sparql.algebra import translateQuery
+from rdflib.plugins.sparql.parser import parseQuery
+
+from algebra.rdflib_algebra import translateAlgebra
+
+def translate(query):
+    return translateAlgebra(translateQuery(parseQuery(query)))
+
+@pytest.mark.parametrize("op", ["IN", "NOT IN"])
+def test_in_list_serialization(op):
+    query = translate(f"SELECT ?s WHERE {{ GRAPH ?g {{ ?s ?p ?o }} FILTER(?g {op} (<http://ex.org/g1>, <http://ex.org/g2>)) }}")
+    assert f"FILTER(?g {op} (<http://ex.org/g1>, <http://ex.org/g2>))" in query
+
+def test_in_list_of_one_value_serialization():
+    query = translate("SELECT ?s WHERE { ?s ?p ?o FILTER(?o NOT IN (1) && ?p IN (<http://ex.org/p>)) }")
+    assert '?o NOT IN ("1"^^<http://www.w3.org/2001/XMLSchema#integer>) && ?p IN (<http://ex.org/p>)' in query
@@ -0,0 +1,39 @@
+from io import BytesIO
+
+from result_cache import CachingReader, ResultCache, normalize_query
+
+def test_normalize_query_collapses_whitespace_and_comments():
+    query = """
+    # a comment
+    SELECT ?s   WHERE {
+        ?s <http://ex.org/vocab#p> ?o . # another comment
+    }
+    """
+    assert normalize_query(query) == "SELECT ?s WHERE { ?s <http://ex.org/vocab#p> ?o . }"
+
+def test_normalize_query_keeps_literals():
+    assert normalize_query('SELECT * WHERE { ?s ?p "a  b" }') != normalize_query('SELECT * WHERE { ?s ?p "a b" }')
+    assert normalize_query("SELECT * WHERE { ?s ?p '''a\n # b''' }") == "SELECT * WHERE { ?s ?p '''a\n # b''' }"
+    assert normalize_query('SELECT * WHERE { ?s ?p "a \\"  # b" }') == 'SELECT * WHERE { ?s ?p "a \\"  # b" }'
+
+def test_caching_reader(tmp_path, monkeypatch):
+    monkeypatch.setattr("result_cache.SPOOL_MAX_BYTES", 16)
+    cache = ResultCache(cache_dir=str(tmp_path), enabled=True)
+    data = b"s,p,o\n" + b"".join(f"<http://ex.org/s{i}>,<http://ex.org/p>,{i}\n".encode() for i in range(1000))
+
+    reader = CachingReader(BytesIO(data), cache, "http://localhost/sparql", "fp", "SELECT * {}")
+    chunks = []
+    while True:
+        chunk = reader.read(100)
+        chunks.append(chunk)
+        if len(chunk) == 0:
+            break
+
+    assert b"".join(chunks) == data
+    assert cache.get("http://localhost/sparql", "fp", "SELECT * {}") == data
+
+def test_caching_reader_too_large(tmp_path):
+    cache = ResultCache(cache_dir=str(tmp_path), max_entry_bytes=10, enabled=True)
+    reader = CachingReader(BytesIO(b"x" * 100), cache, "http://localhost/sparql", "fp", "SELECT * {}")
+    assert reader.read() == b"x" * 100
+    assert cache.get("http://localhost/sparql", "fp", "SELECT * {}") is None
@@ -0,0 +1,31 @@
+import pytest
+
+import utils
+
+@pytest.fixture
+def docker(monkeypatch):
+    """Record the docker commands, the target container has the given mounts."""
+    commands, mounts = [], ["/database"]
+    def check_output(cmd, shell=False):
+        commands.append(cmd)
+        return ("\n".join(mounts) if ".Mounts" in cmd else "openlink/virtuoso-opensource-7:7.2.13-alpine").encode()
+    monkeypatch.setattr(utils.subprocess, "check_output", check_output)
+    monkeypatch.setattr(utils.subprocess, "run", lambda cmd, **kwargs: commands.append(cmd))
+    return commands, mounts
+
+def test_clone_container_database_empties_the_target_first(tmp_path, docker):
+    commands, _ = docker
+    utils.clone_container_database("virtuoso-1", "virtuoso-2", "virtuoso.yml", switch_log=str(tmp_path / "switch.csv"))
+
+    clear = next(i for i, cmd in enumerate(commands) if "rm -rf" in cmd)
+    copy = next(i for i, cmd in enumerate(commands) if "docker cp" in cmd)
+    assert clear < copy
+    assert "--volumes-from virtuoso-2" in commands[clear] and "openlink/virtuoso-opensource-7:7.2.13-alpine" in commands[clear]
+    assert "/database/*" in commands[clear]
+
+def test_clone_container_database_requires_a_volume(tmp_path, docker):
+    commands, mounts = docker
+    mounts.clear()
+    with pytest.raises(RuntimeError, match="not a volume"):
+        utils.clone_container_database("virtuoso-1", "virtuoso-2", "virtuoso.yml", switch_log=str(tmp_path / "switch.csv"))
+    assert not any("docker cp" in cmd for cmd in commands)
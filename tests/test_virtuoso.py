@@ -0,0 +1,19 @@
+import gzip
+
+from virtuoso import count_graph_triples
+
+def test_count_graph_triples_tab_separated(tmp_path):
+    datafile = tmp_path / "vendor0.nq.gz"
+    with gzip.open(datafile, "wt") as fs:
+        fs.write('<http://ex.org/s1>\t<http://ex.org/p>\t"a literal . with spaces"\t<http://www.vendor0.fr/> .\n')
+        fs.write('<http://ex.org/s2>\t<http://ex.org/p>\t<http://ex.org/o>\t<http://www.vendor0.fr/> .\n')
+        fs.write('<http://ex.org/s2>\t<http://ex.org/p>\t<http://ex.org/o>\t<http://www.vendor0.fr/> .\n')
+        fs.write('<http://ex.org/s3>\t<http://ex.org/p>\t<http://ex.org/o>\t<http://www.vendor1.fr/> .\n')
+
+    assert count_graph_triples(str(datafile)) == {"http://www.vendor0.fr/": 2, "http://www.vendor1.fr/": 1}
+
+def test_count_graph_triples_space_separated(tmp_path):
+    datafile = tmp_path / "vendor0.nq"
+    datafile.write_text('<http://ex.org/s1> <http://ex.org/p> "o" <http://www.vendor0.fr/> .\n')
+
+    assert count_graph_triples(str(datafile)) == {"http://www.vendor0.fr/": 1}